@@ -0,0 +1,364 @@
+# !/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Throughput and latency benchmark of the Queue executor.
+
+    For every combination of store, dispatch mode, pool size and workload, the benchmark:
+        1. enqueues `--commands` commands with enqueue_many while no daemon runs (enqueue rate),
+        2. starts a daemon and waits for the queue to drain (commands/sec and per-command overhead of the daemon:
+           pool slot time not spent inside a command),
+        3. trickles `--latency-samples` commands into the now idle daemon, one every `--interval` seconds
+           (end-to-end dispatch latency: from enqueue to the start of the command in a worker).
+
+    Workloads:
+        * noop   - `true`
+        * sleep  - `sleep <--sleep>`
+        * cpu    - a python loop of `--cpu-loops` iterations
+        * output - `--output-bytes` bytes written to stdout
+
+    Usage:
+        $python3 -m src.executors.benchmark --pools 1 4 --stores files sqlite --modes batch continuous asyncio
+        $python3 -m src.executors.benchmark --compare benchmarks/benchmark_<old>.json
+
+    Results are saved as JSON (`benchmarks/benchmark_<datetime>.json` by default), `--compare` prints the change
+    of every measure against an older result file. Benchmark queues are named `benchmark_*` and removed afterwards.
+"""
+
+import sys
+import shutil
+import signal
+import socket
+import logging
+import argparse
+import platform
+from pathlib import Path
+import subprocess
+from time import sleep, time, monotonic
+from datetime import datetime
+from configs.conf import __WORKSPACE__
+from src.utils.json_util import save_json, read_json
+from src.executors import queue_executor
+from src.executors.queue_executor import QueueExecutor
+from src.executors.limits import kill_group
+from src.executors.journal import pid_alive, __DONE__
+
+
+__author__ = 'Mohammed Ataaur Rahaman'
+
+
+__BENCHMARK_DIR__ = __WORKSPACE__ / 'benchmarks'
+__WORKLOADS__ = ('noop', 'sleep', 'cpu', 'output')
+__MODES__ = {
+    # mode -> (dispatch, engine)
+    'batch': ('batch', 'process'),
+    'continuous': ('continuous', 'process'),
+    'asyncio': ('batch', 'asyncio'),
+}
+__PERCENTILES__ = (50, 90, 99)
+
+log = logging.getLogger(__name__)
+
+
+def workload_command(workload, sleep_seconds=0.1, cpu_loops=200000, output_bytes=1048576):
+    """
+    :param workload: One of __WORKLOADS__
+    :return: Shell command of the workload
+    """
+    if workload == 'noop':
+        return 'true'
+    if workload == 'sleep':
+        return f'sleep {sleep_seconds}'
+    if workload == 'cpu':
+        return f'{sys.executable} -c "for _ in range({cpu_loops}): pass"'
+    if workload == 'output':
+        return f'yes benchmark | head -c {output_bytes}'
+    raise Exception(f"Unknown workload: {workload}")
+
+
+def percentiles(values):
+    """
+    Nearest-rank percentiles.
+    :return: Dictionary of p50, p90, p99, min, max and mean, None if there is no value
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    stats = {f'p{p}': values[min(len(values) - 1, max(0, -(-p * len(values) // 100) - 1))] for p in __PERCENTILES__}
+    stats.update(min=values[0], max=values[-1], mean=sum(values) / len(values))
+    return stats
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=__WORKSPACE__, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+
+    def __init__(self, store, mode, pool, workload, commands=200, latency_samples=50, interval=0.02, timeout=600,
+                 keep=False, **workload_args):
+        """
+        :param store: 'files' or 'sqlite'
+        :param mode: Key of __MODES__
+        :param pool: Pool size of the daemon
+        :param workload: One of __WORKLOADS__
+        :param commands: Number of commands of the throughput run
+        :param latency_samples: Number of commands of the latency run
+        :param interval: Seconds between two commands of the latency run
+        :param timeout: Max seconds to wait for a run to drain
+        :param keep: Keep the benchmark queue directory
+        :param workload_args: sleep_seconds, cpu_loops and output_bytes of the workloads
+        """
+        self.store = store
+        self.mode = mode
+        self.pool = pool
+        self.workload = workload
+        self.commands = commands
+        self.latency_samples = latency_samples
+        self.interval = interval
+        self.timeout = timeout
+        self.keep = keep
+        self.command = workload_command(workload, **workload_args)
+
+        self.queue_name = f'benchmark_{store}_{mode}_p{pool}_{workload}'
+        self.queue_root = queue_executor.__QUEUE_DIR__ / self.queue_name
+        self.daemon = None
+
+    def tagged(self, tag):
+        # The shell ignores the comment, it maps the completion record back to the enqueued command.
+        return f'{self.command} # benchmark {tag}'
+
+    def start_daemon(self):
+        dispatch, engine = __MODES__[self.mode]
+        self.daemon = subprocess.Popen(
+            [
+                sys.executable, '-m', 'src.executors.queue_executor', '--queue', self.queue_name,
+                '--pool', str(self.pool), '--dispatch', dispatch, '--engine', engine, '--store', self.store,
+            ],
+            cwd=__WORKSPACE__, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+        )
+
+    def stop_daemon(self, executor):
+        """
+        Kill the daemon with its pool (they share a process group), then the commands still running: each one runs
+        in a session of its own, found in the journal.
+        """
+        if self.daemon is None:
+            return
+        kill_group(self.daemon.pid, signal.SIGKILL)
+        self.daemon.wait()
+        self.daemon = None
+        for state, info, _ in executor.journal.states().values():
+            pgid = info.get('pgid')
+            if state != __DONE__ and pgid and pid_alive(pgid, info.get('pgid_start')):
+                kill_group(pgid, signal.SIGKILL)
+
+    def wait_completed(self, executor, count):
+        """
+        Wait for `count` completion records.
+        :return: List of the completion records
+        """
+        deadline = monotonic() + self.timeout
+        while True:
+            done = executor.count_results()
+            if done >= count:
+                try:
+                    return list(executor.results())
+                except Exception:
+                    pass  # A record still being written, read again
+            if self.daemon.poll() is not None:
+                raise Exception(f"Daemon of {self.queue_name} exited with {self.daemon.returncode}")
+            if monotonic() > deadline:
+                raise Exception(f"{self.queue_name}: only {done} of {count} commands done in {self.timeout}s")
+            sleep(0.01)
+
+    def run(self):
+        """
+        :return: Dictionary of the measures
+        """
+        shutil.rmtree(self.queue_root, ignore_errors=True)
+        dispatch, engine = __MODES__[self.mode]
+        executor = QueueExecutor(self.queue_name, self.pool, dispatch=dispatch, engine=engine, store=self.store)
+        result = {
+            'store': self.store, 'mode': self.mode, 'pool': self.pool, 'workload': self.workload,
+            'command': self.command, 'commands': self.commands, 'latency_samples': self.latency_samples,
+        }
+        try:
+            # Throughput
+            start = monotonic()
+            executor.enqueue_many(self.tagged(i) for i in range(self.commands))
+            enqueue_time = monotonic() - start
+
+            launched = monotonic()
+            self.start_daemon()
+            records = self.wait_completed(executor, self.commands)
+            drain_time = monotonic() - launched
+
+            busy = max(record['finished_at'] for record in records) - min(record['started_at'] for record in records)
+            run_time = sum(record['wall_time'] for record in records)
+            result.update(
+                enqueue_rate=self.commands / enqueue_time if enqueue_time else None,
+                drain_time=drain_time,
+                busy_time=busy,
+                commands_per_sec=self.commands / busy if busy else None,
+                run_time=percentiles([record['wall_time'] for record in records]),
+                overhead_per_command=max(busy * self.pool - run_time, 0) / self.commands,
+                failures=sum(1 for record in records if not record['status']),
+            )
+
+            # Latency, against the idle daemon
+            enqueued_at = {}
+            for i in range(self.latency_samples):
+                command = self.tagged(f'latency {i}')
+                enqueued_at[command] = time()
+                executor.store.enqueue([command])
+                sleep(self.interval)
+            records = self.wait_completed(executor, self.commands + self.latency_samples)
+            result['dispatch_latency'] = percentiles([
+                record['started_at'] - enqueued_at[record['command']]
+                for record in records if record['command'] in enqueued_at
+            ])
+        finally:
+            self.stop_daemon(executor)
+            if not self.keep:
+                shutil.rmtree(self.queue_root, ignore_errors=True)
+        return result
+
+
+def run_benchmarks(pools=(1, 2, 4), stores=('files', 'sqlite'), modes=tuple(__MODES__), workloads=__WORKLOADS__,
+                   **kwargs):
+    """
+    Run the benchmark for every combination.
+    :param kwargs: Arguments of Benchmark
+    :return: Dictionary with the environment and the list of results
+    """
+    results = []
+    for store in stores:
+        for mode in modes:
+            for pool in pools:
+                for workload in workloads:
+                    log.info(f"Benchmarking {store} / {mode} / pool {pool} / {workload}.")
+                    result = Benchmark(store, mode, pool, workload, **kwargs).run()
+                    print_result(result)
+                    results.append(result)
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'version': git_version(),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'cpus': queue_executor.multiprocessing.cpu_count(),
+        'settings': kwargs,
+        'results': results,
+    }
+
+
+def _fmt(value, scale=1, digits=1):
+    return '-' if value is None else f'{value * scale:.{digits}f}'
+
+
+def print_result(result):
+    latency = result['dispatch_latency'] or {}
+    print(
+        f"{result['store']:<7} {result['mode']:<11} pool {result['pool']:<3} {result['workload']:<7} "
+        f"enqueue {_fmt(result['enqueue_rate'], digits=0):>8}/s  "
+        f"throughput {_fmt(result['commands_per_sec']):>7}/s  "
+        f"overhead {_fmt(result['overhead_per_command'], 1000):>7} ms  "
+        f"latency p50 {_fmt(latency.get('p50'), 1000):>7} ms  p99 {_fmt(latency.get('p99'), 1000):>7} ms  "
+        f"failures {result['failures']}"
+    )
+
+
+def compare(old, new):
+    """
+    Print the change of the main measures between two result files, matched on store, mode, pool and workload.
+    :param old: Results dictionary of the reference run
+    :param new: Results dictionary of the new run
+    """
+    def key(result):
+        return result['store'], result['mode'], result['pool'], result['workload']
+
+    measures = {
+        'enqueue_rate': lambda result: result['enqueue_rate'],
+        'commands_per_sec': lambda result: result['commands_per_sec'],
+        'overhead_per_command': lambda result: result['overhead_per_command'],
+        'latency_p50': lambda result: (result['dispatch_latency'] or {}).get('p50'),
+        'latency_p99': lambda result: (result['dispatch_latency'] or {}).get('p99'),
+    }
+    reference = {key(result): result for result in old['results']}
+    print(f"Comparing {old.get('version')} ({old.get('date')}) -> {new.get('version')} ({new.get('date')})")
+    for result in new['results']:
+        if key(result) not in reference:
+            continue
+        changes = []
+        for name, measure in measures.items():
+            before, after = measure(reference[key(result)]), measure(result)
+            if before and after is not None:
+                changes.append(f'{name} {(after - before) / before:+.1%}')
+        print(' '.join(str(part) for part in key(result)) + ': ' + ', '.join(changes))
+
+
+def get_args():
+    """
+    Get args when running with command line interface
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.version = '1.0.0'
+
+    arg_parser.add_argument('-p', '--pools', action='store', type=int, nargs='+', default=[1, 2, 4],
+                            help='Pool sizes to benchmark.')
+    arg_parser.add_argument('-s', '--stores', action='store', type=str, nargs='+', default=['files', 'sqlite'],
+                            choices=['files', 'sqlite'], help='Stores to benchmark.')
+    arg_parser.add_argument('-m', '--modes', action='store', type=str, nargs='+', default=list(__MODES__),
+                            choices=list(__MODES__), help='Dispatch modes to benchmark.')
+    arg_parser.add_argument('-w', '--workloads', action='store', type=str, nargs='+', default=list(__WORKLOADS__),
+                            choices=list(__WORKLOADS__), help='Workloads to benchmark.')
+    arg_parser.add_argument('-n', '--commands', action='store', type=int, default=200,
+                            help='Number of commands of the throughput run.')
+    arg_parser.add_argument('--latency-samples', action='store', type=int, default=50,
+                            help='Number of commands of the latency run.')
+    arg_parser.add_argument('--interval', action='store', type=float, default=0.02,
+                            help='Seconds between two commands of the latency run.')
+    arg_parser.add_argument('--sleep', action='store', type=float, default=0.1,
+                            help='Seconds slept by the sleep workload.')
+    arg_parser.add_argument('--cpu-loops', action='store', type=int, default=200000,
+                            help='Iterations of the cpu workload.')
+    arg_parser.add_argument('--output-bytes', action='store', type=int, default=1048576,
+                            help='Bytes printed by the output workload.')
+    arg_parser.add_argument('--timeout', action='store', type=float, default=600,
+                            help='Max seconds to wait for a run to complete.')
+    arg_parser.add_argument('--keep', action='store_true', help='Keep the benchmark queues.')
+    arg_parser.add_argument('-o', '--output', action='store', type=str, default=None,
+                            help='JSON file of the results, benchmarks/benchmark_<datetime>.json by default.')
+    arg_parser.add_argument('-c', '--compare', action='store', type=str, default=None,
+                            help='Result file to compare with.')
+    arg_parser.add_argument('--no-run', action='store_true',
+                            help='Only compare --compare with --output, without running the benchmark.')
+
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    output = Path(args.output) if args.output else __BENCHMARK_DIR__ / f'benchmark_{queue_executor.dt}.json'
+    if args.no_run:
+        if not args.compare or not args.output:
+            raise Exception("--no-run needs both --compare and --output")
+        compare(read_json(Path(args.compare)), read_json(output))
+        sys.exit(0)
+
+    results = run_benchmarks(
+        pools=args.pools, stores=args.stores, modes=args.modes, workloads=args.workloads,
+        commands=args.commands, latency_samples=args.latency_samples, interval=args.interval, timeout=args.timeout,
+        keep=args.keep, sleep_seconds=args.sleep, cpu_loops=args.cpu_loops, output_bytes=args.output_bytes,
+    )
+    save_json(output, data=results)
+    print(f"Results saved in {output}")
+
+    if args.compare:
+        compare(read_json(Path(args.compare)), results)
@@ -0,0 +1,447 @@
+# !/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Append-only completion log of the Queue executor.
+
+    Instead of one JSON file per finished command, completion records are appended as JSON lines to segment files:
+        queues/<queue_name>/completions/
+            segment-00000000.jsonl.gz   compacted segment
+            segment-00000000.idx        index of the segment: idx, completed_at, status, offset, length
+            segment-00000001.jsonl      active segment
+            segment-00000001.idx
+            manifest.json               idx/time range, count and failures of every closed segment
+            .lock                       flock guarding appends and rotations, holds the active segment
+
+    The active segment is rotated once it reaches `segment_bytes` or is older than `segment_seconds`, the closed
+    segment is then compressed (gzip, or zstd with the optional `zstandard` package). Lookups only open the segments
+    whose manifest range matches and read a single record through the index.
+
+    Usage:
+        $python3 -m src.executors.completion_log --queue <queue_name> --idx 42
+        $python3 -m src.executors.completion_log --queue <queue_name> --status failed --since 2024-01-01T00:00:00
+        $python3 -m src.executors.completion_log --queue <queue_name> --migrate   # old completed/*.json files
+"""
+
+import os
+import sys
+import json
+import gzip
+import fcntl
+import logging
+import argparse
+from time import time
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+__author__ = 'Mohammed Ataaur Rahaman'
+
+
+__SEGMENT_BYTES__ = 67108864
+__SEGMENT_SECONDS__ = 86400
+__COMPRESSIONS__ = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+log = logging.getLogger(__name__)
+
+
+def _open_compressed(path, mode, compression=None):
+    """
+    :param compression: None, 'gzip' or 'zstd', guessed from the extension of the path if None
+    """
+    if compression is None:
+        compression = {'.gz': 'gzip', '.zst': 'zstd'}.get(os.path.splitext(path)[1])
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise Exception(f"Reading {path} needs the zstandard package")
+        if 'w' in mode:
+            return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+        return zstandard.ZstdDecompressor().stream_reader(open(path, mode))
+    return open(path, mode)
+
+
+class CompletionLog:
+
+    def __init__(self, root, segment_bytes=__SEGMENT_BYTES__, segment_seconds=__SEGMENT_SECONDS__,
+                 compression='gzip'):
+        """
+        :param root: Directory of the log, queues/<queue_name>/completions
+        :param segment_bytes: Size at which the active segment is rotated
+        :param segment_seconds: Age at which the active segment is rotated, None to only rotate on size
+        :param compression: None, 'gzip' or 'zstd', compression of the closed segments
+        """
+        if compression not in __COMPRESSIONS__:
+            raise Exception(f"Unknown compression: {compression}")
+        if compression == 'zstd' and zstandard is None:
+            raise Exception("zstd compression needs the zstandard package")
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.compression = compression
+        self.lock_file = root / '.lock'
+        self.manifest_file = root / 'manifest.json'
+        self._indexes = {}  # segment number -> (bytes of its index read, {idx: latest entry})
+
+    def segment_path(self, number):
+        return self.root / f'segment-{number:08d}.jsonl'
+
+    def index_path(self, number):
+        return self.root / f'segment-{number:08d}.idx'
+
+    def _locked(self):
+        """
+        :return: Lock file opened and locked, holding '<active segment> <created at>'
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        lock = os.fdopen(fd, 'r+')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _active(self, lock):
+        """
+        :return: Number of the active segment and its creation time, None if it has no record yet
+        """
+        lock.seek(0)
+        content = lock.read().split()
+        if len(content) == 2:
+            return int(content[0]), float(content[1])
+        # New log, or a lock file left empty by a crash in _set_active(): the newest open segment is the active one.
+        segments = self.segments()
+        if not segments:
+            return 0, None
+        number = segments[-1]
+        if str(number) in self.manifest():
+            return number + 1, None
+        entries = self._read_index(number, limit=1)
+        if not entries:
+            return number, None
+        self._set_active(lock, number, entries[0][1])
+        return number, entries[0][1]
+
+    @staticmethod
+    def _set_active(lock, number, created):
+        lock.seek(0)
+        lock.truncate()
+        lock.write(f'{number} {created}')
+        lock.flush()
+
+    def append(self, idx, record, status=None, completed_at=None):
+        """
+        Append the completion record of a command, safe to call from many processes at once.
+        :param idx: Index of the command
+        :param record: JSON serializable dictionary
+        :param status: Status indexed along the record, record['status'] if None
+        :param completed_at: Timestamp of the completion, now if None
+        """
+        # Rounded as in the index, so filters on a record's timestamp match it.
+        completed_at = round(time() if completed_at is None else completed_at, 6)
+        status = record.get('status') if status is None else status
+        line = (json.dumps({'idx': idx, 'completed_at': completed_at, **record}, ensure_ascii=False) + '\n')
+        data = line.encode('utf-8')
+
+        closed = None
+        lock = self._locked()
+        try:
+            number, created = self._active(lock)
+            segment = self.segment_path(number)
+            size = segment.stat().st_size if segment.exists() else 0
+            if size and (size + len(data) > self.segment_bytes or
+                         (self.segment_seconds is not None and created is not None and
+                          completed_at - created >= self.segment_seconds)):
+                self._close_segment(number)
+                closed, number, size = number, number + 1, 0
+                segment = self.segment_path(number)
+            if not size or created is None:
+                self._set_active(lock, number, completed_at)
+
+            with open(segment, 'ab') as f:
+                f.write(data)
+            with open(self.index_path(number), 'a') as f:
+                f.write(f'{idx}\t{completed_at:.6f}\t{1 if status else 0}\t{size}\t{len(data)}\n')
+        finally:
+            lock.close()
+
+        if closed is not None and self.compression:
+            self.compact_segment(closed)
+
+    @staticmethod
+    def _parse_index_line(line):
+        idx, completed_at, status, offset, length = line.split('\t')
+        return int(idx), float(completed_at), status == '1', int(offset), int(length)
+
+    def _read_index(self, number, limit=None):
+        """
+        :param limit: Max entries read, all of them if None
+        :return: List of (idx, completed_at, status, offset, length) of a segment
+        """
+        entries = []
+        try:
+            with open(self.index_path(number), 'r') as f:
+                for line in f:
+                    if limit is not None and len(entries) >= limit:
+                        break
+                    entries.append(self._parse_index_line(line))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _index_by_idx(self, number):
+        """
+        Index of a segment by command idx, kept in memory. Index files are append-only: only the lines added since
+        the last call are read.
+        :return: Dictionary of idx -> latest (idx, completed_at, status, offset, length) of the segment
+        """
+        read, by_idx = self._indexes.get(number, (0, {}))
+        try:
+            with open(self.index_path(number), 'rb') as f:
+                if os.fstat(f.fileno()).st_size < read:
+                    read, by_idx = 0, {}  # Log recreated
+                f.seek(read)
+                data = f.read()
+        except FileNotFoundError:
+            self._indexes.pop(number, None)
+            return {}
+        # A line being appended by another process is left for the next call.
+        data = data[:data.rfind(b'\n') + 1]
+        for line in data.decode('utf-8').splitlines():
+            entry = self._parse_index_line(line)
+            by_idx[entry[0]] = entry
+        self._indexes[number] = (read + len(data), by_idx)
+        return by_idx
+
+    def _close_segment(self, number):
+        """
+        Add a closed segment to the manifest, called with the lock held.
+        """
+        entries = self._read_index(number)
+        if not entries:
+            return
+        manifest = self.manifest()
+        manifest[str(number)] = {
+            'first_idx': min(entry[0] for entry in entries),
+            'last_idx': max(entry[0] for entry in entries),
+            'first_ts': min(entry[1] for entry in entries),
+            'last_ts': max(entry[1] for entry in entries),
+            'count': len(entries),
+            'failed': sum(1 for entry in entries if not entry[2]),
+        }
+        tmp_path = f'{self.manifest_file}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_file)
+
+    def manifest(self):
+        """
+        :return: Dictionary of segment number (str) -> summary of the closed segments
+        """
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def segments(self):
+        """
+        :return: Sorted list of the segment numbers
+        """
+        if not self.root.exists():
+            return []
+        return sorted(int(name[8:16]) for name in os.listdir(self.root) if name.endswith('.idx'))
+
+    def _segment_file(self, number):
+        """
+        :return: Path of the data of a segment, compressed or not
+        """
+        plain = str(self.segment_path(number))
+        for suffix in ('', '.gz', '.zst'):
+            if os.path.exists(plain + suffix):
+                return plain + suffix
+        raise Exception(f"Segment {number} is missing in {self.root}")
+
+    def compact_segment(self, number):
+        """
+        Compress a closed segment, the plain file is removed once the compressed one is complete.
+        """
+        plain = self.segment_path(number)
+        target = f'{plain}{__COMPRESSIONS__[self.compression]}'
+        tmp_path = f'{target}.tmp'
+        try:
+            with open(plain, 'rb') as src, _open_compressed(tmp_path, 'wb', self.compression) as dst:
+                while True:
+                    chunk = src.read(1048576)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+        except FileNotFoundError:
+            return  # Compacted by another process
+        os.replace(tmp_path, target)
+        plain.unlink()
+        log.info(f"Compacted completion segment {number} to {target}.")
+
+    def compact(self):
+        """
+        Compress every closed segment that isn't yet.
+        :return: Number of compressed segments
+        """
+        if not self.compression:
+            return 0
+        count = 0
+        for number in self.manifest():
+            if self.segment_path(int(number)).exists():
+                self.compact_segment(int(number))
+                count += 1
+        return count
+
+    def _open_segment(self, number):
+        try:
+            path = self._segment_file(number)
+            return path, _open_compressed(path, 'rb')
+        except FileNotFoundError:
+            # Compacted in between, open the compressed file.
+            path = self._segment_file(number)
+            return path, _open_compressed(path, 'rb')
+
+    def _read(self, number, entries):
+        """
+        Read the records of some index entries of a segment, in file order.
+        """
+        path, f = self._open_segment(number)
+        with f:
+            position = 0
+            for entry in sorted(entries, key=lambda entry: entry[3]):
+                offset, length = entry[3], entry[4]
+                if path.endswith('.jsonl'):
+                    f.seek(offset)
+                else:
+                    # Compressed streams only seek forward, by decompressing.
+                    while position < offset:
+                        position += len(f.read(min(offset - position, 1048576)))
+                yield json.loads(f.read(length))
+                position = offset + length
+
+    def _candidates(self, idx=None, since=None, until=None):
+        """
+        :return: Segment numbers that can hold matching records, closed ones are pruned with the manifest
+        """
+        manifest = self.manifest()
+        for number in self.segments():
+            summary = manifest.get(str(number))
+            if summary is None:
+                yield number  # Active segment
+                continue
+            if idx is not None and not summary['first_idx'] <= idx <= summary['last_idx']:
+                continue
+            if since is not None and summary['last_ts'] < since:
+                continue
+            if until is not None and summary['first_ts'] > until:
+                continue
+            yield number
+
+    def get(self, idx):
+        """
+        :return: Latest completion record of a command, None if it isn't in the log
+        """
+        for number in reversed(list(self._candidates(idx=idx))):
+            entry = self._index_by_idx(number).get(idx)
+            if entry is not None:
+                return list(self._read(number, [entry]))[0]
+        return None
+
+    def query(self, status=None, since=None, until=None):
+        """
+        Iterate over the completion records, oldest first.
+        :param status: True or False to only get the successful or failed commands, None for all of them
+        :param since: Only records completed at or after this timestamp
+        :param until: Only records completed at or before this timestamp
+        """
+        for number in self._candidates(since=since, until=until):
+            entries = [
+                entry for entry in self._read_index(number)
+                if (status is None or entry[2] == status)
+                and (since is None or entry[1] >= since)
+                and (until is None or entry[1] <= until)
+            ]
+            if entries:
+                yield from self._read(number, entries)
+
+    def count(self, status=None):
+        """
+        :return: Number of records in the log, only the successful or failed ones if status is given
+        """
+        total = 0
+        manifest = self.manifest()
+        for number in self.segments():
+            summary = manifest.get(str(number))
+            if summary is None:
+                total += sum(1 for entry in self._read_index(number) if status is None or entry[2] == status)
+            elif status is None:
+                total += summary['count']
+            else:
+                total += summary['failed'] if not status else summary['count'] - summary['failed']
+        return total
+
+    def migrate(self, completed_dir):
+        """
+        Move the records of the one-file-per-command layout (`<datetime>_<idx>_completed.json`) into the log.
+        :return: Number of migrated records
+        """
+        count = 0
+        for path in sorted(completed_dir.glob('*_completed.json')):
+            dt, idx, _ = path.name.split('_')
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+            completed_at = datetime.strptime(dt, '%Y%m%d%H%M%S').timestamp()
+            self.append(int(idx), record, completed_at=completed_at)
+            path.unlink()
+            count += 1
+        return count
+
+
+def get_args():
+    """
+    Get args when running with command line interface
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.version = '1.0.0'
+
+    arg_parser.add_argument('-q', '--queue', action='store', type=str, required=True, help='Name of the Queue.')
+    arg_parser.add_argument('-i', '--idx', action='store', type=int, default=None, help='Index of a command.')
+    arg_parser.add_argument('-s', '--status', action='store', type=str, default=None, choices=['ok', 'failed'],
+                            help='Only the successful or failed commands.')
+    arg_parser.add_argument('--since', action='store', type=datetime.fromisoformat, default=None,
+                            help='Only the commands completed since this ISO datetime.')
+    arg_parser.add_argument('--until', action='store', type=datetime.fromisoformat, default=None,
+                            help='Only the commands completed until this ISO datetime.')
+    arg_parser.add_argument('--migrate', action='store_true', help='Move the completed/*.json files into the log.')
+    arg_parser.add_argument('--compact', action='store_true', help='Compress the closed segments.')
+
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    from src.executors.queue_executor import QueueExecutor
+
+    args = get_args()
+    completion_log = QueueExecutor(args.queue).get_completion_log()
+
+    if args.migrate:
+        print(f"Migrated {completion_log.migrate(completion_log.root.parent / 'completed')} records.")
+    if args.compact:
+        print(f"Compacted {completion_log.compact()} segments.")
+    if args.idx is not None:
+        print(json.dumps(completion_log.get(args.idx), ensure_ascii=False))
+    elif not (args.migrate or args.compact):
+        records = completion_log.query(
+            status=None if args.status is None else args.status == 'ok',
+            since=args.since.timestamp() if args.since else None,
+            until=args.until.timestamp() if args.until else None,
+        )
+        for record in records:
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + '\n')
@@ -0,0 +1,312 @@
+# !/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Flows: dependency-aware pipelines of commands run on top of a Queue executor.
+
+    A flow is a DAG of named nodes, each node is a command that runs once all the nodes it depends on succeeded:
+        flow = Flow('nightly', queue='my_queue')
+        flow.add('extract', 'python3 -m src.extract')
+        flow.add('clean', 'python3 -m src.clean', depends_on=['extract'])
+        flow.add('features', 'python3 -m src.features', depends_on=['extract'])
+        flow.add('train', 'python3 -m src.train', depends_on=['clean', 'features'], timeout=3600)
+        statuses = flow.run()
+
+    Or from a JSON file ({"name": .., "queue": .., "nodes": {"<node>": {"command": .., "depends_on": [..]}}}):
+        $python3 -m src.executors.dag --file nightly.json
+
+    The flow only enqueues: a daemon must be running on the queue (see src.executors.queue_executor).
+    Ready nodes are enqueued together, so independent branches run in parallel and the wall time of the flow is
+    its critical path. Nodes on the longest remaining path get a higher priority, so they are dispatched first when
+    the pool is full. When a node fails (after its retries), its descendants are pruned and the other branches
+    keep running.
+
+    The state of a flow is kept in `queues/<queue_name>/flows/<flow_name>.json`. A new run reuses the nodes that
+    succeeded with the same command, as long as none of their ancestors runs again, and waits for the nodes still
+    queued by an interrupted run instead of enqueuing them twice. `force` reruns nodes and their descendants.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import argparse
+from time import time
+from collections import deque
+from src.executors.queue_executor import QueueExecutor, __QUEUE_DIR__, __COMMAND_OPTIONS__
+from src.executors.queue_watcher import get_watcher
+from src.utils.json_util import read_json
+
+
+__author__ = 'Mohammed Ataaur Rahaman'
+
+
+__PENDING__ = 'pending'
+__QUEUED__ = 'queued'
+__OK__ = 'ok'
+__FAILED__ = 'failed'
+__PRUNED__ = 'pruned'
+__NODE_OPTIONS__ = ('priority', 'lane') + __COMMAND_OPTIONS__
+# Seconds between two checks of the queued nodes when no completion wakes the flow up
+__FLOW_POLL__ = 5
+
+log = logging.getLogger(__name__)
+
+
+def command_hash(cmd):
+    return hashlib.sha1(cmd.encode('utf-8')).hexdigest()
+
+
+class Flow:
+
+    def __init__(self, name, queue, store='files', wakeup='auto', critical_path=True):
+        """
+        :param name: Name of the flow, its state is kept across runs under this name
+        :param queue: Name of the queue running the commands
+        :param store: Store of the queue, as used by its daemon
+        :param wakeup: How to wait for completions: 'inotify', 'poll' or 'auto'
+        :param critical_path: Prioritize the nodes on the longest remaining path, else keep the node priorities
+        """
+        self.name = name
+        self.wakeup = wakeup
+        self.critical_path = critical_path
+        self.executor = QueueExecutor(queue, store=store)
+        self.state_file = __QUEUE_DIR__ / queue / 'flows' / f'{name}.json'
+        self.nodes = {}  # name -> {'command', 'depends_on', 'options'}
+
+    def add(self, name, command, depends_on=(), **options):
+        """
+        :param name: Unique name of the node
+        :param command: String cmd
+        :param depends_on: Names of the nodes that must succeed before this one runs
+        :param options: priority, lane, limits and retry policy of the command (see QueueExecutor.enqueue)
+        :return: The flow, to chain the calls
+        """
+        if name in self.nodes:
+            raise Exception(f"Node {name} is already in flow {self.name}")
+        unknown = set(options) - set(__NODE_OPTIONS__)
+        if unknown:
+            raise Exception(f"Unknown node options: {sorted(unknown)}")
+        self.nodes[name] = {'command': command, 'depends_on': list(depends_on), 'options': options}
+        return self
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """
+        :param path: JSON file with the name and queue of the flow and its nodes
+        :param kwargs: Arguments of the Flow, override the file
+        """
+        spec = read_json(path)
+        flow = cls(**{'name': spec['name'], 'queue': spec['queue'], 'store': spec.get('store', 'files'), **kwargs})
+        for name, node in spec['nodes'].items():
+            node = dict(node)
+            flow.add(name, node.pop('command'), node.pop('depends_on', ()), **node)
+        return flow
+
+    def children(self):
+        children = {name: [] for name in self.nodes}
+        for name, node in self.nodes.items():
+            for parent in node['depends_on']:
+                if parent not in self.nodes:
+                    raise Exception(f"Node {name} depends on an unknown node: {parent}")
+                children[parent].append(name)
+        return children
+
+    def topological_order(self):
+        """
+        :return: Names of the nodes, every node after the nodes it depends on
+        """
+        children = self.children()
+        missing = {name: len(set(node['depends_on'])) for name, node in self.nodes.items()}
+        ready = deque(name for name, count in missing.items() if not count)
+        order = []
+        while ready:
+            name = ready.popleft()
+            order.append(name)
+            for child in children[name]:
+                missing[child] -= 1
+                if not missing[child]:
+                    ready.append(child)
+        if len(order) != len(self.nodes):
+            raise Exception(f"Flow {self.name} has a cycle between: {sorted(set(self.nodes) - set(order))}")
+        return order
+
+    def descendants(self, names):
+        children = self.children()
+        found = set()
+        stack = list(names)
+        while stack:
+            for child in children[stack.pop()]:
+                if child not in found:
+                    found.add(child)
+                    stack.append(child)
+        return found
+
+    def critical_priorities(self, order, state):
+        """
+        Length of the longest path from each node to the end of the flow, in seconds of the last known wall
+        times (1 for the nodes that never ran).
+        """
+        children = self.children()
+        remaining = {}
+        for name in reversed(order):
+            duration = state.get(name, {}).get('wall_time') or 1
+            remaining[name] = duration + max((remaining[child] for child in children[name]), default=0)
+        return {name: int(round(length)) for name, length in remaining.items()}
+
+    def load_state(self):
+        return read_json(self.state_file).get('nodes', {}) if self.state_file.exists() else {}
+
+    def save_state(self, state):
+        # Written aside then renamed, an interrupted flow never leaves a partial state behind.
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f'{self.state_file}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'name': self.name, 'updated_at': time(), 'nodes': state}, f, indent=4)
+        os.replace(tmp_path, self.state_file)
+
+    def plan(self, order, state, force=()):
+        """
+        Decide what to do with every node at the start of a run.
+        :return: Dictionary of name -> __OK__ (reused), __QUEUED__ (still queued by a previous run) or __PENDING__
+        """
+        rerun = set(force) | self.descendants(force)
+        plan = {}
+        for name in order:
+            node, previous = self.nodes[name], state.get(name, {})
+            same = previous.get('hash') == command_hash(node['command']) and name not in rerun
+            parents_reused = all(plan[parent] == __OK__ for parent in node['depends_on'])
+            if same and parents_reused and previous.get('status') == __OK__:
+                plan[name] = __OK__
+            elif same and previous.get('status') == __QUEUED__ and previous.get('idx') is not None:
+                plan[name] = __QUEUED__
+            else:
+                plan[name] = __PENDING__
+        return plan
+
+    def run(self, force=(), timeout=None):
+        """
+        Run the flow until every node succeeded, failed or was pruned.
+        :param force: Names of nodes to run again even if they succeeded, along with their descendants
+        :param timeout: Max seconds to wait for the flow, None to wait until it ends
+        :return: Dictionary of node name -> __OK__, __FAILED__, __PRUNED__ (or __PENDING__, __QUEUED__ on timeout)
+        """
+        order = self.topological_order()
+        unknown = set(force) - set(self.nodes)
+        if unknown:
+            raise Exception(f"Unknown nodes to force: {sorted(unknown)}")
+
+        state = {name: node for name, node in self.load_state().items() if name in self.nodes}
+        plan = self.plan(order, state, force)
+        priorities = self.critical_priorities(order, state) if self.critical_path else {}
+        for name, status in plan.items():
+            if status == __OK__:
+                log.info(f"Flow {self.name}: reusing node {name}, it succeeded with the same command.")
+            elif status == __PENDING__:
+                state[name] = {'status': __PENDING__, 'hash': command_hash(self.nodes[name]['command'])}
+        self.save_state(state)
+
+        for path in (self.executor.completions, self.executor.completed):
+            path.mkdir(parents=True, exist_ok=True)
+        watcher = get_watcher([self.executor.completions, self.executor.completed], mode=self.wakeup)
+        deadline = None if timeout is None else time() + timeout
+        started = time()
+        try:
+            while True:
+                self.dispatch(order, state, priorities)
+                queued = [name for name in order if state[name]['status'] == __QUEUED__]
+                if not queued:
+                    break
+                if deadline is not None and time() >= deadline:
+                    log.warning(f"Flow {self.name}: timed out with {len(queued)} nodes still queued.")
+                    break
+                wait = __FLOW_POLL__ if deadline is None else min(__FLOW_POLL__, max(deadline - time(), 0))
+                watcher.wait(wait)
+                self.collect(queued, state)
+        finally:
+            watcher.close()
+
+        statuses = {name: state[name]['status'] for name in order}
+        counts = {status: list(statuses.values()).count(status) for status in set(statuses.values())}
+        log.info(f"Flow {self.name}: finished in {time() - started:.1f}s, {counts}")
+        return statuses
+
+    def dispatch(self, order, state, priorities):
+        """
+        Prune the descendants of failed nodes and enqueue the nodes whose parents all succeeded.
+        """
+        ready = []
+        for name in order:
+            if state[name]['status'] != __PENDING__:
+                continue
+            parents = [state[parent]['status'] for parent in self.nodes[name]['depends_on']]
+            if any(status in (__FAILED__, __PRUNED__) for status in parents):
+                log.info(f"Flow {self.name}: pruning node {name}, a node it depends on failed.")
+                state[name]['status'] = __PRUNED__
+            elif all(status == __OK__ for status in parents):
+                ready.append(name)
+
+        for name in ready:
+            node = self.nodes[name]
+            options = dict(node['options'])
+            if 'priority' not in options and name in priorities:
+                options['priority'] = priorities[name]
+            idx = self.executor.enqueue([node['command']], **options)[0]
+            state[name].update(status=__QUEUED__, idx=idx, queued_at=time())
+            log.info(f"Flow {self.name}: enqueued node {name} as command {idx}.")
+        if ready or any(state[name]['status'] == __PRUNED__ for name in order):
+            self.save_state(state)
+
+    def collect(self, queued, state):
+        """
+        Update the queued nodes from their completion records. A record is final unless the command was
+        interrupted or scheduled for a retry.
+        """
+        changed = False
+        for name in queued:
+            record = self.executor.get_result(state[name]['idx'])
+            if not record or record.get('interrupted') or record.get('retry_at') is not None:
+                continue
+            status = __OK__ if record['status'] else __FAILED__
+            state[name].update(status=status, wall_time=record.get('wall_time'), finished_at=time())
+            log.info(f"Flow {self.name}: node {name} {'succeeded' if record['status'] else 'failed'}.")
+            changed = True
+        if changed:
+            self.save_state(state)
+
+    def status(self):
+        """
+        :return: Dictionary of node name -> last known status, __PENDING__ for the nodes that never ran
+        """
+        state = self.load_state()
+        return {name: state.get(name, {}).get('status', __PENDING__) for name in self.nodes}
+
+
+def get_args():
+    """
+    Get args when running with command line interface
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.version = '1.0.0'
+
+    arg_parser.add_argument('-f', '--file', action='store', type=str, required=True, help='JSON file of the flow.')
+    arg_parser.add_argument('--force', action='store', type=str, nargs='*', default=[],
+                            help='Run these nodes and their descendants again.')
+    arg_parser.add_argument('-t', '--timeout', action='store', type=float, default=None,
+                            help='Max seconds to wait for the flow.')
+    arg_parser.add_argument('--no-critical-path', action='store_true',
+                            help='Keep the node priorities instead of prioritizing the longest path.')
+    arg_parser.add_argument('--status', action='store_true', help='Only print the last known status of the nodes.')
+
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    flow = Flow.from_file(args.file, critical_path=not args.no_critical_path)
+    statuses = flow.status() if args.status else flow.run(force=args.force, timeout=args.timeout)
+    for node_name, node_status in statuses.items():
+        print(f'{node_name}\t{node_status}')
+    if not args.status and any(node_status != __OK__ for node_status in statuses.values()):
+        raise SystemExit(1)
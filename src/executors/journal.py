@@ -0,0 +1,189 @@
+# !/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Per-command state journal of the Queue executor, used to recover in-flight work after a crash.
+
+    Every process running commands (pool workers, or the daemon itself with the asyncio engine) appends the state
+    transitions of its commands to its own file, `queues/<queue_name>/journal/<worker_id>/<pid>.log`, one JSON
+    line per transition:
+        started - the command is about to run (command, attempt, worker pid and its start time)
+        running - the command runs in the process group `pgid` (and its start time)
+        done    - the command was recorded, then dequeued or scheduled for a retry
+    A single writer per file means no locking, a write is one small append. Files of processes that are gone and
+    only hold finished commands are removed by compact(), a process rewrites its own file when it grows too big.
+
+    On start, the daemon reconciles the last state of every command with the completion log and the queue
+    (see QueueExecutor.recover()) and clears the journal.
+"""
+
+import os
+import json
+import logging
+from time import time
+
+
+__author__ = 'Mohammed Ataaur Rahaman'
+
+
+__STARTED__ = 'started'
+__RUNNING__ = 'running'
+__DONE__ = 'done'
+__MAX_JOURNAL_BYTES__ = 1048576
+
+log = logging.getLogger(__name__)
+
+
+def process_start_time(pid):
+    """
+    :return: Start time of a process in clock ticks since boot (Linux), None if it doesn't exist or is unknown.
+             Tells a live process from a new one that reused its pid.
+    """
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            # The command name (field 2) may hold spaces, the fields after it are fixed.
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def pid_alive(pid, start_time=None):
+    """
+    :param start_time: process_start_time() recorded for the pid, None to not check it
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return start_time is None or process_start_time(pid) in (None, start_time)
+
+
+class Journal:
+
+    def __init__(self, root, max_bytes=__MAX_JOURNAL_BYTES__):
+        """
+        :param root: Directory of the journal of one worker, queues/<queue_name>/journal/<worker_id>
+        :param max_bytes: Size at which a process compacts its own file
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self._fd = None
+        self._pid = None
+
+    def __getstate__(self):
+        # Every process writes its own file.
+        state = self.__dict__.copy()
+        state.update(_fd=None, _pid=None)
+        return state
+
+    def path(self, pid=None):
+        return self.root / f'{pid or os.getpid()}.log'
+
+    def _open(self):
+        if self._fd is None or self._pid != os.getpid():
+            self.root.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(self.path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    def write(self, idx, state, **info):
+        """
+        Append a state transition of a command.
+        :param idx: Index of the command
+        :param state: __STARTED__, __RUNNING__ or __DONE__
+        :param info: Details of the transition (attempt, pids..)
+        """
+        fd = self._open()
+        os.write(fd, (json.dumps([time(), idx, state, info]) + '\n').encode('utf-8'))
+        if state == __DONE__ and os.fstat(fd).st_size > self.max_bytes:
+            self._compact_file(self.path(), own=True)
+
+    def started(self, idx, cmd, attempt=1):
+        pid = os.getpid()
+        self.write(idx, __STARTED__, command=cmd, attempt=attempt, pid=pid, pid_start=process_start_time(pid))
+
+    def running(self, idx, pgid):
+        self.write(idx, __RUNNING__, pgid=pgid, pgid_start=process_start_time(pgid))
+
+    def done(self, idx):
+        self.write(idx, __DONE__)
+
+    @staticmethod
+    def _read(path):
+        entries = []
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        pass  # Last line cut by a crash
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _files(self):
+        if not self.root.exists():
+            return []
+        return [self.root / name for name in os.listdir(self.root) if name.endswith('.log')]
+
+    @staticmethod
+    def _last_states(entries):
+        """
+        :return: Dictionary of idx -> (state, info merged over the transitions of its last attempt, timestamp)
+        """
+        states = {}
+        for ts, idx, state, info in sorted(entries, key=lambda entry: entry[0]):
+            if state == __STARTED__:
+                states[idx] = (state, dict(info), ts)
+            else:
+                _, previous, started_at = states.get(idx, (None, {}, ts))
+                states[idx] = (state, {**previous, **info}, started_at)
+        return states
+
+    def states(self):
+        """
+        :return: Dictionary of idx -> (last state, info, timestamp of the start) over every file of the journal
+        """
+        entries = []
+        for path in self._files():
+            entries += self._read(path)
+        return self._last_states(entries)
+
+    def _compact_file(self, path, own=False):
+        """
+        Drop the finished commands of a file, remove it if nothing is left.
+        """
+        pending = [
+            [ts, idx, state, info] for idx, (state, info, ts) in self._last_states(self._read(path)).items()
+            if state != __DONE__
+        ]
+        if own and self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if not pending:
+            path.unlink()
+            return
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in pending:
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, path)
+
+    def compact(self):
+        """
+        Clean up the files of processes that are gone (e.g. the workers of a finished batch).
+        """
+        for path in self._files():
+            pid = int(path.name[:-4])
+            if pid != os.getpid() and not pid_alive(pid):
+                self._compact_file(path)
+
+    def clear(self):
+        for path in self._files():
+            path.unlink()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
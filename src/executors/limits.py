@@ -0,0 +1,185 @@
+# !/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Resource limits, timeouts and accounting of the commands run by the Queue executor.
+
+    Every command runs in its own session (process group) so a timeout can kill the whole tree:
+    SIGTERM first, SIGKILL if it is still alive `grace` seconds later.
+    RLIMIT_AS / RLIMIT_CPU are set by the command's shell with ulimit before it runs the command, and the resource
+    usage of the command itself (not of every child of the worker) is read with os.wait4.
+"""
+
+import os
+import signal
+import asyncio
+import selectors
+from time import monotonic, sleep
+from src.executors.output_capture import __CHUNK_SIZE__
+
+
+__author__ = 'Mohammed Ataaur Rahaman'
+
+
+__REAP_INTERVAL__ = 0.05
+
+
+def limit_command(cmd, rlimit_as=None, rlimit_cpu=None):
+    """
+    Prefix a shell command with the ulimit calls applying the resource limits.
+    The shell sets them on itself before running the command, so they are in place before anything of the
+    command starts, without a preexec_fn (not safe in a process running threads, as the daemon does).
+    :param cmd: Shell command
+    :param rlimit_as: Max address space in bytes (rounded down to KiB)
+    :param rlimit_cpu: Max CPU time in seconds, SIGXCPU at the limit and SIGKILL a second later
+    :return: Shell command, exiting with 126 without running cmd if a limit cannot be set
+    """
+    ulimits = []
+    if rlimit_as is not None:
+        ulimits.append(f'ulimit -v {rlimit_as // 1024}')
+    if rlimit_cpu is not None:
+        # Hard limit first, the soft one cannot be above it.
+        ulimits.append(f'ulimit -t {rlimit_cpu + 1} && ulimit -S -t {rlimit_cpu}')
+    if not ulimits:
+        return cmd
+    return ' && '.join(ulimits) + ' || exit 126\n' + cmd
+
+
+def exit_code(wait_status):
+    """
+    Same as os.waitstatus_to_exitcode (python 3.9+): negative signal number if the process was killed.
+    """
+    if os.WIFSIGNALED(wait_status):
+        return -os.WTERMSIG(wait_status)
+    return os.WEXITSTATUS(wait_status)
+
+
+def rusage_to_dict(rusage):
+    if rusage is None:
+        return None
+    return {
+        'user_time': rusage.ru_utime,
+        'sys_time': rusage.ru_stime,
+        'max_rss_kb': rusage.ru_maxrss,
+        'in_blocks': rusage.ru_inblock,
+        'out_blocks': rusage.ru_oublock,
+    }
+
+
+def kill_group(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class Deadline:
+    """
+    Wall-clock timeout with kill escalation: SIGTERM when it expires, SIGKILL after the grace period.
+    """
+
+    def __init__(self, pid, timeout=None, grace=5):
+        self.pid = pid
+        self.grace = grace
+        self.expires = None if timeout is None else monotonic() + timeout
+        self.timed_out = False
+        self.killed = False
+
+    def remaining(self):
+        return None if self.expires is None else max(self.expires - monotonic(), 0)
+
+    def check(self):
+        """
+        Escalate if the deadline expired.
+        :return: False once SIGKILL was sent and the grace period is over as well
+        """
+        if self.expires is None or monotonic() < self.expires:
+            return True
+        if not self.timed_out:
+            self.timed_out = True
+            kill_group(self.pid, signal.SIGTERM)
+            self.expires = monotonic() + self.grace
+            return True
+        if not self.killed:
+            self.killed = True
+            kill_group(self.pid, signal.SIGKILL)
+            self.expires = monotonic() + self.grace
+            return True
+        return False
+
+
+def supervise(process, out_capture, err_capture, timeout=None, grace=5):
+    """
+    Stream the outputs of a Popen process into their captures, enforce the timeout and reap it with os.wait4.
+    :param process: Popen started with stdout=PIPE, stderr=PIPE and start_new_session=True
+    :param timeout: Wall-clock timeout in seconds, None for no timeout
+    :param grace: Seconds between SIGTERM and SIGKILL
+    :return: (returncode, timed_out, rusage dictionary)
+    """
+    deadline = Deadline(process.pid, timeout, grace)
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ, out_capture)
+        selector.register(process.stderr, selectors.EVENT_READ, err_capture)
+        while selector.get_map():
+            for key, _ in selector.select(deadline.remaining()):
+                chunk = os.read(key.fd, __CHUNK_SIZE__)
+                if chunk:
+                    key.data.write(chunk)
+                else:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+            if not deadline.check():
+                # Pipes still held open by processes that left the group, stop reading.
+                for key in list(selector.get_map().values()):
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+
+    # Outputs are closed but the command may still be running (e.g. a daemonized child kept it alive).
+    while deadline.expires is not None:
+        pid, wait_status, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if not deadline.check():
+            pid, wait_status, rusage = os.wait4(process.pid, 0)
+            break
+        sleep(__REAP_INTERVAL__)
+    else:
+        pid, wait_status, rusage = os.wait4(process.pid, 0)
+
+    process.returncode = exit_code(wait_status)
+    return process.returncode, deadline.timed_out, rusage_to_dict(rusage)
+
+
+async def supervise_async(process, out_capture, err_capture, timeout=None, grace=5):
+    """
+    Same as supervise for an asyncio subprocess.
+    asyncio reaps its children itself, so there is no per-command rusage with this engine.
+    :return: (returncode, timed_out, None)
+    """
+    async def pump(stream, capture):
+        while True:
+            chunk = await stream.read(__CHUNK_SIZE__)
+            if not chunk:
+                break
+            capture.write(chunk)
+
+    done = asyncio.ensure_future(
+        asyncio.gather(pump(process.stdout, out_capture), pump(process.stderr, err_capture), process.wait())
+    )
+    timed_out = False
+    for sig in (None, signal.SIGTERM, signal.SIGKILL):
+        if sig is not None:
+            timed_out = True
+            kill_group(process.pid, sig)
+        try:
+            await asyncio.wait_for(asyncio.shield(done), timeout if sig is None else grace)
+            break
+        except asyncio.TimeoutError:
+            continue
+    else:
+        # Pipes still held open by processes that left the group, stop reading.
+        done.cancel()
+        await process.wait()
+
+    return process.returncode, timed_out, None
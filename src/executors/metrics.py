@@ -0,0 +1,301 @@
+# !/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Metrics of the Queue executor daemon.
+
+    The daemon records, for its queue:
+        * queue depth, commands in flight and pool size (gauges)
+        * wait time (enqueue to start) and run time of the commands (histograms)
+        * completions, failures, timeouts, retries and dead letters (counters, plus per-second rates over the
+          last minute)
+        * time spent reading the queue and writing completion records (histograms)
+
+    They are exposed in the Prometheus text format on `http://<metrics_host>:<metrics_port>/metrics` and/or
+    as JSON in `queues/<queue_name>/metrics.json`, rewritten every `metrics_interval` seconds.
+"""
+
+import os
+import json
+import logging
+import threading
+from time import time, monotonic
+from collections import deque
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+__author__ = 'Mohammed Ataaur Rahaman'
+
+
+__PREFIX__ = 'queue_executor'
+__BUCKETS__ = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800, 3600)
+__RATE_WINDOW__ = 60
+
+log = logging.getLogger(__name__)
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, as Prometheus expects it.
+    """
+
+    def __init__(self, buckets=__BUCKETS__):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+        }
+
+
+class Metrics:
+    """
+    Thread safe: updated by the dispatch loop and the pool callbacks, read by the exporters.
+    """
+
+    gauges = {
+        'queue_depth': 'Commands waiting in the queue, the ones in flight left out.',
+        'in_flight': 'Commands dispatched and not finished yet.',
+        'pool_size': 'Max commands in flight.',
+        'completions_per_second': f'Commands finished per second over the last {__RATE_WINDOW__}s.',
+        'failures_per_second': f'Commands failed per second over the last {__RATE_WINDOW__}s.',
+    }
+    counters = {
+        'dispatched_total': 'Commands dispatched.',
+        'completed_total': 'Commands finished, successful or not.',
+        'failed_total': 'Commands finished with a failed status.',
+        'timed_out_total': 'Commands killed by their timeout.',
+        'retried_total': 'Failed commands scheduled for a retry.',
+        'dead_lettered_total': 'Commands sent to the dead letters after their last attempt.',
+    }
+    histograms = {
+        'wait_seconds': 'Time between the enqueue and the start of a command.',
+        'run_seconds': 'Wall time of a command.',
+        'read_queue_seconds': 'Time spent reading/claiming the queue.',
+        'mark_as_completed_seconds': 'Time spent writing a completion record.',
+    }
+
+    def __init__(self, queue_name, depth=None, pool_size=None):
+        """
+        :param queue_name: Label of every metric
+        :param depth: Function returning the queue depth, called when the metrics are exported
+        :param pool_size: Function returning the pool size, called when the metrics are exported
+        """
+        self.queue_name = queue_name
+        self.depth = depth
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.started = time()
+        self.values = {name: 0 for name in self.counters}
+        self.timings = {name: Histogram() for name in self.histograms}
+        self.running = {}  # idx -> enqueued_at
+        self.recent = deque()  # (finished at, status) of the last __RATE_WINDOW__ seconds
+
+    @contextmanager
+    def timer(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start)
+
+    def observe(self, name, value):
+        with self.lock:
+            self.timings[name].observe(value)
+
+    def dispatched(self, idx, enqueued_at=None):
+        with self.lock:
+            self.values['dispatched_total'] += 1
+            self.running[idx] = enqueued_at
+
+    def in_flight_indices(self):
+        with self.lock:
+            return set(self.running)
+
+    def finished(self, idx, result=None):
+        """
+        :param idx: Index of the command
+        :param result: Dictionary returned by execute_command, None if the worker failed before returning it
+        """
+        now = time()
+        with self.lock:
+            enqueued_at = self.running.pop(idx, None)
+            result = result if isinstance(result, dict) else {}
+            status = result.get('status', False)
+
+            self.values['completed_total'] += 1
+            if not status:
+                self.values['failed_total'] += 1
+            if result.get('timed_out'):
+                self.values['timed_out_total'] += 1
+            if result.get('retried'):
+                self.values['retried_total'] += 1
+            if result.get('dead_lettered'):
+                self.values['dead_lettered_total'] += 1
+            if enqueued_at is not None and result.get('started_at') is not None:
+                self.timings['wait_seconds'].observe(max(result['started_at'] - enqueued_at, 0))
+            if result.get('wall_time') is not None:
+                self.timings['run_seconds'].observe(result['wall_time'])
+            if result.get('record_time') is not None:
+                self.timings['mark_as_completed_seconds'].observe(result['record_time'])
+
+            self.recent.append((now, status))
+            self._expire(now)
+
+    def _expire(self, now):
+        while self.recent and self.recent[0][0] < now - __RATE_WINDOW__:
+            self.recent.popleft()
+
+    def _call(self, function):
+        if function is None:
+            return None
+        try:
+            return function()
+        except Exception as err:
+            log.warning(f"Failed to collect a metric: {err}")
+            return None
+
+    def snapshot(self):
+        """
+        :return: Dictionary of every metric
+        """
+        depth = self._call(self.depth)
+        pool_size = self._call(self.pool_size)
+        now = time()
+        with self.lock:
+            self._expire(now)
+            window = min(__RATE_WINDOW__, max(now - self.started, 1))
+            return {
+                'queue': self.queue_name,
+                'timestamp': now,
+                'uptime': now - self.started,
+                'queue_depth': depth,
+                'in_flight': len(self.running),
+                'pool_size': pool_size,
+                'completions_per_second': len(self.recent) / window,
+                'failures_per_second': sum(1 for _, status in self.recent if not status) / window,
+                **self.values,
+                **{name: histogram.to_dict() for name, histogram in self.timings.items()},
+            }
+
+    def render(self):
+        """
+        :return: Metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        label = f'queue="{self.queue_name}"'
+        lines = []
+        for kind, metrics in (('gauge', self.gauges), ('counter', self.counters)):
+            for name, description in metrics.items():
+                if snapshot[name] is None:
+                    continue
+                lines += [
+                    f'# HELP {__PREFIX__}_{name} {description}',
+                    f'# TYPE {__PREFIX__}_{name} {kind}',
+                    f'{__PREFIX__}_{name}{{{label}}} {snapshot[name]}',
+                ]
+        for name, description in self.histograms.items():
+            histogram = snapshot[name]
+            lines += [f'# HELP {__PREFIX__}_{name} {description}', f'# TYPE {__PREFIX__}_{name} histogram']
+            lines += [
+                f'{__PREFIX__}_{name}_bucket{{{label},le="{bound}"}} {count}'
+                for bound, count in histogram['buckets'].items()
+            ]
+            lines += [
+                f'{__PREFIX__}_{name}_bucket{{{label},le="+Inf"}} {histogram["count"]}',
+                f'{__PREFIX__}_{name}_sum{{{label}}} {histogram["sum"]}',
+                f'{__PREFIX__}_{name}_count{{{label}}} {histogram["count"]}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    """
+    Background exporters of a Metrics: HTTP /metrics endpoint and/or JSON stats file.
+    """
+
+    def __init__(self, metrics, port=None, host='127.0.0.1', stats_file=None, interval=10):
+        """
+        :param metrics: Metrics to export
+        :param port: Port of the HTTP endpoint, None to disable it
+        :param host: Interface of the HTTP endpoint
+        :param stats_file: Path of the JSON stats file, None to disable it
+        :param interval: Seconds between two rewrites of the stats file
+        """
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self.stats_file = stats_file
+        self.interval = interval
+        self.server = None
+        self.stop_event = threading.Event()
+
+    def start(self):
+        if self.port is not None:
+            metrics = self.metrics
+
+            class Handler(BaseHTTPRequestHandler):
+
+                def do_GET(self):
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = metrics.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    log.debug(f"Metrics request: {format % args}")
+
+            self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            log.info(f"Serving metrics on http://{self.host}:{self.server.server_port}/metrics")
+
+        if self.stats_file is not None:
+            threading.Thread(target=self._write_stats, daemon=True).start()
+            log.info(f"Writing metrics to {self.stats_file} every {self.interval}s.")
+
+    def _write_stats(self):
+        while True:
+            try:
+                self.write_stats()
+            except Exception as err:
+                log.warning(f"Failed to write metrics: {err}")
+            if self.stop_event.wait(self.interval):
+                return
+
+    def write_stats(self):
+        # Written aside then renamed, readers never see a partial file.
+        tmp_path = f'{self.stats_file}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.metrics.snapshot(), f, indent=4)
+        os.replace(tmp_path, self.stats_file)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.stats_file is not None:
+            try:
+                self.write_stats()
+            except Exception as err:
+                log.warning(f"Failed to write metrics: {err}")
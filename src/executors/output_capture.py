@@ -0,0 +1,125 @@
+# !/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Streaming capture of the stdout/stderr of queued commands.
+
+    Only the first `head_bytes` and the last `tail_bytes` of a stream are kept in memory, so a worker uses the same
+    memory whatever the command prints. Once a stream outgrows head + tail, everything is streamed to a rotating
+    log file (`<log_path>`, `<log_path>.1`, ...) and the completion record only gets the head and the tail.
+"""
+
+import os
+import logging
+
+
+__author__ = 'Mohammed Ataaur Rahaman'
+
+
+__CHUNK_SIZE__ = 65536
+
+log = logging.getLogger(__name__)
+
+
+class OutputCapture:
+
+    def __init__(self, log_path=None, head_bytes=32768, tail_bytes=32768, max_log_bytes=10485760, log_backups=2):
+        """
+        :param log_path: Path of the log file, None to only keep head and tail
+        :param head_bytes: Number of bytes kept from the start of the stream
+        :param tail_bytes: Number of bytes kept from the end of the stream
+        :param max_log_bytes: Size at which the log file is rotated
+        :param log_backups: Number of rotated log files kept
+        """
+        self.log_path = log_path
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.max_log_bytes = max_log_bytes
+        self.log_backups = log_backups
+
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+        self.log_file = None
+        self.log_size = 0
+
+    @property
+    def truncated(self):
+        return self.total > self.head_bytes + self.tail_bytes
+
+    def write(self, chunk):
+        """
+        Feed a chunk of bytes read from the stream.
+        """
+        if not chunk:
+            return
+        self.total += len(chunk)
+
+        if len(self.head) < self.head_bytes:
+            missing = self.head_bytes - len(self.head)
+            self.head += chunk[:missing]
+            chunk = chunk[missing:]
+
+        if self.log_file is None and self.truncated and self.log_path is not None:
+            # First overflow: the buffers still hold everything seen so far, start the log file with them.
+            self._open_log()
+            self._log(bytes(self.head) + bytes(self.tail))
+        if self.log_file is not None:
+            self._log(chunk)
+
+        self.tail += chunk
+        if len(self.tail) > 2 * self.tail_bytes:
+            del self.tail[:len(self.tail) - self.tail_bytes]
+
+    def _open_log(self):
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        self.log_file = open(self.log_path, 'wb')
+        self.log_size = 0
+
+    def _rotate(self):
+        self.log_file.close()
+        for i in range(self.log_backups - 1, 0, -1):
+            src = f'{self.log_path}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.log_path}.{i + 1}')
+        if self.log_backups > 0:
+            os.replace(self.log_path, f'{self.log_path}.1')
+        self._open_log()
+
+    def _log(self, data):
+        while data:
+            if self.log_size >= self.max_log_bytes:
+                self._rotate()
+            part = data[:self.max_log_bytes - self.log_size]
+            self.log_file.write(part)
+            self.log_size += len(part)
+            data = data[len(part):]
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+
+    def text(self):
+        """
+        :return: Captured output as a string, with a marker where the middle of the stream was dropped.
+        """
+        tail = bytes(self.tail[-self.tail_bytes:]) if self.tail_bytes else b''
+        if not self.truncated:
+            return (bytes(self.head) + bytes(self.tail)).decode('utf-8', errors='replace')
+        dropped = self.total - len(self.head) - len(tail)
+        return (
+            bytes(self.head).decode('utf-8', errors='replace')
+            + f'\n... [{dropped} bytes truncated] ...\n'
+            + tail.decode('utf-8', errors='replace')
+        )
+
+    def summary(self, name):
+        """
+        Metadata of the stream for the completion record.
+        :param name: 'output' or 'error'
+        """
+        return {
+            f'{name}_bytes': self.total,
+            f'{name}_truncated': self.truncated,
+            f'{name}_log': str(self.log_path) if self.log_file is not None else None,
+        }
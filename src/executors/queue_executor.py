@@ -14,18 +14,94 @@
         2. Enqueue commands from your other script:
             my_queue = QueueExecutor('my_queue')
             my_queue.enqueue(['python3 -m src.my_script'])
+
+            Large or generated workloads can be streamed, safe to call from many producers at once:
+            my_queue.enqueue_many(f'python3 -m src.my_script --part {i}' for i in range(1000000))
+
+            Commands go to a lane ('default') with a priority (0, higher runs first):
+            my_queue.enqueue(['python3 -m src.report'], priority=10, lane='interactive')
+
+            Commands can get a wall-clock timeout (SIGTERM, then SIGKILL after `kill_grace` seconds) and
+            RLIMIT_AS (bytes) / RLIMIT_CPU (seconds) limits, the queue settings hold the defaults:
+            my_queue.enqueue(['python3 -m src.train'], timeout=3600, rlimit_as=8 * 1024 ** 3)
+
+            A command fails on a non-zero exit code or a timeout. Failed commands can be retried with an exponential
+            backoff (see src.executors.retry), commands that failed for good go to `dead_letter/`:
+            my_queue.enqueue(['python3 -m src.fetch'], max_attempts=5, retry_on=[75], retry_backoff=10)
+            my_queue.requeue_dead_letters()
+
+        The daemon wakes up on new commands using inotify (`--wakeup inotify`) and falls back to adaptive
+        polling (`--wakeup poll`) where inotify isn't available. inotify only sees the changes made on its own host,
+        so `--wakeup auto` polls with `--leases`, where other hosts may share the queues directory.
+
+        By default the queue is run in batches, one pool per snapshot of the queue. With `--dispatch continuous`
+        a single pool lives as long as the daemon and a new command starts as soon as any slot frees up.
+
+        With `--engine asyncio` the commands are run as asyncio subprocesses supervised by the daemon itself,
+        `--pool` then caps the number of commands in flight instead of the number of worker processes.
+
+        Commands are stored one file per command by default, `--store sqlite` keeps them in a single
+        WAL-backed sqlite table instead (see src.executors.queue_store). Producers must use the same store.
+
+        Several daemons (on one host, or on several hosts sharing the queues directory) can drain the same queue
+        with `--leases`: each one claims commands under its `--worker-id` and keeps a heartbeat, commands of a daemon
+        silent for `lease_ttl` seconds are put back in the queue by the others. Every heartbeat (lease_ttl / 3)
+        also rescans the queue, for the changes no watcher reports (e.g. NFS attribute caching). The default worker id,
+        <hostname>-<n>, is the lowest n not held by another daemon of the host on the queue: a restarted daemon
+        gets its id back and with it its journal and the commands it had claimed.
+
+        Per-queue settings live in `queues/<queue_name>/settings.json` (see __DEFAULT_SETTINGS__):
+            my_queue.save_settings(output_head_bytes=1024, output_tail_bytes=4096)
+            my_queue.save_settings(scheduling='weighted', lane_weights={'interactive': 4}, lane_caps={'bulk': 2})
+        Completion records are appended to a segmented JSON lines log in `queues/<queue_name>/completions/`,
+        query them with my_queue.get_result(idx) / my_queue.results(status=False) or
+        `python3 -m src.executors.completion_log` (see src.executors.completion_log).
+        Outputs are streamed, only their head and tail end up in the completion record and the rest goes to
+        rotating log files, one per attempt, in `queues/<queue_name>/logs/<idx>.<attempt>.out|err`. The record also
+        holds the return code, wall time and the resource usage of the command (user/sys time, max RSS, block I/O).
+
+        Queue depth, commands in flight, wait/run times and completion rates are rewritten every
+        `metrics_interval` seconds to `queues/<queue_name>/metrics.json`, and served in the Prometheus format
+        with `--metrics-port <port>` (see src.executors.metrics).
+
+        Every command's state (started, running, done) is appended to a journal in `queues/<queue_name>/journal/`
+        (see src.executors.journal). After a crash, the daemon reconciles it with the completion log on start:
+        commands that completed are not run again, commands that were interrupted are recorded as such and rerun.
+
+        Commands that depend on each other can be run as a flow (a DAG of commands) on top of the queue,
+        see src.executors.dag.
+
+        Throughput and latency of the daemon can be measured with src.executors.benchmark.
 """
 
+import os
+import fcntl
+import signal
+import socket
 import logging
 import argparse
+import asyncio
+import threading
+from time import monotonic, time
+from functools import partial
+from itertools import count
+from contextlib import contextmanager
+from collections import Counter, deque
 from src.utils.setup_logger import setup_logger
-from time import sleep
 import multiprocessing
 from subprocess import Popen, PIPE
 from datetime import datetime
 from configs.conf import __WORKSPACE__
-from src.utils.file_handlers import save_file, read_file
 from src.utils.json_util import save_json, read_json
+from src.executors.queue_watcher import get_watcher
+from src.executors.queue_store import get_store, __ENQUEUE_BLOCK__
+from src.executors.output_capture import OutputCapture
+from src.executors.limits import limit_command, supervise, supervise_async, kill_group
+from src.executors.scheduler import LaneScheduler, __DEFAULT_LANE__
+from src.executors.metrics import Metrics, MetricsExporter
+from src.executors.completion_log import CompletionLog
+from src.executors.retry import RetryPolicy, __RETRY__
+from src.executors.journal import Journal, pid_alive, __DONE__
 
 
 __author__ = 'Mohammed Ataaur Rahaman'
@@ -35,6 +111,60 @@ __QUEUE_DIR__ = __WORKSPACE__ / 'queues'
 __QUEUE_NAME__ = 'Ataa_queue'
 __POOL__ = 2
 
+__DEFAULT_SETTINGS__ = {
+    # Bytes of stdout/stderr kept in the completion record
+    'output_head_bytes': 32768,
+    'output_tail_bytes': 32768,
+    # Stream outputs larger than head + tail to rotating log files
+    'output_logs': True,
+    'output_log_max_bytes': 10485760,
+    'output_log_backups': 2,
+    # 'priority' (strict priority across lanes) or 'weighted' (weighted round-robin across lanes)
+    'scheduling': 'priority',
+    # lane -> weight for the weighted scheduling, lanes not listed get 1
+    'lane_weights': {},
+    # lane -> max commands of the lane in flight
+    'lane_caps': {},
+    # Default wall-clock timeout of a command in seconds (None: no timeout)
+    'timeout': None,
+    # Seconds between SIGTERM and SIGKILL when a command times out
+    'kill_grace': 5,
+    # Default RLIMIT_AS (bytes) and RLIMIT_CPU (seconds) of a command (None: unlimited)
+    'rlimit_as': None,
+    'rlimit_cpu': None,
+    # Seconds without heartbeat after which the commands claimed by a daemon are reclaimed (with --leases)
+    'lease_ttl': 60,
+    # Rewrite queues/<queue_name>/metrics.json every metrics_interval seconds
+    'metrics_file': True,
+    'metrics_interval': 10,
+    # Serve Prometheus metrics on http://<metrics_host>:<metrics_port>/metrics (None: disabled)
+    'metrics_port': None,
+    'metrics_host': '127.0.0.1',
+    # 'log' (append-only JSON lines in completions/) or 'files' (one JSON file per command in completed/)
+    'completion_store': 'log',
+    # Size and age (seconds, None: no limit) at which the completion log segment is rotated
+    'completion_segment_bytes': 67108864,
+    'completion_segment_seconds': 86400,
+    # Compression of the closed completion log segments: None, 'gzip' or 'zstd' (zstandard package)
+    'completion_compression': 'gzip',
+    # A command fails on a non-zero exit code or a timeout, and also when it writes to stderr with fail_on_stderr
+    'fail_on_stderr': False,
+    # Runs of a failed command (1: no retry), exit codes to retry (None: any failure) and backoff in seconds
+    'max_attempts': 1,
+    'retry_on': None,
+    'retry_backoff': 1,
+    'retry_backoff_max': 300,
+    # Random part of the backoff delay, 0 (none) to 1 (full jitter)
+    'retry_jitter': 0.5,
+    # Keep the commands that failed for good in queues/<queue_name>/dead_letter/
+    'dead_letter': True,
+}
+
+# Limits that can be set per command, the settings hold their defaults
+__LIMITS__ = ('timeout', 'rlimit_as', 'rlimit_cpu')
+# Every option that can be set per command
+__COMMAND_OPTIONS__ = __LIMITS__ + __RETRY__
+
 
 dt = datetime.now().strftime("%Y%m%d%H%M%S")
 setup_logger(
@@ -48,46 +178,221 @@ log = logging.getLogger(__name__)
 
 class QueueExecutor:
 
-    def __init__(self, queue_name, pool=None):
+    def __init__(self, queue_name, pool=None, wakeup='auto', dispatch='batch', engine='process', store='files',
+                 leases=False, worker_id=None, metrics_port=None):
+        self.wakeup = wakeup
+        self.dispatch = dispatch
+        self.engine = engine
         self.queue = __QUEUE_DIR__ / queue_name / 'queue'
         self.completed = __QUEUE_DIR__ / queue_name / 'completed'
-        self.latest_pool = __QUEUE_DIR__ / queue_name / 'latest_pool.json'
+        self.completions = __QUEUE_DIR__ / queue_name / 'completions'
+        self.dead_letter = __QUEUE_DIR__ / queue_name / 'dead_letter'
+        self.logs = __QUEUE_DIR__ / queue_name / 'logs'
+        self.metrics_file = __QUEUE_DIR__ / queue_name / 'metrics.json'
+        self.metrics_port = metrics_port
 
         self.pool_file = __QUEUE_DIR__ / queue_name / 'pool_size.json'
         if pool:
             self.save_pool(pool)
 
+        self.settings_file = __QUEUE_DIR__ / queue_name / 'settings.json'
+        self.settings = self.get_settings()
+        self.completion_log = self.get_completion_log()
+
+        self._worker_lock = None
+        self.worker_id = (worker_id or self.take_worker_id(__QUEUE_DIR__ / queue_name)) if leases else None
+        self.journal = Journal(__QUEUE_DIR__ / queue_name / 'journal' / (self.worker_id or 'local'))
+        self.store = get_store(
+            __QUEUE_DIR__ / queue_name, store=store, worker_id=self.worker_id, lease_ttl=self.settings['lease_ttl']
+        )
+        self.metrics = Metrics(queue_name, depth=self.queue_depth, pool_size=self.get_pool_size)
+
+    def __getstate__(self):
+        # Pool workers get a copy of the executor, the metrics stay in the daemon.
+        state = self.__dict__.copy()
+        state['metrics'] = None
+        state['_worker_lock'] = None
+        return state
+
+    def take_worker_id(self, queue_root):
+        """
+        Default worker id of a daemon with leases, <hostname>-<n> with the lowest n not taken by a running daemon
+        of the host. The id is held by a lock on queues/<queue_name>/workers/<worker_id>.lock until the daemon exits.
+        It is a POSIX record lock (lockf): unlike flock, the forked pool workers don't inherit it, so workers
+        orphaned by a killed daemon don't keep its id from the restarted one.
+        :return: Worker id
+        """
+        workers = queue_root / 'workers'
+        workers.mkdir(parents=True, exist_ok=True)
+        host = socket.gethostname()
+        for n in count():
+            worker_id = f'{host}-{n}'
+            lock = open(workers / f'{worker_id}.lock', 'a')
+            try:
+                fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (BlockingIOError, PermissionError):
+                lock.close()
+                continue
+            self._worker_lock = lock
+            return worker_id
+
     def save_pool(self, pool):
         save_json(self.pool_file, data={"pool":pool})
 
+    def queue_depth(self):
+        """
+        :return: Number of commands waiting in the queue, the ones this daemon runs are counted as in flight
+        """
+        return self.store.depth(exclude=self.metrics.in_flight_indices())
+
     def get_pool_size(self):
         return read_json(self.pool_file)['pool']
 
+    def save_settings(self, **settings):
+        """
+        Update the settings of the queue, a running daemon picks them up on restart.
+        :param settings: Keys of __DEFAULT_SETTINGS__
+        """
+        unknown = set(settings) - set(__DEFAULT_SETTINGS__)
+        if unknown:
+            raise Exception(f"Unknown queue settings: {sorted(unknown)}")
+        saved = read_json(self.settings_file) if self.settings_file.exists() else {}
+        saved.update(settings)
+        save_json(self.settings_file, data=saved)
+        self.settings = self.get_settings()
+
+    def get_settings(self):
+        settings = dict(__DEFAULT_SETTINGS__)
+        if self.settings_file.exists():
+            settings.update(read_json(self.settings_file))
+        return settings
+
+    def get_completion_log(self):
+        return CompletionLog(
+            self.completions,
+            segment_bytes=self.settings['completion_segment_bytes'],
+            segment_seconds=self.settings['completion_segment_seconds'],
+            compression=self.settings['completion_compression'],
+        )
+
+    def get_scheduler(self):
+        return LaneScheduler(
+            policy=self.settings['scheduling'],
+            weights=self.settings['lane_weights'],
+            caps=self.settings['lane_caps'],
+        )
+
+    def get_limits(self, meta=None):
+        """
+        :param meta: Metadata of the command
+        :return: Dictionary of the limits of a command, falling back to the queue settings
+        """
+        meta = meta or {}
+        return {name: meta.get(name, self.settings[name]) for name in __LIMITS__}
+
+    def get_retry_policy(self, meta=None):
+        """
+        :param meta: Metadata of the command
+        :return: RetryPolicy of a command, falling back to the queue settings
+        """
+        meta = meta or {}
+        return RetryPolicy(
+            max_attempts=meta.get('max_attempts', self.settings['max_attempts']),
+            retry_on=meta.get('retry_on', self.settings['retry_on']),
+            backoff=meta.get('retry_backoff', self.settings['retry_backoff']),
+            backoff_max=self.settings['retry_backoff_max'],
+            jitter=self.settings['retry_jitter'],
+        )
+
+    def new_capture(self, idx, stream, attempt=1):
+        """
+        Create the OutputCapture of one stream of a command.
+        :param idx: integer Index
+        :param stream: 'out' or 'err'
+        :param attempt: Attempt of the command, every attempt logs to files of its own
+        """
+        return OutputCapture(
+            log_path=self.logs / f'{idx}.{attempt}.{stream}' if self.settings['output_logs'] else None,
+            head_bytes=self.settings['output_head_bytes'],
+            tail_bytes=self.settings['output_tail_bytes'],
+            max_log_bytes=self.settings['output_log_max_bytes'],
+            log_backups=self.settings['output_log_backups'],
+        )
+
     def read_queue(self):
-        files = list(self.queue.glob('*'))
-        files = [int(file.name) for file in files if files]
-        return sorted(files) if files else None
-
-    def enqueue(self, commands):
-        queue = self.read_queue()
-        idx = -1 if not queue else queue[-1]
-        for command in commands:
-            idx += 1
-            save_file(file_path=self.queue / str(idx), content=command)
+        return self.store.pending()
+
+    @staticmethod
+    def command_meta(priority=0, lane=__DEFAULT_LANE__, **options):
+        """
+        Metadata stored along a command, only the values that differ from the defaults.
+        :param options: Limits (timeout, rlimit_as, rlimit_cpu) and retry policy (max_attempts, retry_on,
+                        retry_backoff) of the command
+        """
+        meta = {}
+        if priority:
+            meta['priority'] = priority
+        if lane != __DEFAULT_LANE__:
+            meta['lane'] = lane
+        unknown = set(options) - set(__COMMAND_OPTIONS__)
+        if unknown:
+            raise Exception(f"Unknown command options: {sorted(unknown)}")
+        meta.update({name: value for name, value in options.items() if value is not None})
+        return meta
+
+    def enqueue(self, commands, priority=0, lane=__DEFAULT_LANE__, **options):
+        """
+        :param commands: List of command strings
+        :param priority: Higher priorities run first
+        :param lane: Lane of the commands, see the 'scheduling' setting
+        :param options: Limits and retry policy of the commands (see command_meta), the queue settings if not given
+        :return: List of the indices of the commands
+        """
+        indices = self.store.enqueue(commands, meta=self.command_meta(priority, lane, **options))
         log.info(f"Enqueued {len(commands)} commands.")
         log.debug(f"Enqueued commands: {commands}")
+        return indices
+
+    def enqueue_many(self, commands, block_size=__ENQUEUE_BLOCK__, priority=0, lane=__DEFAULT_LANE__, **options):
+        """
+        Enqueue commands from any iterable without loading all of them in memory.
+        :param commands: Iterable of command strings, e.g. a generator
+        :param block_size: Number of indices reserved and written at a time
+        :param priority: Higher priorities run first
+        :param lane: Lane of the commands, see the 'scheduling' setting
+        :param options: Limits and retry policy of the commands (see command_meta), the queue settings if not given
+        :return: Number of enqueued commands
+        """
+        meta = self.command_meta(priority, lane, **options)
+        count = self.store.enqueue_many(commands, block_size=block_size, meta=meta)
+        log.info(f"Enqueued {count} commands.")
+        return count
+
+    def claim(self, limit=None, exclude=(), running=None):
+        """
+        Claim the next commands to run with the scheduler of the daemon and count them as in flight.
+        :return: List of (idx, cmd, meta)
+        """
+        with self.metrics.timer('read_queue_seconds'):
+            commands = self.store.claim(limit=limit, exclude=exclude, scheduler=self.scheduler, running=running)
+        for idx, _, _ in commands:
+            self.metrics.dispatched(idx, self.store.enqueued_at(idx))
+        return commands
+
+    def command_done(self, idx, result=None):
+        """
+        Pool/task callback of a finished command.
+        :param result: Dictionary returned by execute_command, or the exception raised by it
+        """
+        if isinstance(result, Exception):
+            log.error(f"Command {idx} failed in its worker: {result}")
+        self.metrics.finished(idx, result)
 
     def dequeue(self, queue):
-        for idx in queue:
-            path = self.queue / str(idx)
-            path.unlink()
+        self.store.dequeue(queue)
         log.info(f"Dequeued {len(queue)} commands.")
 
-    def mark_in_process(self, commands, queue):
-        content = {idx:cmd for idx, cmd in zip(queue, commands)}
-        save_json(file_path=self.latest_pool, data=content)
-
-    def mark_as_completed(self, idx, cmd, status, output=None, err=None):
+    def mark_as_completed(self, idx, cmd, status, output=None, err=None, details=None):
         """
         Save the metadata for a cmd in an JSON file
         :param idx: Integer index of the command
@@ -95,6 +400,7 @@ class QueueExecutor:
         :param output:String Output (if Any)
         :param err: String Error (if any)
         :param status: Boolean Status
+        :param details: Dictionary of extra metadata (output sizes, log files..)
         """
         try:
             content = {
@@ -103,66 +409,537 @@ class QueueExecutor:
                 'output': output if output != '' else None,
                 'error': err if err != '' else None
             }
-            save_json(
-                file_path=self.completed / '{}_{}_completed.json'.format(datetime.now().strftime("%Y%m%d%H%M%S"), idx),
-                data=content
-            )
+            content.update(details or {})
+            if self.settings['completion_store'] == 'log':
+                self.completion_log.append(idx, content)
+            else:
+                save_json(
+                    file_path=self.completed / '{}_{}_completed.json'.format(
+                        datetime.now().strftime("%Y%m%d%H%M%S"), idx
+                    ),
+                    data=content
+                )
 
         except Exception as err:
             log.warning(f'Error in storing status of cmd {cmd}: {err}')
             log.info(f'Command Status: {cmd}')
 
-    def execute_command(self, idx, cmd):
+    def get_result(self, idx):
         """
-        A simple python function to run a command
+        :param idx: Index of the command
+        :return: Latest completion record of the command, None if it didn't complete yet
+        """
+        record = self.completion_log.get(idx)
+        if record is None and self.completed.exists():
+            files = sorted(self.completed.glob(f'*_{idx}_completed.json'))
+            if files:
+                record = {'idx': idx, **read_json(files[-1])}
+        return record
+
+    def results(self, status=None, since=None, until=None):
+        """
+        Iterate over the completion records, from completed/ files first then from the completion log.
+        :param status: True or False to only get the successful or failed commands, None for all of them
+        :param since: Only records completed at or after this timestamp
+        :param until: Only records completed at or before this timestamp
+        """
+        if self.completed.exists():
+            for path in sorted(self.completed.glob('*_completed.json')):
+                dt, idx, _ = path.name.split('_')
+                completed_at = datetime.strptime(dt, "%Y%m%d%H%M%S").timestamp()
+                if (since is not None and completed_at < since) or (until is not None and completed_at > until):
+                    continue
+                record = read_json(path)
+                if status is None or record['status'] == status:
+                    yield {'idx': int(idx), 'completed_at': completed_at, **record}
+        yield from self.completion_log.query(status=status, since=since, until=until)
+
+    def count_results(self):
+        """
+        :return: Number of completion records
+        """
+        files = len(list(self.completed.glob('*_completed.json'))) if self.completed.exists() else 0
+        return files + self.completion_log.count()
+
+    @contextmanager
+    def command_run(self, idx, cmd, meta=None):
+        """
+        Steps of a command run shared by execute_command and execute_command_async. The block spawns and
+        supervises the command, which is then recorded and retried or removed from the queue:
+            with self.command_run(idx, cmd, meta) as run:
+                process = Popen(...)  # under run['limits']
+                self.journal.running(idx, process.pid)
+                run['result'] = supervise(process, run['out'], run['err'], ...)  # (returncode, timed_out, rusage)
+            return run['outcome']
+        Errors in the block are logged and the command counts as failed.
         :param idx: integer Index
         :param cmd: command string
-        :return: (idx, cmd, Status, Output String, Error String)
+        :param meta: Metadata of the command (limits..)
+        :return: Dictionary of the limits and the output captures of the command, its 'outcome' (status, timings
+                 and timeout for the metrics) is set once the block is done
         """
+        attempt = (meta or {}).get('attempt', 1)
+        run = {
+            'limits': self.get_limits(meta),
+            'out': self.new_capture(idx, 'out', attempt),
+            'err': self.new_capture(idx, 'err', attempt),
+        }
         status = False
-        output_str = ''
-        error_str = ''
+        details = {'returncode': None, 'timed_out': False, 'rusage': None, 'started_at': time()}
+        start = monotonic()
         try:
             log.info(f'Running command {idx}: {cmd}')
-            cmd_out, cmd_err = Popen(
-                cmd, stdout=PIPE, stderr=PIPE, shell=True
-            ).communicate()
+            self.journal.started(idx, cmd, attempt)
+            yield run
+            returncode, timed_out, rusage = run['result']
+            details.update(returncode=returncode, timed_out=timed_out, rusage=rusage)
+            if timed_out:
+                log.warning(f"Command {idx} timed out after {run['limits']['timeout']}s: {cmd}")
 
-            error_str = cmd_err.decode("utf-8")
-            output_str = cmd_out.decode("utf-8")
-            status = True if error_str == '' else False
+            status = self.command_status(returncode, timed_out, run['err'])
 
         except Exception as err:
             log.error(f'Command failed: {err}')
 
         finally:
             log.info(f"Command executed {idx}: {cmd}")
-            self.mark_as_completed(idx=idx, cmd=cmd, status=status, output=output_str, err=error_str)
+            details.update(wall_time=monotonic() - start, finished_at=time())
+            outcome = self.finish_command(idx, cmd, status, run['out'], run['err'], details, meta)
+            run['outcome'] = {
+                'status': status, 'timed_out': details['timed_out'], 'started_at': details['started_at'],
+                'wall_time': details['wall_time'], **outcome,
+            }
+
+    def execute_command(self, idx, cmd, meta=None):
+        """
+        A simple python function to run a command
+        :param idx: integer Index
+        :param cmd: command string
+        :param meta: Metadata of the command (limits..)
+        :return: Dictionary of the status, timings and timeout of the command for the metrics
+        """
+        with self.command_run(idx, cmd, meta) as run:
+            limits = run['limits']
+            process = Popen(
+                limit_command(cmd, limits['rlimit_as'], limits['rlimit_cpu']),
+                stdout=PIPE, stderr=PIPE, shell=True, start_new_session=True
+            )
+            self.journal.running(idx, process.pid)
+            run['result'] = supervise(
+                process, run['out'], run['err'], timeout=limits['timeout'], grace=self.settings['kill_grace']
+            )
+        return run['outcome']
+
+    def command_status(self, returncode, timed_out, err_capture):
+        """
+        :return: True if the command succeeded
+        """
+        if timed_out or returncode != 0:
+            return False
+        return not (self.settings['fail_on_stderr'] and err_capture.total)
+
+    def finish_command(self, idx, cmd, status, out_capture, err_capture, details=None, meta=None):
+        """
+        Record the result of a command, then schedule its retry or remove it from the queue.
+        :return: Dictionary of the seconds spent in mark_as_completed, and whether the command was retried or
+                 sent to the dead letters
+        """
+        meta = meta or {}
+        attempt = meta.get('attempt', 1)
+        retry_at = None
+        if not status:
+            policy = self.get_retry_policy(meta)
+            if policy.should_retry(attempt, (details or {}).get('returncode'), (details or {}).get('timed_out')):
+                retry_at = time() + policy.delay(attempt)
+        dead_lettered = not status and retry_at is None and self.settings['dead_letter']
+
+        for capture in (out_capture, err_capture):
+            capture.close()
+        details = {
+            **(details or {}), **out_capture.summary('output'), **err_capture.summary('error'),
+            'attempt': attempt, 'retry_at': retry_at,
+        }
+        start = monotonic()
+        self.mark_as_completed(
+            idx=idx, cmd=cmd, status=status, output=out_capture.text(), err=err_capture.text(), details=details
+        )
+        record_time = monotonic() - start
+
+        if retry_at is not None:
+            log.info(f"Command {idx} failed on attempt {attempt}, retrying in {retry_at - time():.1f}s.")
+            self.store.retry(idx, {**meta, 'attempt': attempt + 1}, retry_at)
+        else:
+            if dead_lettered:
+                self.send_to_dead_letter(idx, cmd, meta, details, err_capture.text())
             self.dequeue([idx])
+        self.journal.done(idx)
+        return {'record_time': record_time, 'retried': retry_at is not None, 'dead_lettered': dead_lettered}
+
+    def send_to_dead_letter(self, idx, cmd, meta, details, err=None):
+        """
+        Keep a command that failed for good in dead_letter/<idx>.json, see requeue_dead_letters().
+        """
+        log.warning(f"Command {idx} failed after {details['attempt']} attempts, sent to the dead letters: {cmd}")
+        save_json(self.dead_letter / f'{idx}.json', data={
+            'idx': idx,
+            'command': cmd,
+            'meta': {name: value for name, value in meta.items() if name != 'attempt'},
+            'attempts': details['attempt'],
+            'returncode': details.get('returncode'),
+            'timed_out': details.get('timed_out'),
+            'error': err or None,
+            'failed_at': time(),
+        })
+
+    def dead_letters(self):
+        """
+        :return: List of the commands in the dead letters
+        """
+        if not self.dead_letter.exists():
+            return []
+        return [read_json(path) for path in sorted(self.dead_letter.glob('*.json'))]
+
+    def requeue_dead_letters(self, indices=None):
+        """
+        Enqueue the commands of the dead letters again (with new indices) and remove them from the dead letters.
+        :param indices: Indices of the commands to requeue, None for all of them
+        :return: Number of requeued commands
+        """
+        count = 0
+        for item in self.dead_letters():
+            if indices is not None and item['idx'] not in indices:
+                continue
+            self.store.enqueue([item['command']], meta=item['meta'])
+            (self.dead_letter / f"{item['idx']}.json").unlink()
+            count += 1
+        log.info(f"Requeued {count} commands from the dead letters.")
+        return count
+
+    async def execute_command_async(self, idx, cmd, meta=None):
+        """
+        Same as execute_command, but runs the command as an asyncio subprocess.
+        asyncio reaps the command itself, the record has no resource usage with this engine.
+        :param idx: integer Index
+        :param cmd: command string
+        :param meta: Metadata of the command (limits..)
+        :return: Dictionary of the status, timings and timeout of the command for the metrics
+        """
+        with self.command_run(idx, cmd, meta) as run:
+            limits = run['limits']
+            process = await asyncio.create_subprocess_shell(
+                limit_command(cmd, limits['rlimit_as'], limits['rlimit_cpu']),
+                stdout=PIPE, stderr=PIPE, start_new_session=True
+            )
+            self.journal.running(idx, process.pid)
+            run['result'] = await supervise_async(
+                process, run['out'], run['err'], timeout=limits['timeout'], grace=self.settings['kill_grace']
+            )
+        return run['outcome']
 
     def run(self):
         log.info(f"Starting Queue: {self.queue.parent.name}")
 
+        self.settings = self.get_settings()
+        self.scheduler = self.get_scheduler()
+        self.completion_log = self.get_completion_log()
+        self.store.lease_ttl = self.settings['lease_ttl']
+        self.recover()
+        self.store.recover()
+
+        # Watch before the first scan so commands enqueued while scanning still wake us up.
+        watch = self.store.watch_paths()
+        if self.pool_file.exists():
+            watch.append(self.pool_file)
+        wakeup = self.wakeup
+        if wakeup == 'auto' and self.store.leases:
+            # Other hosts sharing the queue directory enqueue and release commands unseen by inotify.
+            wakeup = 'poll'
+        watcher = get_watcher(watch, mode=wakeup)
+        log.info(f"Waiting for commands using {type(watcher).__name__}.")
+
+        stop_leases = threading.Event()
+        if self.store.leases:
+            log.info(f"Claiming commands with leases as worker {self.worker_id}.")
+            threading.Thread(target=self.keep_leases, args=(watcher, stop_leases), daemon=True).start()
+
+        exporter = MetricsExporter(
+            self.metrics,
+            port=self.metrics_port or self.settings['metrics_port'],
+            host=self.settings['metrics_host'],
+            stats_file=self.metrics_file if self.settings['metrics_file'] else None,
+            interval=self.settings['metrics_interval'],
+        )
+        exporter.start()
+
+        try:
+            if self.engine == 'asyncio':
+                asyncio.run(self.run_asyncio(watcher))
+            elif self.dispatch == 'continuous':
+                self.run_continuous(watcher)
+            else:
+                self.run_batches(watcher)
+        finally:
+            stop_leases.set()
+            exporter.stop()
+            watcher.close()
+
+    def recover(self):
+        """
+        Reconcile the journal left by a previous run with the completion log and the queue, before claiming again:
+            * a command recorded as completed is finished again: rescheduled for its retry, or dead lettered
+              and dequeued. Steps that were already done before the crash are skipped.
+            * a command that was started and not recorded is stopped if it outlived the daemon, recorded as
+              interrupted and left in the queue, store.recover() hands it out again with the same attempt.
+        :return: Number of commands recovered
+        """
+        recovered = 0
+        for idx, (state, info, started_at) in self.journal.states().items():
+            if state == __DONE__:
+                continue
+            recovered += 1
+            attempt = info.get('attempt', 1)
+            record = self.get_result(idx)
+            if (
+                record and not record.get('interrupted') and record.get('attempt', 1) == attempt
+                and record.get('started_at', 0) >= started_at - 1
+            ):
+                log.info(f"Recovering command {idx}: recorded before the crash, finishing it.")
+                self.recover_recorded(idx, record)
+            else:
+                log.info(f"Recovering command {idx}: interrupted by the crash, running it again.")
+                self.stop_orphan(info)
+                self.mark_as_completed(
+                    idx=idx, cmd=info.get('command'), status=False,
+                    err='Interrupted: the daemon stopped while the command was running.',
+                    details={'interrupted': True, 'attempt': attempt, 'started_at': started_at},
+                )
+        self.journal.clear()
+        if recovered:
+            log.info(f"Recovered {recovered} commands from the journal.")
+        return recovered
+
+    def recover_recorded(self, idx, record):
+        """
+        Finish a command whose completion record was written before a crash.
+        """
+        try:
+            if record.get('retry_at') is not None:
+                meta = self.store.get_meta(idx)
+                self.store.retry(idx, {**meta, 'attempt': record['attempt'] + 1}, record['retry_at'])
+                return
+            if not record['status'] and self.settings['dead_letter'] and not (self.dead_letter / f'{idx}.json').exists():
+                self.send_to_dead_letter(idx, record['command'], self.store.get_meta(idx), record, record.get('error'))
+            self.dequeue([idx])
+        except FileNotFoundError:
+            log.debug(f"Command {idx} was already dequeued or rescheduled.")
+
+    @staticmethod
+    def stop_orphan(info):
+        """
+        Kill what is left of an interrupted command: its worker if it still runs, then its process group.
+        :param info: Journal info of the command
+        """
+        pid = info.get('pid')
+        if pid and pid != os.getpid() and pid_alive(pid, info.get('pid_start')):
+            log.warning(f"Killing the worker {pid} left by the previous run.")
+            os.kill(pid, signal.SIGKILL)
+        pgid = info.get('pgid')
+        if pgid and pid_alive(pgid, info.get('pgid_start')):
+            log.warning(f"Killing the process group {pgid} left by the previous run.")
+            kill_group(pgid, signal.SIGKILL)
+
+    def next_wakeup(self):
+        """
+        :return: Seconds until the next delayed retry is due, None to only wait for a change of the queue
+        """
+        next_due = self.store.next_due
+        return None if next_due is None else max(next_due - time(), 0)
+
+    def keep_leases(self, watcher, stop):
+        """
+        Heartbeat thread: renew our leases and reclaim the commands of dead workers every lease_ttl / 3 seconds.
+        The daemon is woken up on every beat so no wait lasts longer, whatever its watcher missed.
+        """
+        while not stop.is_set():
+            try:
+                self.store.heartbeat()
+                self.store.reclaim()
+            except Exception as err:
+                log.warning(f"Failed to renew leases: {err}")
+            watcher.notify()
+            stop.wait(self.settings['lease_ttl'] / 3)
+
+    def run_batches(self, watcher):
+        """
+        Snapshot the queue and run it on a fresh pool, the next snapshot is taken once the whole batch is done.
+        With leases, other daemons drain the same queue: a batch only claims the commands its pool can start and
+        claims again as slots free up, instead of holding the whole snapshot.
+        """
         while True:
             log.debug(f"Refreshing queue.")
-            queue = self.read_queue()
-
-            if queue:
-                commands = [(idx, read_file(self.queue / str(idx))) for idx in queue]
-                self.mark_in_process(commands, queue)
+            pool_size = self.get_pool_size()
+            commands = self.claim(limit=pool_size if self.store.leases else None)
 
+            if commands:
                 log.info(f"Pooling {len(commands)} commands.")
                 log.debug(f"Pooling commands: {commands}")
-                worker_pool = multiprocessing.Pool(self.get_pool_size())
-                worker_pool.starmap(func=self.execute_command, iterable=commands, chunksize=1)
+                worker_pool = multiprocessing.Pool(pool_size)
+                if self.store.leases:
+                    self.run_leased_batch(worker_pool, pool_size, commands, watcher)
+                else:
+                    for idx, cmd, meta in commands:
+                        worker_pool.apply_async(
+                            func=self.execute_command, args=(idx, cmd, meta),
+                            callback=partial(self.command_done, idx), error_callback=partial(self.command_done, idx)
+                        )
                 worker_pool.close()
                 worker_pool.join()
+                self.journal.compact()
 
                 queue = self.read_queue()
                 if not queue:
                     log.info(f"Queue is Empty. Enqueue more commands to execute..")
+                # Claim again right away: retries were scheduled and commands enqueued while the batch ran.
+                continue
 
-            sleep(2)
+            watcher.wait(self.next_wakeup())
+
+    def run_leased_batch(self, worker_pool, pool_size, commands, watcher):
+        """
+        Run a batch claimed with leases: every time commands finish, claim as many as there are free slots, until
+        the queue has nothing left for this daemon and the batch is done.
+        """
+        in_flight = {}  # idx -> lane
+        finished = deque()  # idx of the commands done, appended by the pool's result thread
+
+        def on_done(idx, result):
+            self.command_done(idx, result)
+            finished.append(idx)
+            watcher.notify()
+
+        while True:
+            for idx, cmd, meta in commands:
+                worker_pool.apply_async(
+                    func=self.execute_command, args=(idx, cmd, meta),
+                    callback=partial(on_done, idx), error_callback=partial(on_done, idx)
+                )
+                in_flight[idx] = meta.get('lane', __DEFAULT_LANE__)
+            if not in_flight:
+                return
+            watcher.wait(None)
+            while finished:
+                in_flight.pop(finished.popleft(), None)
+            free_slots = pool_size - len(in_flight)
+            commands = []
+            if free_slots > 0:
+                commands = self.claim(limit=free_slots, exclude=in_flight, running=Counter(in_flight.values()))
+                if commands:
+                    log.info(f"Pooling {len(commands)} more commands, {len(in_flight)} in flight.")
+
+    def run_continuous(self, watcher):
+        """
+        Keep one worker pool alive and hand it a new command as soon as a slot frees up.
+        pool_size.json is re-read on every wakeup: shrinking lowers the number of commands in flight,
+        growing starts a bigger pool and retires the old one once its commands are done.
+        """
+        pool_size = self.get_pool_size()
+        worker_pool = multiprocessing.Pool(pool_size)
+        pool_processes = pool_size
+        retired_pools = []
+        in_flight = {}  # idx -> (pool, AsyncResult, cmd, lane)
+        finished = deque()  # idx of the commands done, appended by the pool's result thread
+
+        def on_done(idx, result):
+            # The pool calls back before the AsyncResult is ready(), so the callback itself reports completion.
+            self.command_done(idx, result)
+            finished.append(idx)
+            watcher.notify()
+
+        try:
+            while True:
+                # Reap finished commands
+                while finished:
+                    in_flight.pop(finished.popleft(), None)
+
+                for old_pool in list(retired_pools):
+                    if not any(pool is old_pool for pool, _, _, _ in in_flight.values()):
+                        old_pool.join()
+                        retired_pools.remove(old_pool)
+                        self.journal.compact()
+
+                new_size = self.get_pool_size()
+                if new_size > pool_processes:
+                    log.info(f"Growing pool from {pool_processes} to {new_size} processes.")
+                    worker_pool.close()
+                    retired_pools.append(worker_pool)
+                    worker_pool = multiprocessing.Pool(new_size)
+                    pool_processes = new_size
+                if new_size != pool_size:
+                    log.info(f"Pool size changed from {pool_size} to {new_size} commands in flight.")
+                pool_size = new_size
+
+                free_slots = pool_size - len(in_flight)
+                if free_slots > 0:
+                    log.debug(f"Refreshing queue.")
+                    running = Counter(lane for _, _, _, lane in in_flight.values())
+                    queue = self.claim(limit=free_slots, exclude=in_flight, running=running)
+                    for idx, cmd, meta in queue:
+                        result = worker_pool.apply_async(
+                            func=self.execute_command, args=(idx, cmd, meta),
+                            callback=partial(on_done, idx), error_callback=partial(on_done, idx)
+                        )
+                        in_flight[idx] = (worker_pool, result, cmd, meta.get('lane', __DEFAULT_LANE__))
+
+                    if queue:
+                        log.info(f"Dispatched {len(queue)} commands, {len(in_flight)} in flight.")
+                    elif not in_flight:
+                        log.info(f"Queue is Empty. Enqueue more commands to execute..")
+
+                # With every slot busy, the next completion wakes us up before any retry can run.
+                watcher.wait(self.next_wakeup() if len(in_flight) < pool_size else None)
+        finally:
+            for pool in retired_pools + [worker_pool]:
+                pool.terminate()
+                pool.join()
+
+    async def run_asyncio(self, watcher):
+        """
+        Run the queue as asyncio subprocesses in this process, at most get_pool_size() of them at a time.
+        The blocking watcher.wait() runs in a thread and is interrupted by watcher.notify() when a command is done.
+        """
+        loop = asyncio.get_running_loop()
+        in_flight = {}  # idx -> (Task, cmd, lane)
+
+        def on_done(idx, task):
+            self.command_done(idx, None if task.cancelled() or task.exception() else task.result())
+            watcher.notify()
+
+        try:
+            while True:
+                for idx, (task, _, _) in list(in_flight.items()):
+                    if task.done():
+                        del in_flight[idx]
+
+                free_slots = self.get_pool_size() - len(in_flight)
+                if free_slots > 0:
+                    log.debug(f"Refreshing queue.")
+                    running = Counter(lane for _, _, lane in in_flight.values())
+                    queue = self.claim(limit=free_slots, exclude=in_flight, running=running)
+                    for idx, cmd, meta in queue:
+                        task = loop.create_task(self.execute_command_async(idx, cmd, meta))
+                        task.add_done_callback(partial(on_done, idx))
+                        in_flight[idx] = (task, cmd, meta.get('lane', __DEFAULT_LANE__))
+
+                    if queue:
+                        log.info(f"Dispatched {len(queue)} commands, {len(in_flight)} in flight.")
+                    elif not in_flight:
+                        log.info(f"Queue is Empty. Enqueue more commands to execute..")
+
+                timeout = self.next_wakeup() if len(in_flight) < self.get_pool_size() else None
+                await loop.run_in_executor(None, watcher.wait, timeout)
+        finally:
+            for task, _, _ in in_flight.values():
+                task.cancel()
 
 
 def get_args():
@@ -175,15 +952,33 @@ def get_args():
 
     arg_parser.add_argument('-q', '--queue', action='store', type=str, required=True, help='Name of the Queue.')
     arg_parser.add_argument('-p', '--pool', action='store', type=int, required=True, help='Size of the Pool.')
+    arg_parser.add_argument('-w', '--wakeup', action='store', type=str, default='auto',
+                            choices=['auto', 'inotify', 'poll'],
+                            help='How to wait for new commands, inotify only works when every producer and daemon '
+                                 'runs on this host. auto polls with --leases.')
+    arg_parser.add_argument('-d', '--dispatch', action='store', type=str, default='batch',
+                            choices=['batch', 'continuous'], help='Run the queue in batches or continuously.')
+    arg_parser.add_argument('-e', '--engine', action='store', type=str, default='process',
+                            choices=['process', 'asyncio'], help='Run commands in worker processes or with asyncio.')
+    arg_parser.add_argument('-s', '--store', action='store', type=str, default='files',
+                            choices=['files', 'sqlite'], help='Where the queued commands are stored.')
+    arg_parser.add_argument('-l', '--leases', action='store_true',
+                            help='Claim commands with leases, to run several daemons on the same queue.')
+    arg_parser.add_argument('-i', '--worker-id', action='store', type=str, default=None,
+                            help='Unique id of this daemon when using leases, by default <hostname>-<n> with '
+                                 'the lowest n free on this host, kept across restarts.')
+    arg_parser.add_argument('-m', '--metrics-port', action='store', type=int, default=None,
+                            help='Serve Prometheus metrics on this port, the metrics_port setting by default.')
 
     # Parse arguments
-    args = arg_parser.parse_args()
-
-    return args.queue, args.pool
+    return arg_parser.parse_args()
 
 
 if __name__ == '__main__':
-    queue_name, pool = get_args()
+    args = get_args()
 
-    my_queue = QueueExecutor(queue_name, pool)
+    my_queue = QueueExecutor(
+        args.queue, args.pool, wakeup=args.wakeup, dispatch=args.dispatch, engine=args.engine, store=args.store,
+        leases=args.leases, worker_id=args.worker_id, metrics_port=args.metrics_port
+    )
     my_queue.run()
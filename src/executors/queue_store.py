@@ -0,0 +1,707 @@
+# !/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Storage backends for the Queue executor.
+
+    FileQueueStore (default):
+        One file per command in `queues/<name>/queue/`, the file name is the index of the command.
+        Indices come from a persistent counter (`queues/<name>/sequence`) guarded by a file lock, so concurrent
+        producers never collide and indices are never reused once the queue drains. Commands are written to
+        `queues/<name>/incoming/` and renamed into the queue, the daemon never sees a half written command.
+
+    SqliteQueueStore:
+        A single `queues/<name>/queue.db` table in WAL mode with an index on the status of the commands.
+        Enqueue and claiming the next commands don't depend on the length of the queue, and commands
+        claimed by a daemon that died are put back in the queue on the next start (see recover()).
+
+    Every store exposes the same methods, so QueueExecutor doesn't care where the commands live.
+    Commands can carry metadata (lane, priority..), claim() hands the queued commands to a LaneScheduler
+    which picks the ones to run next.
+
+    Leases (worker_id + lease_ttl) let several daemons, on one host or on several hosts sharing the queue
+    directory, drain the same queue without running a command twice:
+        * files  - a command is claimed by renaming it into `claimed/<worker_id>/`, an atomic operation only one
+                   daemon can win. The daemon touches `claimed/<worker_id>/.heartbeat` while it is alive.
+        * sqlite - claimed rows record the worker id and the time of its last heartbeat.
+    Commands claimed by a worker whose heartbeat is older than lease_ttl are put back in the queue by the others.
+
+    Retries (see src.executors.retry) keep the index of the command and wait for their delay out of the queue:
+        * files  - in `delayed/<run_at in ms>_<idx>`, moved back to the queue by promote() once due.
+        * sqlite - as queued rows with a run_at in the future.
+"""
+
+import os
+import json
+import fcntl
+import sqlite3
+import logging
+import threading
+from time import time
+from itertools import islice
+from src.utils.file_handlers import save_file, read_file
+from src.executors.scheduler import LaneScheduler, __DEFAULT_LANE__
+
+
+__author__ = 'Mohammed Ataaur Rahaman'
+
+
+__ENQUEUE_BLOCK__ = 1000
+
+log = logging.getLogger(__name__)
+
+
+def chunked(iterable, size):
+    """
+    Yield lists of at most size items from iterable without materializing it.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class SequenceAllocator:
+    """
+    Monotonic counter stored in a file, shared by every process through an exclusive flock.
+    """
+
+    def __init__(self, path, seed=None):
+        """
+        :param path: Path of the counter file
+        :param seed: Callable returning the first index when the counter file doesn't exist yet
+        """
+        self.path = path
+        self.seed = seed
+
+    def allocate(self, count):
+        """
+        Reserve a block of consecutive indices.
+        :param count: Number of indices to reserve
+        :return: First index of the block
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            content = os.read(fd, 64).strip()
+            start = int(content) if content else (self.seed() if self.seed else 0)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, str(start + count).encode())
+            return start
+        finally:
+            os.close(fd)  # Releases the lock
+
+
+class QueueStore:
+    """
+    Base class of the stores, claim() is shared: the store lists the candidates of every lane, the scheduler
+    picks some of them and the store takes them out of the queue.
+    """
+
+    default_scheduler = LaneScheduler()
+    worker_id = None
+    lease_ttl = None
+    next_due = None
+
+    @property
+    def leases(self):
+        return self.worker_id is not None
+
+    def heartbeat(self):
+        """
+        Renew the leases of this worker.
+        """
+
+    def reclaim(self):
+        """
+        Put the commands of workers whose lease expired back in the queue.
+        :return: Number of reclaimed commands
+        """
+        return 0
+
+    def depth(self, exclude=()):
+        """
+        :param exclude: Indices being run by this daemon, left out if they are still in the queue
+        :return: Number of commands waiting in the queue
+        """
+        return sum(1 for idx in self.pending() or [] if idx not in exclude)
+
+    def enqueued_at(self, idx):
+        """
+        :return: Timestamp at which a claimed command was enqueued, None if unknown
+        """
+        return None
+
+    def promote(self):
+        """
+        Make the delayed retries that are due runnable again.
+        :return: Timestamp of the next delayed retry, None if there is none
+        """
+        return None
+
+    def retry(self, idx, meta, run_at):
+        """
+        Put a claimed command back in the queue, runnable from run_at.
+        :param idx: Index of the command
+        :param meta: New metadata of the command (attempt..)
+        :param run_at: Timestamp from which the command can run again
+        """
+        raise NotImplementedError
+
+    def candidates(self, limit=None, exclude=()):
+        """
+        :param limit: Max number of candidates per lane, None for all of them
+        :param exclude: Indices already being run by this daemon
+        :return: Dictionary of lane -> list of (idx, priority) sorted by descending priority then idx
+        """
+        raise NotImplementedError
+
+    def take(self, selected):
+        """
+        :param selected: List of (idx, lane) picked by the scheduler
+        :return: List of (idx, cmd, meta)
+        """
+        raise NotImplementedError
+
+    def claim(self, limit=None, exclude=(), scheduler=None, running=None):
+        """
+        Get the next commands to run.
+        :param limit: Max number of commands, None for all of them
+        :param exclude: Indices already being run by this daemon
+        :param scheduler: LaneScheduler, strict priority then FIFO if None
+        :param running: Dictionary of lane -> number of commands of the lane in flight
+        :return: List of (idx, cmd, meta)
+        """
+        scheduler = scheduler or self.default_scheduler
+        self.next_due = self.promote()
+        selected = scheduler.select(self.candidates(limit, exclude), limit=limit, running=running)
+        return self.take(selected) if selected else []
+
+    def enqueue_many(self, commands, block_size=__ENQUEUE_BLOCK__, meta=None):
+        """
+        Enqueue commands from any iterable (e.g. a generator), block_size commands at a time.
+        :return: Number of enqueued commands
+        """
+        count = 0
+        for chunk in chunked(commands, block_size):
+            count += len(self.enqueue(chunk, meta=meta))
+        return count
+
+
+class FileQueueStore(QueueStore):
+
+    def __init__(self, queue_root, worker_id=None, lease_ttl=60):
+        self.queue = queue_root / 'queue'
+        self.incoming = queue_root / 'incoming'
+        self.completed = queue_root / 'completed'
+        self.completions = queue_root / 'completions'
+        self.meta = queue_root / 'meta'
+        self.claimed = queue_root / 'claimed'
+        self.delayed = queue_root / 'delayed'
+        self.sequence = SequenceAllocator(queue_root / 'sequence', seed=self._seed)
+        self._meta_cache = {}
+
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.claim_dir = self.claimed / worker_id if worker_id else None
+
+    def __getstate__(self):
+        # Workers don't need the metadata cache of the daemon.
+        state = self.__dict__.copy()
+        state['_meta_cache'] = {}
+        return state
+
+    def _seed(self):
+        """
+        First index for a queue created before the sequence file existed: after every queued or completed index.
+        """
+        indices = [-1]
+        indices += self.pending() or []
+        if self.completed.exists():
+            indices += [int(path.name.split('_')[1]) for path in self.completed.glob('*_completed.json')]
+        if self.completions.exists():
+            for path in self.completions.glob('*.idx'):
+                with open(path, 'r') as f:
+                    indices += [int(line.split('\t', 1)[0]) for line in f]
+        return max(indices) + 1
+
+    def watch_paths(self):
+        """
+        Paths that change when a command is enqueued.
+        """
+        self.queue.mkdir(parents=True, exist_ok=True)
+        return [self.queue]
+
+    def pending(self):
+        """
+        :return: Sorted list of the indices in the queue or None if the queue is empty.
+        """
+        files = list(self.queue.glob('*'))
+        files = [int(file.name) for file in files if files]
+        return sorted(files) if files else None
+
+    def enqueue(self, commands, meta=None):
+        """
+        :param commands: List of command strings
+        :param meta: Dictionary of metadata shared by the commands (lane, priority..), None for the defaults
+        :return: List of the allocated indices
+        """
+        if not commands:
+            return []
+        start = self.sequence.allocate(len(commands))
+        self.incoming.mkdir(parents=True, exist_ok=True)
+        self.queue.mkdir(parents=True, exist_ok=True)
+        if meta:
+            self.meta.mkdir(parents=True, exist_ok=True)
+        for idx, command in enumerate(commands, start):
+            if meta:
+                # Written first, the command is only visible once its metadata is there.
+                with open(self.meta / f'{idx}.json', 'w', encoding='utf-8') as f:
+                    json.dump(meta, f)
+            tmp_path = self.incoming / str(idx)
+            with open(tmp_path, 'w') as f:
+                f.write(command)
+            os.rename(tmp_path, self.queue / str(idx))
+        return list(range(start, start + len(commands)))
+
+    def read(self, idx):
+        return read_file(self.queue / str(idx))
+
+    def depth(self, exclude=()):
+        # Without leases, a running command stays in the queue directory until it is dequeued.
+        try:
+            return sum(1 for name in os.listdir(self.queue) if int(name) not in exclude)
+        except FileNotFoundError:
+            return 0
+
+    def enqueued_at(self, idx):
+        # The command file is written once when enqueued, renames keep its mtime.
+        try:
+            return os.stat((self.claim_dir if self.leases else self.queue) / str(idx)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def get_meta(self, idx):
+        """
+        :return: Metadata dictionary of a command, empty if it was enqueued with the defaults.
+        """
+        if idx not in self._meta_cache:
+            self._meta_cache[idx] = self.read_meta(idx)
+        return self._meta_cache[idx]
+
+    def read_meta(self, idx):
+        """
+        :return: Metadata dictionary of a command read from its file, bypassing the cache.
+        """
+        try:
+            with open(self.meta / f'{idx}.json', 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def retry(self, idx, meta, run_at):
+        """
+        The command waits in delayed/<run_at in ms>_<idx> until promote() moves it back to the queue.
+        """
+        for path in (self.incoming, self.meta, self.delayed):
+            path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.incoming / f'{idx}.json'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta / f'{idx}.json')
+        self._meta_cache[idx] = meta
+        source = (self.claim_dir if self.leases else self.queue) / str(idx)
+        os.rename(source, self.delayed / f'{int(run_at * 1000)}_{idx}')
+
+    def promote(self):
+        if not self.delayed.exists():
+            return None
+        now = time() * 1000
+        next_due = None
+        for name in os.listdir(self.delayed):
+            run_at, idx = name.split('_')
+            if int(run_at) > now:
+                next_due = min(next_due or int(run_at), int(run_at))
+                continue
+            try:
+                os.rename(self.delayed / name, self.queue / idx)
+            except FileNotFoundError:
+                pass  # Promoted by another worker
+        return None if next_due is None else next_due / 1000
+
+    def candidates(self, limit=None, exclude=()):
+        queue = self.pending() or []
+        with_meta = {int(name[:-5]) for name in os.listdir(self.meta) if name.endswith('.json')} \
+            if self.meta.exists() else set()
+        self._meta_cache = {idx: meta for idx, meta in self._meta_cache.items() if idx in with_meta}
+
+        lanes = {}
+        for idx in queue:
+            if idx in exclude:
+                continue
+            meta = self.get_meta(idx) if idx in with_meta else {}
+            lanes.setdefault(meta.get('lane', __DEFAULT_LANE__), []).append((idx, meta.get('priority', 0)))
+
+        for lane, jobs in lanes.items():
+            jobs.sort(key=lambda job: (-job[1], job[0]))
+            if limit is not None:
+                del jobs[limit:]
+        return lanes
+
+    def take(self, selected):
+        # The cache only serves lanes and priorities: the attempt of a retried command is rewritten by whichever
+        # worker ran it, so the metadata handed out is read again from its file.
+        if not self.leases:
+            return [(idx, self.read(idx), self.fresh_meta(idx)) for idx, _ in selected]
+
+        claimed = []
+        self.claim_dir.mkdir(parents=True, exist_ok=True)
+        for idx, _ in selected:
+            try:
+                os.rename(self.queue / str(idx), self.claim_dir / str(idx))
+            except FileNotFoundError:
+                continue  # Claimed by another worker
+            claimed.append((idx, read_file(self.claim_dir / str(idx)), self.fresh_meta(idx)))
+        return claimed
+
+    def fresh_meta(self, idx):
+        meta = self.read_meta(idx)
+        self._meta_cache[idx] = meta
+        return dict(meta)
+
+    def dequeue(self, queue):
+        for idx in queue:
+            path = self.claim_dir / str(idx) if self.leases else self.queue / str(idx)
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                if not self.leases:
+                    raise
+                # Lease expired and the command was reclaimed, remove it from the queue anyway.
+                log.warning(f"Command {idx} was reclaimed while running.")
+                try:
+                    (self.queue / str(idx)).unlink()
+                except FileNotFoundError:
+                    pass
+            try:
+                (self.meta / f'{idx}.json').unlink()
+            except FileNotFoundError:
+                pass
+
+    def heartbeat(self):
+        if not self.leases:
+            return
+        self.claim_dir.mkdir(parents=True, exist_ok=True)
+        (self.claim_dir / '.heartbeat').touch()
+
+    def _release(self, claim_dir):
+        """
+        Move every command of a claim directory back to the queue.
+        :return: Number of commands moved
+        """
+        count = 0
+        for path in claim_dir.iterdir():
+            if not path.name.isdigit():
+                continue
+            try:
+                os.rename(path, self.queue / path.name)
+                count += 1
+            except FileNotFoundError:
+                pass  # Reclaimed by another worker
+        return count
+
+    def reclaim(self):
+        if not self.leases or not self.claimed.exists():
+            return 0
+        count = 0
+        for claim_dir in self.claimed.iterdir():
+            if claim_dir == self.claim_dir or not claim_dir.is_dir():
+                continue
+            heartbeat = claim_dir / '.heartbeat'
+            try:
+                last_beat = (heartbeat if heartbeat.exists() else claim_dir).stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if time() - last_beat < self.lease_ttl:
+                continue
+
+            released = self._release(claim_dir)
+            if released:
+                log.info(f"Reclaimed {released} commands of expired worker {claim_dir.name}.")
+            count += released
+            try:
+                heartbeat.unlink()
+                claim_dir.rmdir()
+            except OSError:
+                pass
+        return count
+
+    def recover(self):
+        """
+        Without leases nothing to recover, a command stays in the queue directory until it is dequeued.
+        With leases, put back the commands claimed by a previous daemon with the same worker id.
+        """
+        if not self.leases:
+            return 0
+        self.heartbeat()
+        count = self._release(self.claim_dir)
+        if count:
+            log.info(f"Recovered {count} in-flight commands.")
+        return count
+
+
+class SqliteQueueStore(QueueStore):
+
+    def __init__(self, db_path, signal_path, worker_id=None, lease_ttl=60):
+        self.db_path = db_path
+        self.signal_path = signal_path
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # sqlite connections can't cross process or thread boundaries, every worker opens its own.
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # Several processes may open a new database at once, one of them creates or migrates the schema.
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS queue ("
+                    " idx INTEGER PRIMARY KEY AUTOINCREMENT,"
+                    " command TEXT NOT NULL,"
+                    " status TEXT NOT NULL DEFAULT 'queued',"
+                    " enqueued_at REAL NOT NULL,"
+                    " claimed_at REAL)"
+                )
+                columns = [row[1] for row in conn.execute("PRAGMA table_info(queue)")]
+                if 'lane' not in columns:
+                    conn.execute(f"ALTER TABLE queue ADD COLUMN lane TEXT NOT NULL DEFAULT '{__DEFAULT_LANE__}'")
+                    conn.execute("ALTER TABLE queue ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+                    conn.execute("ALTER TABLE queue ADD COLUMN meta TEXT")
+                if 'claimed_by' not in columns:
+                    conn.execute("ALTER TABLE queue ADD COLUMN claimed_by TEXT")
+                if 'run_at' not in columns:
+                    conn.execute("ALTER TABLE queue ADD COLUMN run_at REAL")
+                conn.execute("CREATE INDEX IF NOT EXISTS queue_status ON queue (status, idx)")
+                conn.execute("CREATE INDEX IF NOT EXISTS queue_lane ON queue (status, lane, priority DESC, idx)")
+                conn.execute("CREATE INDEX IF NOT EXISTS queue_claims ON queue (status, claimed_by, claimed_at)")
+                conn.execute("CREATE TABLE IF NOT EXISTS lanes (lane TEXT PRIMARY KEY)")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _signal(self):
+        """
+        Rewrite the signal file so watchers of the queue wake up, sqlite keeps its own files open.
+        """
+        save_file(file_path=self.signal_path, content=str(time()))
+
+    def watch_paths(self):
+        if not self.signal_path.exists():
+            self._signal()
+        return [self.signal_path]
+
+    def pending(self):
+        # Running rows and retries waiting for their delay are not in the queue, as with the files store.
+        rows = self.conn.execute(
+            "SELECT idx FROM queue WHERE status = 'queued' AND (run_at IS NULL OR run_at <= ?) ORDER BY idx", (time(),)
+        ).fetchall()
+        return [row[0] for row in rows] if rows else None
+
+    def _insert(self, commands, meta):
+        """
+        Insert a block of commands with one executemany, in the write transaction of the caller.
+        The transaction holds the write lock, so the indices after the last one AUTOINCREMENT handed out are ours;
+        inserting them explicitly moves its counter past them.
+        """
+        meta = meta or {}
+        row = (time(), meta.get('lane', __DEFAULT_LANE__), meta.get('priority', 0), json.dumps(meta) if meta else None)
+        self.conn.execute("INSERT OR IGNORE INTO lanes (lane) VALUES (?)", (row[1],))
+        last = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'queue'").fetchone()
+        first = (last[0] if last else 0) + 1
+        commands = list(commands)
+        indices = list(range(first, first + len(commands)))
+        self.conn.executemany(
+            "INSERT INTO queue (idx, command, enqueued_at, lane, priority, meta) VALUES (?, ?, ?, ?, ?, ?)",
+            [(idx, command) + row for idx, command in zip(indices, commands)]
+        )
+        return indices
+
+    def enqueue(self, commands, meta=None):
+        """
+        :param commands: List of command strings
+        :param meta: Dictionary of metadata shared by the commands (lane, priority..), None for the defaults
+        :return: List of the allocated indices, AUTOINCREMENT never reuses them
+        """
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            indices = self._insert(commands, meta)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._signal()
+        return indices
+
+    def read(self, idx):
+        row = self.conn.execute("SELECT command FROM queue WHERE idx = ?", (idx,)).fetchone()
+        if row is None:
+            raise Exception(f"Command {idx} is not in the queue.")
+        return row[0]
+
+    def get_meta(self, idx):
+        row = self.conn.execute("SELECT meta FROM queue WHERE idx = ?", (idx,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+    def depth(self, exclude=()):
+        # Claimed rows are not queued anymore, exclude is not needed.
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM queue WHERE status = 'queued' AND (run_at IS NULL OR run_at <= ?)", (time(),)
+        ).fetchone()[0]
+
+    def retry(self, idx, meta, run_at):
+        self.conn.execute(
+            "UPDATE queue SET status = 'queued', claimed_at = NULL, claimed_by = NULL, run_at = ?, meta = ?"
+            " WHERE idx = ?",
+            (run_at, json.dumps(meta), idx)
+        )
+
+    def promote(self):
+        """
+        Delayed rows stay queued with a run_at in the future, candidates() skips them until then.
+        """
+        return self.conn.execute(
+            "SELECT MIN(run_at) FROM queue WHERE status = 'queued' AND run_at > ?", (time(),)
+        ).fetchone()[0]
+
+    def enqueued_at(self, idx):
+        row = self.conn.execute("SELECT enqueued_at FROM queue WHERE idx = ?", (idx,)).fetchone()
+        return row[0] if row else None
+
+    def candidates(self, limit=None, exclude=()):
+        lanes = {}
+        now = time()
+        for (lane,) in self.conn.execute("SELECT lane FROM lanes").fetchall():
+            jobs = self.conn.execute(
+                "SELECT idx, priority FROM queue WHERE status = 'queued' AND lane = ?"
+                " AND (run_at IS NULL OR run_at <= ?) ORDER BY priority DESC, idx LIMIT ?",
+                (lane, now, -1 if limit is None else limit)
+            ).fetchall()
+            if jobs:
+                lanes[lane] = jobs
+        return lanes
+
+    def take(self, selected):
+        claimed = []
+        now = time()
+        for idx, _ in selected:
+            cursor = self.conn.execute(
+                "UPDATE queue SET status = 'running', claimed_at = ?, claimed_by = ?"
+                " WHERE idx = ? AND status = 'queued'",
+                (now, self.worker_id, idx)
+            )
+            if cursor.rowcount:
+                claimed.append((idx, self.read(idx), self.get_meta(idx)))
+        return claimed
+
+    def claim(self, limit=None, exclude=(), scheduler=None, running=None):
+        """
+        Mark the next queued commands as running and return them, in a single transaction.
+        Claimed commands are not queued anymore, exclude is not needed.
+        """
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            claimed = super().claim(limit=limit, scheduler=scheduler, running=running)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return claimed
+
+    def dequeue(self, queue):
+        self.conn.executemany("DELETE FROM queue WHERE idx = ?", [(idx,) for idx in queue])
+
+    def heartbeat(self):
+        """
+        claimed_at of the running rows of this worker doubles as their heartbeat.
+        """
+        if self.leases:
+            self.conn.execute(
+                "UPDATE queue SET claimed_at = ? WHERE status = 'running' AND claimed_by = ?", (time(), self.worker_id)
+            )
+
+    def reclaim(self):
+        if not self.leases:
+            return 0
+        cursor = self.conn.execute(
+            "UPDATE queue SET status = 'queued', claimed_at = NULL, claimed_by = NULL"
+            " WHERE status = 'running' AND claimed_at < ?",
+            (time() - self.lease_ttl,)
+        )
+        if cursor.rowcount:
+            log.info(f"Reclaimed {cursor.rowcount} commands of expired workers.")
+            self._signal()
+        return cursor.rowcount
+
+    def recover(self):
+        """
+        Put commands claimed by a previous daemon back in the queue.
+        Without leases every running command belongs to us, with leases only the ones claimed with our worker id.
+        :return: Number of recovered commands
+        """
+        if self.leases:
+            cursor = self.conn.execute(
+                "UPDATE queue SET status = 'queued', claimed_at = NULL, claimed_by = NULL"
+                " WHERE status = 'running' AND claimed_by = ?",
+                (self.worker_id,)
+            )
+        else:
+            cursor = self.conn.execute(
+                "UPDATE queue SET status = 'queued', claimed_at = NULL WHERE status = 'running'"
+            )
+        if cursor.rowcount:
+            log.info(f"Recovered {cursor.rowcount} in-flight commands.")
+        return cursor.rowcount
+
+
+def get_store(queue_root, store='files', worker_id=None, lease_ttl=60):
+    """
+    Create the storage backend of a queue.
+    :param queue_root: Path to queues/<queue_name>
+    :param store: 'files' or 'sqlite'
+    :param worker_id: Unique id of the consuming daemon to claim commands with leases, None for a single consumer
+    :param lease_ttl: Seconds without heartbeat after which the commands of a worker are reclaimed
+    """
+    if store == 'files':
+        return FileQueueStore(queue_root, worker_id=worker_id, lease_ttl=lease_ttl)
+    elif store == 'sqlite':
+        return SqliteQueueStore(
+            queue_root / 'queue.db', signal_path=queue_root / 'queue.signal', worker_id=worker_id, lease_ttl=lease_ttl
+        )
+    else:
+        raise Exception(f"Unknown queue store: {store}")
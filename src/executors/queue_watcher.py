@@ -0,0 +1,206 @@
+# !/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Wakeup helpers for the Queue executor.
+
+    Instead of rescanning the queue directory on a fixed interval, a watcher blocks until something
+    changes in the watched directories:
+        * inotify (Linux) - the kernel wakes us up as soon as a file is written or moved into the queue. Only the
+                            changes made on this host are seen, not those of other clients of a network filesystem.
+        * poll            - a cheap `stat` of the directories with adaptive exponential backoff, used where
+                            inotify isn't available.
+
+    Usage:
+        watcher = get_watcher([queue_dir])
+        while True:
+            ... scan the queue ...
+            watcher.wait()
+
+        Other threads can interrupt a wait() with watcher.notify().
+"""
+
+import os
+import select
+import ctypes
+import ctypes.util
+import logging
+from time import monotonic
+
+
+__author__ = 'Mohammed Ataaur Rahaman'
+
+
+# inotify(7) constants
+__IN_NONBLOCK__ = 0o4000
+__IN_CLOEXEC__ = 0o2000000
+__IN_CLOSE_WRITE__ = 0x00000008
+__IN_MOVED_TO__ = 0x00000080
+__IN_MASK__ = __IN_CLOSE_WRITE__ | __IN_MOVED_TO__
+
+# Adaptive polling bounds (seconds)
+__MIN_POLL__ = 0.05
+__MAX_POLL__ = 2
+
+log = logging.getLogger(__name__)
+
+
+def _load_libc():
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return None
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        libc.inotify_init1  # Raises AttributeError when the platform has no inotify
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class Watcher:
+    """
+    Base watcher, owns a self-pipe so other threads (e.g. pool callbacks) can interrupt a wait() via notify().
+    """
+
+    def __init__(self):
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+
+    def notify(self):
+        """
+        Wake up a thread blocked in wait(). Safe to call from any thread.
+        """
+        try:
+            os.write(self.wake_w, b'\0')
+        except BlockingIOError:
+            pass  # Pipe full, a wakeup is already pending
+
+    @staticmethod
+    def _drain(fd):
+        try:
+            while os.read(fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self.wake_r is None:
+            return
+        for fd in (self.wake_r, self.wake_w):
+            os.close(fd)
+        self.wake_r = self.wake_w = None
+
+
+class PollWatcher(Watcher):
+    """
+    Detects changes by comparing the mtime of the watched paths.
+    The delay between two checks doubles while nothing happens and resets on activity.
+    """
+
+    def __init__(self, paths, min_delay=__MIN_POLL__, max_delay=__MAX_POLL__):
+        super().__init__()
+        self.paths = [str(path) for path in paths]
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
+        self.snapshot = self._stat()
+
+    def _stat(self):
+        snapshot = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                snapshot.append((st.st_mtime_ns, st.st_nlink, st.st_size))
+            except FileNotFoundError:
+                snapshot.append(None)
+        return snapshot
+
+    def wait(self, timeout=None):
+        """
+        Block until a watched path changes, notify() is called or timeout expires.
+        :param timeout: Max seconds to wait, None to wait until a change.
+        :return: True if woken up by a change or notify(), False on timeout.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            delay = self.delay
+            if deadline is not None:
+                delay = min(delay, max(deadline - monotonic(), 0))
+            readable, _, _ = select.select([self.wake_r], [], [], delay)
+            if readable:
+                self._drain(self.wake_r)
+                return True
+
+            snapshot = self._stat()
+            if snapshot != self.snapshot:
+                self.snapshot = snapshot
+                self.delay = self.min_delay
+                return True
+
+            self.delay = min(self.delay * 2, self.max_delay)
+            if deadline is not None and monotonic() >= deadline:
+                return False
+
+
+class InotifyWatcher(Watcher):
+    """
+    Blocks on an inotify file descriptor, an idle daemon sleeps in the kernel without any syscalls.
+    """
+
+    def __init__(self, paths, libc=None):
+        self.libc = libc or _load_libc()
+        if self.libc is None:
+            raise OSError("inotify is not available on this platform")
+
+        super().__init__()
+        self.fd = self.libc.inotify_init1(__IN_NONBLOCK__ | __IN_CLOEXEC__)
+        if self.fd < 0:
+            self.fd = None
+            errno = ctypes.get_errno()
+            self.close()
+            raise OSError(errno, "inotify_init1 failed")
+
+        for path in paths:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(path)), __IN_MASK__)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                self.close()
+                raise OSError(errno, f"inotify_add_watch failed for {path}")
+
+    def wait(self, timeout=None):
+        """
+        Block until a watched path changes, notify() is called or timeout expires.
+        :param timeout: Max seconds to wait, None to wait until a change.
+        :return: True if woken up by a change or notify(), False on timeout.
+        """
+        readable, _, _ = select.select([self.fd, self.wake_r], [], [], timeout)
+        if not readable:
+            return False
+        for fd in readable:
+            self._drain(fd)
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        super().close()
+
+
+def get_watcher(paths, mode='auto'):
+    """
+    Create a watcher for the given paths.
+    :param paths: List of existing directories or files to watch
+    :param mode: 'inotify', 'poll' or 'auto' (inotify with poll as fallback)
+    :return: InotifyWatcher or PollWatcher
+    """
+    if mode in ('auto', 'inotify'):
+        try:
+            return InotifyWatcher(paths)
+        except OSError as err:
+            if mode == 'inotify':
+                raise
+            log.info(f"inotify unavailable ({err}), falling back to polling.")
+
+    return PollWatcher(paths)
@@ -0,0 +1,60 @@
+# !/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Retry policy of the Queue executor.
+
+    A command fails when its exit code isn't 0 or it timed out (or, with the `fail_on_stderr` setting, when it wrote
+    to stderr). A failed command is retried while it has attempts left and its exit code is retryable, after an
+    exponential backoff with jitter:
+        delay = min(retry_backoff * 2 ** (attempt - 1), retry_backoff_max)
+        delay = delay * (1 - retry_jitter) + uniform(0, delay * retry_jitter)
+    A retry keeps the index and the priority of the command. While it waits for its delay it isn't in the queue,
+    so it doesn't hold a pool slot. Commands that failed for good go to `dead_letter/`.
+"""
+
+import random
+
+
+__author__ = 'Mohammed Ataaur Rahaman'
+
+
+# Options of the retry policy that can be set per command, the queue settings hold their defaults
+__RETRY__ = ('max_attempts', 'retry_on', 'retry_backoff')
+
+
+class RetryPolicy:
+
+    def __init__(self, max_attempts=1, retry_on=None, backoff=1, backoff_max=300, jitter=0.5):
+        """
+        :param max_attempts: Number of runs of a command, 1 to never retry
+        :param retry_on: List of the exit codes to retry, None to retry any failure (timeouts included)
+        :param backoff: Delay before the first retry in seconds, doubled at every attempt
+        :param backoff_max: Max delay between two attempts in seconds
+        :param jitter: Part of the delay that is random, 0 for none and 1 for "full jitter"
+        """
+        self.max_attempts = max_attempts
+        self.retry_on = None if retry_on is None else set(retry_on)
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+
+    def should_retry(self, attempt, returncode=None, timed_out=False):
+        """
+        :param attempt: Number of the attempt that failed, starting at 1
+        :param returncode: Exit code of the failed attempt
+        :param timed_out: True if the attempt was killed by its timeout
+        """
+        if attempt >= self.max_attempts:
+            return False
+        if self.retry_on is None:
+            return True
+        return not timed_out and returncode in self.retry_on
+
+    def delay(self, attempt):
+        """
+        :param attempt: Number of the attempt that failed, starting at 1
+        :return: Seconds to wait before the next attempt
+        """
+        delay = min(self.backoff * 2 ** (attempt - 1), self.backoff_max)
+        return delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
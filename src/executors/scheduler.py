@@ -0,0 +1,94 @@
+# !/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Lane scheduler for the Queue executor.
+
+    Every command belongs to a lane (default: 'default') and has a priority (default: 0, higher runs first).
+    The scheduler picks which queued commands run next:
+        * priority - strict priority across all lanes, FIFO for equal priorities.
+        * weighted - smooth weighted round-robin across lanes, so a lane with weight 3 gets 3 slots for every
+                     slot of a lane with weight 1. Inside a lane commands still run by priority, then FIFO.
+    Both policies honour per-lane concurrency caps.
+"""
+
+import heapq
+
+
+__author__ = 'Mohammed Ataaur Rahaman'
+
+
+__DEFAULT_LANE__ = 'default'
+
+
+class LaneScheduler:
+
+    def __init__(self, policy='priority', weights=None, caps=None):
+        """
+        :param policy: 'priority' or 'weighted'
+        :param weights: Dictionary of lane -> weight, lanes not listed get a weight of 1
+        :param caps: Dictionary of lane -> max commands of the lane in flight
+        """
+        if policy not in ('priority', 'weighted'):
+            raise Exception(f"Unknown scheduling policy: {policy}")
+        self.policy = policy
+        self.weights = weights or {}
+        self.caps = caps or {}
+        self.credits = {}
+
+    def select(self, candidates, limit=None, running=None):
+        """
+        Pick the next commands to run.
+        :param candidates: Dictionary of lane -> list of (idx, priority) sorted by descending priority then idx
+        :param limit: Max number of commands to pick, None for as many as the caps allow
+        :param running: Dictionary of lane -> number of commands of the lane in flight
+        :return: List of (idx, lane) in dispatch order
+        """
+        running = dict(running or {})
+        heads = {lane: list(jobs) for lane, jobs in candidates.items() if jobs}
+        if self.policy == 'weighted':
+            return self._select_weighted(heads, limit, running)
+        return self._select_priority(heads, limit, running)
+
+    def _free(self, lane, running):
+        cap = self.caps.get(lane)
+        return cap is None or running.get(lane, 0) < cap
+
+    def _select_priority(self, heads, limit, running):
+        merged = heapq.merge(
+            *[[(-priority, idx, lane) for idx, priority in jobs] for lane, jobs in heads.items()]
+        )
+        selected = []
+        for _, idx, lane in merged:
+            if limit is not None and len(selected) >= limit:
+                break
+            if not self._free(lane, running):
+                continue
+            selected.append((idx, lane))
+            running[lane] = running.get(lane, 0) + 1
+        return selected
+
+    def _select_weighted(self, heads, limit, running):
+        positions = {lane: 0 for lane in heads}
+        selected = []
+        while limit is None or len(selected) < limit:
+            lanes = [
+                lane for lane in heads if positions[lane] < len(heads[lane]) and self._free(lane, running)
+            ]
+            if not lanes:
+                break
+
+            # Smooth weighted round-robin: credits persist between calls so fairness holds across dispatches.
+            total = 0
+            for lane in lanes:
+                weight = self.weights.get(lane, 1)
+                self.credits[lane] = self.credits.get(lane, 0) + weight
+                total += weight
+            lane = max(lanes, key=lambda name: self.credits[name])
+            self.credits[lane] -= total
+
+            idx, _ = heads[lane][positions[lane]]
+            positions[lane] += 1
+            selected.append((idx, lane))
+            running[lane] = running.get(lane, 0) + 1
+        return selected
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Asyncio DB Handler to connect to postgres using psycopg 3 and psycopg_pool, with the surface of DbHandler.
+
+    Every query checks out a connection of the pool, so a single event loop keeps up to max_size queries in flight:
+        db = AsyncDbHandler('db', 'user', 'pass', 'localhost', 5432, max_size=32)
+        await db.create_connection()
+        rows = await asyncio.gather(*(db.fetchall_query("SELECT * FROM jobs WHERE id = %s", (i,)) for i in ids))
+        await db.close_connection()
+
+    Many small queries can also share one connection in pipeline mode, without waiting for each result:
+        results = await db.fetch_pipeline([("SELECT * FROM jobs WHERE id = %s", (i,)) for i in ids])
+
+    Streaming fetch, bulk insert, COPY and transactions work as in DbHandler:
+        async for row in db.iter_query("SELECT * FROM events", itersize=5000, as_dicts=True):
+            ...
+        await db.bulk_insert('jobs', rows, columns=['name', 'status'])
+        await db.copy_from_iter('jobs', rows, columns=['name', 'status'])
+        async with db.transaction():
+            await db.execute_query(...)
+"""
+
+import uuid
+import logging
+import contextvars
+from contextlib import asynccontextmanager
+import psycopg
+from psycopg import sql
+from psycopg.rows import dict_row
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+
+
+__author__ = "Mohammed Ataaur Rahaman"
+
+
+def table_identifier(table):
+    """
+    :param table: Table name, optionally qualified by its schema ('schema.table')
+    :return: Quoted SQL identifier
+    """
+    return sql.Identifier(*table.split('.'))
+
+
+class AsyncDbHandler:
+    def __init__(self, db_name: str, db_user: str, db_pass: str, host: str, port: int, min_size: int = 1,
+                 max_size: int = 10, max_idle: float = 300, health_check: bool = True, checkout_timeout: float = 30,
+                 autocommit: bool = False):
+        """
+        :param min_size: Connections kept open by the pool
+        :param max_size: Max connections open at once, i.e. max queries in flight
+        :param max_idle: Seconds after which an idle connection above min_size is closed
+        :param health_check: Check a connection with the server before handing it out
+        :param checkout_timeout: Max seconds to wait for a free connection
+        :param autocommit: Commit every statement on its own, use transaction() to group statements
+        """
+        self.db_name = db_name
+        self.db_pass = db_pass
+        self.port = port
+        self.host = host
+        self.user = db_user
+        self.url = host + ":" + str(port)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.health_check = health_check
+        self.checkout_timeout = checkout_timeout
+        self.autocommit = autocommit
+        self.pool = None
+        # Transaction of the current task, see transaction()
+        self._transaction = contextvars.ContextVar(f'transaction_{id(self)}', default=None)
+
+    def __str__(self):
+        return f"async connection to {self.db_name} on {self.url} as {self.user}"
+
+    async def __aenter__(self):
+        await self.create_connection()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close_connection()
+
+    async def create_connection(self):
+        if self.pool is not None:
+            logging.info("Database connection pool already exists")
+            return
+        try:
+            self.pool = AsyncConnectionPool(
+                make_conninfo(host=self.host, port=self.port, dbname=self.db_name, user=self.user,
+                              password=self.db_pass),
+                min_size=self.min_size,
+                max_size=self.max_size,
+                max_idle=self.max_idle,
+                timeout=self.checkout_timeout,
+                check=AsyncConnectionPool.check_connection if self.health_check else None,
+                kwargs={'autocommit': self.autocommit},
+                open=False,
+            )
+            await self.pool.open(wait=True)
+        except Exception as db_err:
+            self.pool = None
+            raise Exception(f"Error in making connection pool to db: {db_err}")
+
+    async def close_connection(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+            logging.debug("Database connection pool closed.")
+
+    @asynccontextmanager
+    async def session(self):
+        """
+        Connection and cursor checked out of the pool, committed on success and rolled back on error:
+            async with db.session() as (conn, cur):
+                await cur.execute(...)
+        Inside transaction(), the connection of the transaction is used and nothing is committed.
+        """
+        current = self._transaction.get()
+        if current is not None:
+            yield current
+            return
+        if self.pool is None:
+            await self.create_connection()
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                yield conn, cur
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Run the queries of the block (in this task) in a single transaction, committed at the end and rolled back
+        on error. A transaction() inside another one is a savepoint, rolled back alone on error.
+        :return: Cursor of the transaction
+        """
+        current = self._transaction.get()
+        if current is not None:
+            conn, cur = current
+            async with conn.transaction():
+                yield cur
+            return
+        async with self.session() as (conn, cur):
+            async with conn.transaction():
+                token = self._transaction.set((conn, cur))
+                try:
+                    yield cur
+                finally:
+                    self._transaction.reset(token)
+
+    @staticmethod
+    def log_error(query, error_msg=None):
+        """
+        Log the exception being handled, with error_msg if given.
+        """
+        if error_msg:
+            logging.exception(error_msg)
+        else:
+            logging.exception("Error occurred while executing query: %s", query)
+
+    async def execute_query(self, query, params=None, error_msg=None):
+        try:
+            logging.debug("Executing query %s", query)
+            async with self.session() as (_, cur):
+                await cur.execute(query, params)
+        except Exception as e:
+            self.log_error(query, error_msg)
+            raise e
+
+    async def fetchall_query(self, query, params=None, error_msg=None):
+        try:
+            logging.debug("Executing query %s", query)
+            async with self.session() as (_, cur):
+                await cur.execute(query, params)
+                return await cur.fetchall()
+        except Exception as e:
+            self.log_error(query, error_msg)
+            raise e
+
+    async def execute_and_fetchone_query(self, query, error_msg=None):
+        try:
+            logging.debug("Executing query %s", query)
+            async with self.session() as (_, cur):
+                await cur.execute(query)
+                return await cur.fetchone()
+        except Exception as e:
+            self.log_error(query, error_msg)
+            raise e
+
+    async def fetch_pipeline(self, queries, error_msg=None):
+        """
+        Run many queries on a single connection in pipeline mode: they are all sent before any result is read.
+        :param queries: List of (query, params)
+        :return: List of the rows of every query in order, None for the queries that return no rows
+        """
+        try:
+            async with self.session() as (conn, _):
+                cursors = []
+                async with conn.pipeline():
+                    for query, params in queries:
+                        cur = conn.cursor()
+                        await cur.execute(query, params)
+                        cursors.append(cur)
+                results = []
+                for cur in cursors:
+                    results.append(await cur.fetchall() if cur.description is not None else None)
+                    await cur.close()
+                return results
+        except Exception as e:
+            self.log_error(f'pipeline of {len(queries)} queries', error_msg)
+            raise e
+
+    async def iter_query(self, query, params=None, itersize=2000, batches=False, as_dicts=False, error_msg=None):
+        """
+        Stream the rows of a query from a named (server-side) cursor, memory stays bounded by itersize rows.
+        The connection is held until the generator is exhausted or closed.
+        :param itersize: Rows fetched per round trip
+        :param batches: Yield lists of up to itersize rows instead of single rows
+        :param as_dicts: Yield rows as dictionaries of column -> value
+        """
+        try:
+            logging.debug("Streaming query %s", query)
+            async with self.session() as (conn, _):
+                # Named cursors only live in a transaction
+                async with conn.transaction():
+                    name = f'iter_{uuid.uuid4().hex}'
+                    async with conn.cursor(name=name, row_factory=dict_row if as_dicts else None) as cur:
+                        cur.itersize = itersize
+                        await cur.execute(query, params)
+                        while True:
+                            rows = await cur.fetchmany(itersize)
+                            if not rows:
+                                break
+                            if batches:
+                                yield rows
+                            else:
+                                for row in rows:
+                                    yield row
+        except Exception as e:
+            self.log_error(query, error_msg)
+            raise e
+
+    @staticmethod
+    async def _aiter(rows):
+        if hasattr(rows, '__aiter__'):
+            async for row in rows:
+                yield row
+        else:
+            for row in rows:
+                yield row
+
+    async def _rows_and_columns(self, rows, columns):
+        """
+        :return: Async iterator of row tuples and the list of columns, taken from the keys of the first row for dicts
+        :raise StopAsyncIteration: No rows and no columns
+        """
+        rows = self._aiter(rows)
+        if columns is not None:
+            return rows, list(columns)
+        first = await rows.__anext__()
+        if not isinstance(first, dict):
+            raise Exception("columns are required unless the rows are dictionaries")
+        columns = list(first)
+
+        async def tuples():
+            yield tuple(first[column] for column in columns)
+            async for row in rows:
+                yield tuple(row[column] for column in columns)
+
+        return tuples(), columns
+
+    async def bulk_insert(self, table, rows, columns=None, page_size=1000, conflict_columns=None,
+                          update_columns=None):
+        """
+        Insert rows with executemany() in pipeline mode, page_size rows per batch, committed once at the end.
+        :param table: Table name, optionally qualified by its schema
+        :param rows: Iterable or async iterable of tuples in the order of columns, or of dictionaries
+        :param columns: Column names, the keys of the first row if None
+        :param page_size: Rows sent per batch
+        :param conflict_columns: Columns of the unique constraint to upsert on, None for a plain insert
+        :param update_columns: Columns updated on conflict, nothing is done on conflict if None
+        :return: Number of rows sent
+        """
+        try:
+            rows, columns = await self._rows_and_columns(rows, columns)
+        except StopAsyncIteration:
+            return 0
+        query = sql.SQL("INSERT INTO {table} ({columns}) VALUES ({values})").format(
+            table=table_identifier(table),
+            columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+            values=sql.SQL(', ').join(sql.Placeholder() * len(columns)),
+        )
+        if conflict_columns:
+            action = sql.SQL("DO NOTHING")
+            if update_columns:
+                action = sql.SQL("DO UPDATE SET {}").format(sql.SQL(', ').join(
+                    sql.SQL("{column} = EXCLUDED.{column}").format(column=sql.Identifier(column))
+                    for column in update_columns
+                ))
+            query = sql.SQL("{query} ON CONFLICT ({conflict}) {action}").format(
+                query=query, conflict=sql.SQL(', ').join(map(sql.Identifier, conflict_columns)), action=action
+            )
+
+        count = 0
+        try:
+            async with self.transaction() as cur:
+                page = []
+                async for row in rows:
+                    page.append(row)
+                    if len(page) >= page_size:
+                        await cur.executemany(query, page)
+                        count += len(page)
+                        page = []
+                if page:
+                    await cur.executemany(query, page)
+                    count += len(page)
+        except Exception as e:
+            logging.exception("Error occurred while bulk inserting into %s", table)
+            raise e
+        logging.debug(f"Inserted {count} rows into {table}.")
+        return count
+
+    async def copy_from_iter(self, table, rows, columns=None):
+        """
+        Stream rows into a table with COPY FROM STDIN, in a single transaction.
+        :param table: Table name, optionally qualified by its schema
+        :param rows: Iterable or async iterable of tuples in the order of columns, or of dictionaries
+        :param columns: Column names, the keys of the first row if None
+        :return: Number of rows copied
+        """
+        try:
+            rows, columns = await self._rows_and_columns(rows, columns)
+        except StopAsyncIteration:
+            return 0
+        query = sql.SQL("COPY {table} ({columns}) FROM STDIN").format(
+            table=table_identifier(table),
+            columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+        )
+        count = 0
+        try:
+            async with self.transaction() as cur:
+                async with cur.copy(query) as copy:
+                    async for row in rows:
+                        await copy.write_row(row)
+                        count += 1
+        except Exception as e:
+            logging.exception("Error occurred while copying into %s", table)
+            raise e
+        logging.debug(f"Copied {count} rows into {table}.")
+        return count
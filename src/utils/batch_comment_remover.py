@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Strip comments from whole source trees in parallel, using comment_remover.
+
+    Files are picked by extension (see __EXTENSIONS__), read and stripped by a pool of worker processes in chunks of
+    files, and written to a mirror tree or streamed as JSON lines ({"path", "lang", "source"}).
+
+    Usage:
+        $python3 -m src.utils.batch_comment_remover --input <src_dir> --output <mirror_dir>
+        $python3 -m src.utils.batch_comment_remover --input <src_dir> --jsonl stripped.jsonl --processes 16
+
+        stats = strip_tree(Path('repo'), output_dir=Path('repo_stripped'))
+        for path, lang, source in iter_stripped(Path('repo')):
+            ...
+
+    Per-language throughput is reported at the end: files, MB, worker time and MB/s per core.
+
+    With --cache <sqlite file>, results are cached by content hash (see src.utils.comment_cache): a re-run over a
+    mostly unchanged tree only reads and hashes the files, the cached files are counted in the `cached` column.
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import multiprocessing
+from time import monotonic
+from pathlib import Path
+from functools import partial
+from src.utils.comment_remover import comment_remover
+from src.utils.comment_cache import CommentCache, __MISS__
+from src.utils.file_handlers import read_file, save_file
+
+
+__author__ = "Mohammed Ataaur Rahaman"
+
+
+# File extension -> lang code of comment_remover
+__EXTENSIONS__ = {
+    '.py': 'py',
+    '.c': 'c',
+    '.h': 'c',
+    '.cpp': 'cpp',
+    '.cc': 'cpp',
+    '.cxx': 'cpp',
+    '.hpp': 'cpp',
+    '.hh': 'cpp',
+    '.cs': 'cs',
+    '.js': 'js',
+    '.mjs': 'js',
+    '.cjs': 'js',
+    '.java': 'java',
+    '.sql': 'sql',
+}
+# Max files handed to a worker at once, smaller chunks are used to keep every worker busy on small trees
+__CHUNK_SIZE__ = 64
+
+log = logging.getLogger(__name__)
+
+# Cache of the worker process, set by the pool initializer so its memory tier lives as long as the worker
+_worker_cache = None
+
+
+def init_worker(cache):
+    global _worker_cache
+    _worker_cache = cache
+
+
+def iter_source_files(root, extensions=None):
+    """
+    Walk a directory and yield the files with a known extension, hidden files and directories are skipped.
+    :param root: Directory to walk
+    :param extensions: Dictionary of extension -> lang, __EXTENSIONS__ if None
+    :return: Generator of (path, lang)
+    """
+    extensions = extensions or __EXTENSIONS__
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+        for name in sorted(file_names):
+            if name.startswith('.'):
+                continue
+            lang = extensions.get(os.path.splitext(name)[1].lower())
+            if lang is not None:
+                yield Path(dir_path) / name, lang
+
+
+def strip_file(task, root=None, output_dir=None, keep_source=False, cache=None):
+    """
+    Worker: strip the comments of one file.
+    :param task: (path, lang)
+    :param root: Input directory, to mirror the path of the file under output_dir
+    :param output_dir: Directory of the mirror tree, None to not write the result
+    :param keep_source: Return the stripped source (e.g. for JSON lines)
+    :param cache: CommentCache to look the result up in, the cache of the worker if None
+    :return: Dictionary of path, lang, bytes, seconds, error, cache (tier of the hit, 'miss' or None without a
+             cache) and the stripped source if keep_source
+    """
+    path, lang = task
+    cache = _worker_cache if cache is None else cache
+    start = monotonic()
+    result = {'path': str(path), 'lang': lang, 'bytes': 0, 'error': None, 'cache': None}
+    try:
+        source = read_file(path)
+        result['bytes'] = len(source.encode('utf-8'))
+        if cache is None:
+            stripped = comment_remover(source, lang)
+        else:
+            stripped, result['cache'] = cache.lookup(source, lang)
+        if output_dir is not None:
+            save_file(output_dir / Path(path).relative_to(root), stripped)
+        if keep_source:
+            result['source'] = stripped
+    except Exception as err:
+        result['error'] = str(err)
+    result['seconds'] = monotonic() - start
+    return result
+
+
+def run_pool(tasks, processes=None, chunksize=None, cache=None, **kwargs):
+    """
+    Strip files on a process pool, results come back as soon as a chunk of files is done.
+    :param tasks: Iterable of (path, lang)
+    :param processes: Worker processes, the number of CPUs if None
+    :param chunksize: Files handed to a worker at once, None for about 8 chunks per worker up to __CHUNK_SIZE__
+    :param cache: CommentCache, every worker gets a copy with its own memory tier and shares the disk tier
+    :param kwargs: Arguments of strip_file
+    :return: Generator of strip_file results, in completion order
+    """
+    processes = processes or os.cpu_count() or 1
+    if chunksize is None:
+        tasks = list(tasks)
+        chunksize = max(1, min(__CHUNK_SIZE__, len(tasks) // (processes * 8)))
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(cache,)) as pool:
+        yield from pool.imap_unordered(partial(strip_file, **kwargs), tasks, chunksize=chunksize)
+
+
+def iter_stripped(root, extensions=None, processes=None, chunksize=None, cache=None):
+    """
+    :return: Generator of (path, lang, stripped source) for every source file of root, failed files are skipped
+    """
+    tasks = iter_source_files(root, extensions)
+    for result in run_pool(tasks, processes, chunksize, cache, root=root, keep_source=True):
+        if result['error'] is None:
+            yield result['path'], result['lang'], result['source']
+
+
+def strip_tree(root, output_dir=None, jsonl=None, extensions=None, processes=None, chunksize=None, cache=None):
+    """
+    Strip the comments of every source file of a directory.
+    :param root: Input directory
+    :param output_dir: Directory of the mirror tree, None to not write one
+    :param jsonl: Writable text file to stream {"path", "lang", "source"} lines to, None to not write them
+    :param extensions: Dictionary of extension -> lang, __EXTENSIONS__ if None
+    :param processes: Worker processes, the number of CPUs if None
+    :param chunksize: Files handed to a worker at once, None to size the chunks from the number of files
+    :param cache: CommentCache of the results, None to strip every file
+    :return: Dictionary of lang -> {'files', 'bytes', 'seconds', 'errors', 'cached'}, plus 'wall_time' for the
+             whole run
+    """
+    root = Path(root)
+    tasks = iter_source_files(root, extensions)
+    stats = {}
+    start = monotonic()
+    for result in run_pool(tasks, processes, chunksize, cache, root=root, output_dir=output_dir,
+                           keep_source=jsonl is not None):
+        lang_stats = stats.setdefault(
+            result['lang'], {'files': 0, 'bytes': 0, 'seconds': 0.0, 'errors': 0, 'cached': 0}
+        )
+        lang_stats['files'] += 1
+        if result['cache'] not in (None, __MISS__):
+            lang_stats['cached'] += 1
+        lang_stats['bytes'] += result['bytes']
+        lang_stats['seconds'] += result['seconds']
+        if result['error'] is not None:
+            lang_stats['errors'] += 1
+            log.warning(f"Failed to strip {result['path']}: {result['error']}")
+        elif jsonl is not None:
+            jsonl.write(json.dumps(
+                {'path': str(Path(result['path']).relative_to(root)), 'lang': result['lang'],
+                 'source': result['source']},
+                ensure_ascii=False
+            ) + '\n')
+    stats['wall_time'] = monotonic() - start
+    return stats
+
+
+def print_stats(stats, file=sys.stderr):
+    """
+    Print the per-language throughput of strip_tree.
+    """
+    wall_time = stats['wall_time']
+    langs = {lang: lang_stats for lang, lang_stats in stats.items() if lang != 'wall_time'}
+    print(f"{'lang':<6} {'files':>9} {'cached':>9} {'MB':>10} {'errors':>7} {'cpu s':>9} {'MB/s/core':>10}",
+          file=file)
+    for lang, lang_stats in sorted(langs.items()):
+        mb = lang_stats['bytes'] / 1e6
+        rate = mb / lang_stats['seconds'] if lang_stats['seconds'] else 0
+        print(
+            f"{lang:<6} {lang_stats['files']:>9} {lang_stats['cached']:>9} {mb:>10.2f} {lang_stats['errors']:>7} "
+            f"{lang_stats['seconds']:>9.2f} {rate:>10.2f}", file=file
+        )
+    total_mb = sum(lang_stats['bytes'] for lang_stats in langs.values()) / 1e6
+    total_files = sum(lang_stats['files'] for lang_stats in langs.values())
+    print(
+        f"Total: {total_files} files, {total_mb:.2f} MB in {wall_time:.2f}s "
+        f"({total_mb / wall_time if wall_time else 0:.2f} MB/s)", file=file
+    )
+
+
+def get_args():
+    """
+    Get args when running with command line interface
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.version = '1.0.0'
+
+    arg_parser.add_argument('-i', '--input', action='store', type=Path, required=True, help='Directory to strip.')
+    arg_parser.add_argument('-o', '--output', action='store', type=Path, default=None,
+                            help='Write the stripped files to this mirror directory.')
+    arg_parser.add_argument('-j', '--jsonl', action='store', type=str, default=None,
+                            help='Stream the stripped files as JSON lines to this file, - for stdout.')
+    arg_parser.add_argument('-p', '--processes', action='store', type=int, default=None,
+                            help='Worker processes, the number of CPUs by default.')
+    arg_parser.add_argument('-c', '--chunksize', action='store', type=int, default=None,
+                            help=f'Files handed to a worker at once, sized from the number of files by default '
+                                 f'(up to {__CHUNK_SIZE__}).')
+    arg_parser.add_argument('-e', '--extension', action='append', type=str, default=[],
+                            help='Extra extension to lang mapping, e.g. -e .jsx=js (repeatable).')
+    arg_parser.add_argument('--cache', action='store', type=str, default=None,
+                            help='sqlite file caching the results by content hash, kept across runs.')
+
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = get_args()
+
+    extension_map = dict(__EXTENSIONS__)
+    for mapping in args.extension:
+        extension, lang_code = mapping.split('=', 1)
+        extension_map[extension if extension.startswith('.') else f'.{extension}'] = lang_code
+
+    comment_cache = CommentCache(path=args.cache) if args.cache else None
+    if args.jsonl is None:
+        run_stats = strip_tree(args.input, output_dir=args.output, extensions=extension_map,
+                               processes=args.processes, chunksize=args.chunksize, cache=comment_cache)
+    elif args.jsonl == '-':
+        run_stats = strip_tree(args.input, output_dir=args.output, jsonl=sys.stdout, extensions=extension_map,
+                               processes=args.processes, chunksize=args.chunksize, cache=comment_cache)
+    else:
+        with open(args.jsonl, 'w', encoding='utf-8') as jsonl_file:
+            run_stats = strip_tree(args.input, output_dir=args.output, jsonl=jsonl_file, extensions=extension_map,
+                                   processes=args.processes, chunksize=args.chunksize, cache=comment_cache)
+    print_stats(run_stats)
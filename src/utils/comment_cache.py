@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Content-hash cache in front of comment_remover.
+
+    Results are keyed by a hash of the source and its lang, so an unchanged file is stripped once: later calls, and
+    later runs with the on-disk tier, only hash it. Two tiers are looked up in order:
+        * memory - LRU of the most recent results, bounded by entries and by total size.
+        * disk - optional sqlite file (WAL) shared by processes and runs.
+
+    Usage:
+        cache = CommentCache(path=Path('.cache/comments.sqlite'))
+        stripped = cache.comment_remover(source, 'py')
+        print(cache.stats())  # {'hits': .., 'disk_hits': .., 'misses': .., 'hit_ratio': .., ...}
+
+        $python3 -m src.utils.batch_comment_remover --input <src_dir> --output <mirror_dir> --cache comments.sqlite
+
+    Bump __CACHE_VERSION__ when the output of comment_remover changes, older results are then never read again.
+"""
+
+import os
+import sqlite3
+import hashlib
+import logging
+import threading
+from time import time
+from collections import OrderedDict
+from src.utils.comment_remover import comment_remover
+
+
+__author__ = "Mohammed Ataaur Rahaman"
+
+
+__CACHE_VERSION__ = 4
+__MEMORY__ = 'memory'
+__DISK__ = 'disk'
+__MISS__ = 'miss'
+
+log = logging.getLogger(__name__)
+
+
+def content_key(source, lang):
+    """
+    :return: Hex digest of the cache version, lang and source
+    """
+    digest = hashlib.blake2b(f'{__CACHE_VERSION__}:{lang}:'.encode('utf-8'), digest_size=20)
+    digest.update(source.encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+
+class CommentCache:
+
+    def __init__(self, max_items=4096, max_size=64 * 1024 * 1024, path=None):
+        """
+        :param max_items: Max results kept in memory
+        :param max_size: Max total length (characters) of the results kept in memory
+        :param path: sqlite file of the on-disk tier, None to only cache in memory
+        """
+        self.max_items = max_items
+        self.max_size = max_size
+        self.path = path
+        self.lru = OrderedDict()  # key -> stripped source, most recently used last
+        self.size = 0
+        self.counts = {__MEMORY__: 0, __DISK__: 0, __MISS__: 0}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # sqlite connections can't cross process or thread boundaries, every worker opens its own.
+        state = self.__dict__.copy()
+        del state['_local'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS comments ("
+                " key TEXT PRIMARY KEY,"
+                " lang TEXT NOT NULL,"
+                " source TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+        return conn
+
+    def _remember(self, key, stripped):
+        with self._lock:
+            if key in self.lru:
+                self.size -= len(self.lru.pop(key))
+            if len(stripped) > self.max_size:
+                return
+            self.lru[key] = stripped
+            self.size += len(stripped)
+            while len(self.lru) > self.max_items or self.size > self.max_size:
+                self.size -= len(self.lru.popitem(last=False)[1])
+
+    def get(self, key):
+        """
+        :return: (cached stripped source, __MEMORY__ or __DISK__), (None, __MISS__) if neither tier has it
+        """
+        with self._lock:
+            stripped = self.lru.get(key)
+            if stripped is not None:
+                self.lru.move_to_end(key)
+                return stripped, __MEMORY__
+        if self.path is not None:
+            try:
+                row = self.conn.execute("SELECT source FROM comments WHERE key = ?", (key,)).fetchone()
+            except (sqlite3.Error, OSError) as err:
+                log.warning(f"Failed to read the comment cache {self.path}: {err}")
+                row = None
+            if row is not None:
+                self._remember(key, row[0])
+                return row[0], __DISK__
+        return None, __MISS__
+
+    def put(self, key, lang, stripped):
+        self._remember(key, stripped)
+        if self.path is not None:
+            try:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO comments (key, lang, source, created_at) VALUES (?, ?, ?, ?)",
+                    (key, lang, stripped, time())
+                )
+            except (sqlite3.Error, OSError) as err:
+                log.warning(f"Failed to write the comment cache {self.path}: {err}")
+
+    def lookup(self, source, lang):
+        """
+        Strip the comments of source, from the cache when it has the result.
+        :return: (comment cleaned source code, __MEMORY__, __DISK__ or __MISS__)
+        """
+        key = content_key(source, lang)
+        stripped, tier = self.get(key)
+        if stripped is None:
+            stripped = comment_remover(source, lang)
+            self.put(key, lang, stripped)
+        with self._lock:
+            self.counts[tier] += 1
+        return stripped, tier
+
+    def comment_remover(self, source, lang):
+        """
+        Cached comment_remover(source, lang).
+        """
+        return self.lookup(source, lang)[0]
+
+    def stats(self):
+        """
+        :return: Dictionary of hits (memory), disk_hits, misses, hit_ratio and the size of the memory tier
+        """
+        with self._lock:
+            calls = sum(self.counts.values())
+            return {
+                'hits': self.counts[__MEMORY__],
+                'disk_hits': self.counts[__DISK__],
+                'misses': self.counts[__MISS__],
+                'hit_ratio': (calls - self.counts[__MISS__]) / calls if calls else 0.0,
+                'items': len(self.lru),
+                'size': self.size,
+            }
+
+    def clear(self):
+        """
+        Drop every cached result, of both tiers.
+        """
+        with self._lock:
+            self.lru.clear()
+            self.size = 0
+        if self.path is not None:
+            try:
+                self.conn.execute("DELETE FROM comments")
+            except (sqlite3.Error, OSError) as err:
+                log.warning(f"Failed to clear the comment cache {self.path}: {err}")
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local = threading.local()
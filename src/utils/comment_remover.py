@@ -7,9 +7,229 @@ Remove comments from source files
 
 import re
 import tokenize
-import sqlparse
 
 from io import StringIO
+from functools import partial
+
+try:
+    import sqlparse
+except ImportError:
+    sqlparse = None
+
+
+__C_FAMILY__ = ('c', 'cpp', 'cs', 'js', 'java')
+
+
+def c_family_lexer(lang):
+    """
+    Compile the comment lexer of a C-family language: a single regex scanning the source left to right, where
+    every match is the code up to the next comment, in the `keep` group, followed by that comment. Code is
+    unrolled as runs of plain characters between literals, a lone quote or a division, so the regex engine makes
+    one match per comment rather than one per token. Every alternative starts with a fixed character and repeats
+    character classes with no overlap with what follows, so the regex never backtracks more than a token and the
+    scan is linear in the size of the source.
+    :param lang: One of __C_FAMILY__
+    :return: Compiled pattern, sub(r"\g<keep>", source) removes the comments
+    """
+    # A quote after an identifier or a number is no 'c'har but a digit separator (C++14 1'000'000)
+    char_start = r"(?<!\w)'"
+    if lang in ('c', 'cpp'):
+        # L'c', u'c', U'c' and u8'c' prefixes
+        char_start = r"(?:(?<!\w)|(?<=(?<!\w)[LuU])|(?<=(?<!\w)u8))'"
+    literals = [
+        # "string" and 'c'har, an escaped newline continues them
+        r'"[^"\\\n]*(?:\\[\s\S][^"\\\n]*)*"',
+        char_start + r"[^'\\\n]*(?:\\[\s\S][^'\\\n]*)*'",
+    ]
+    stops = '"\''
+    line_comment = r'//[^\n]*'
+    if lang in ('c', 'cpp'):
+        # R"delim( raw string )delim", and line comments continued by a backslash-newline
+        literals.insert(0, r'R"(?P<delimiter>[^()\\\s]{0,16})\([\s\S]*?\)(?P=delimiter)"')
+        stops += 'R'
+        line_comment = r'//[^\n\\]*(?:\\[\s\S][^\n\\]*)*'
+    elif lang == 'cs':
+        # @"verbatim string" where "" is a quote
+        literals.insert(0, r'@"[^"]*(?:""[^"]*)*"')
+        stops += '@'
+    elif lang == 'js':
+        # `template literal`
+        literals.insert(0, r'`[^`\\]*(?:\\[\s\S][^`\\]*)*`')
+        stops += '`'
+    elif lang == 'java':
+        # """text block"""
+        literals.insert(0, r'"""[^"\\]*(?:(?:\\[\s\S]|"(?!""))[^"\\]*)*"""')
+
+    code = '[^/' + re.escape(stops) + ']*'
+    # A literal, else a lone quote or prefix character, or a slash starting no comment
+    token = '(?:' + '|'.join(literals) + '|[' + re.escape(stops) + r']|/(?![/*]))'
+    return re.compile(
+        '(?P<keep>' + code + '(?:' + token + code + ')*)'
+        + '(?:' + line_comment
+        + r'|/\*[^*]*\*+(?:[^/*][^*]*\*+)*/'  # /* block comment */
+        + r'|/\*[\s\S]*'  # Unterminated block comment, up to the end
+        + ')?'
+    )
+
+
+# Compiled once, shared by every call
+__C_FAMILY_LEXERS__ = {lang: c_family_lexer(lang) for lang in __C_FAMILY__}
+
+# Characters of SQL source read at once by sql_comments_file()
+__SQL_CHUNK_SIZE__ = 1048576
+# Start of a comment, string literal, quoted identifier or $tag$ dollar quote. An E'' string is a quote after an E
+# that does not end a word, so the two characters before the search position are kept as context.
+__SQL_TOKENS__ = re.compile(
+    r"(?P<line>--)|(?P<block>/\*)"
+    r"|(?<=[^\w$][Ee])(?P<escaped>')|(?P<string>')"
+    r"|(?P<identifier>[\"`])"
+    r"|(?<![\w$])(?P<dollar>\$(?:[^\W\d]\w*)?\$)"
+)
+# End of a chunk that may be the start of a token continued by the next chunk
+__SQL_PARTIAL__ = re.compile(r"(?:[-/]|\$(?:[^\W\d]\w*)?)\Z")
+# Body of a string with backslash escapes, up to its closing quote or a backslash ending the chunk
+__SQL_ESCAPED_BODY__ = re.compile(r"[^'\\]*(?:\\[\s\S][^'\\]*)*")
+
+
+def sql_code_run(backslash_escapes):
+    """
+    Compile the fast path of SqlCommentLexer: plain code and complete literals, up to the next comment or the next
+    character that needs more context (a -, / or $ ending the chunk, an unterminated literal).
+    :param backslash_escapes: Backslashes escape quotes in every string literal
+    """
+    escaped = r"'[^'\\]*(?:\\[\s\S][^'\\]*)*'"
+    plain = escaped if backslash_escapes else r"(?<![^\w$][Ee])'[^']*'"
+    return re.compile(
+        r"(?:[^-/'\"`$]+"
+        r"|-(?=[^-])|/(?=[^*])"
+        + r"|" + plain
+        + r"|(?<=[^\w$][Ee])" + escaped
+        + r"|\"[^\"]*\"|`[^`]*`"
+        r"|(?<![\w$])\$(?P<tag>(?:[^\W\d]\w*)?)\$[\s\S]*?\$(?P=tag)\$"
+        r"|(?<=[\w$])\$|\$(?=[^\w$])|\$(?=\d)"
+        r")*"
+    )
+
+
+__SQL_CODE_RUNS__ = {backslash_escapes: sql_code_run(backslash_escapes) for backslash_escapes in (False, True)}
+# End of a -- comment, as in postgres: the \r of a \r\n is kept with the newline
+__SQL_LINE_END__ = re.compile(r"[\r\n]")
+__SQL_NESTED_BLOCK__ = re.compile(r"/\*|\*/")
+__SQL_BLOCK_END__ = re.compile(r"\*/")
+
+
+class SqlCommentLexer:
+    """
+    Streaming lexer removing the -- and /* */ comments of SQL source code fed in chunks of any size, in a single
+    linear pass. String literals ('', E'' with backslash escapes), quoted identifiers ("", ``) and dollar-quoted
+    bodies ($$ $$, $tag$ $tag$) are kept as they are. Line comments keep their newline, block comments become a
+    space unless they follow one. Only the few characters of a token cut by the end of a chunk are held until the
+    next chunk, memory stays bounded by the chunk size.
+        lexer = SqlCommentLexer()
+        for chunk in chunks:
+            out.write(lexer.feed(chunk))
+        out.write(lexer.feed('', final=True))
+    """
+
+    def __init__(self, nested_comments=True, backslash_escapes=False):
+        """
+        :param nested_comments: /* */ comments nest, as in postgres
+        :param backslash_escapes: Backslashes escape quotes in every string literal, as in mysql, else only in E''
+        """
+        self.nested_comments = nested_comments
+        self.backslash_escapes = backslash_escapes
+        self.state = None  # None for code, else the token being read: line, block, escaped, string, identifier, dollar
+        self.closer = None  # Closing quote of an identifier or closing tag of a dollar quote
+        self.depth = 0  # Nesting of the block comment
+        self.context = '\n\n'  # Last two characters of source before the pending ones
+        self.pending = ''
+        self.last = '\n'  # Last character written out
+
+    def feed(self, chunk, final=False):
+        """
+        :param chunk: Next piece of source code
+        :param final: No more source follows, unterminated comments are dropped and literals written out
+        :return: Comment cleaned source code of the chunk, up to the last complete token
+        """
+        buffer = self.context + self.pending + chunk
+        pos = len(self.context)
+        out = []
+        while pos < len(buffer):
+            state = self.state
+            if state is None:
+                end = __SQL_CODE_RUNS__[self.backslash_escapes].match(buffer, pos).end()
+                out.append(buffer[pos:end])
+                pos = end
+                match = __SQL_TOKENS__.search(buffer, pos)
+                if match is None:
+                    end = len(buffer)
+                    partial_token = None if final else __SQL_PARTIAL__.search(buffer, pos)
+                    if partial_token is not None:
+                        end = partial_token.start()
+                    out.append(buffer[pos:end])
+                    pos = end
+                    break
+                out.append(buffer[pos:match.start()])
+                pos = match.end()
+                kind = match.lastgroup
+                if kind == 'line':
+                    self.state = kind
+                elif kind == 'block':
+                    self.state, self.depth = kind, 1
+                else:
+                    out.append(match.group())
+                    if kind == 'string' and self.backslash_escapes:
+                        kind = 'escaped'
+                    self.state, self.closer = kind, match.group()
+            elif state == 'line':
+                match = __SQL_LINE_END__.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer)
+                    break
+                self.state, pos = None, match.start()
+            elif state == 'block':
+                pattern = __SQL_NESTED_BLOCK__ if self.nested_comments else __SQL_BLOCK_END__
+                match = pattern.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer) if final or buffer[-1] not in '/*' else len(buffer) - 1
+                    break
+                pos = match.end()
+                self.depth += 1 if match.group() == '/*' else -1
+                if not self.depth:
+                    self.state = None
+                    last = next((piece[-1] for piece in reversed(out) if piece), self.last)
+                    if not last.isspace():
+                        out.append(' ')
+            elif state == 'escaped':
+                end = __SQL_ESCAPED_BODY__.match(buffer, pos).end()
+                if end < len(buffer) and buffer[end] == "'":
+                    out.append(buffer[pos:end + 1])
+                    self.state, pos = None, end + 1
+                else:
+                    # Up to the end, or a backslash ending the chunk whose escaped character is in the next one
+                    end = len(buffer) if final else end
+                    out.append(buffer[pos:end])
+                    pos = end
+                    break
+            else:
+                # '' in a string or "" in an identifier closes and reopens it, which writes out the same
+                closer = "'" if state == 'string' else self.closer
+                end = buffer.find(closer, pos)
+                if end < 0:
+                    # A dollar tag may be cut by the end of the chunk
+                    end = len(buffer) if final else max(pos, len(buffer) - len(closer) + 1)
+                    out.append(buffer[pos:end])
+                    pos = end
+                    break
+                out.append(buffer[pos:end + len(closer)])
+                self.state, pos = None, end + len(closer)
+
+        self.context = buffer[pos - 2:pos]
+        self.pending = buffer[pos:]
+        result = ''.join(out)
+        if result:
+            self.last = result[-1]
+        return result
 
 
 def python_comments(source):
@@ -33,26 +253,90 @@ def java_comments(source):
     :param source: java source code string
     :return: comment cleaned java code as string
     """
-    reg_java = re.compile("(?:/\\*(?:[^*]|(?:\\*+[^*/]))*\\*+/)|(?://.*)")
-    return re.sub(reg_java, "", source)
+    return c_family_comments(source, "java")
 
 
-def sql_comments(source):
+def sql_comments(source, mode="lexer", **kwargs):
     """
     Remove comments from sql source code
     :param source: sql source code string
+    :param mode: lexer (SqlCommentLexer, linear) or sqlparse (full tokenize and format of the statements, slow)
+    :param kwargs: Dialect arguments of SqlCommentLexer
     :return: comment cleaned sql code as string
     """
-    return sqlparse.format(source, strip_comments=True).strip()
+    if mode == "sqlparse":
+        if sqlparse is None:
+            raise Exception("sql_comments in sqlparse mode needs the sqlparse package")
+        return sqlparse.format(source, strip_comments=True).strip()
+    return SqlCommentLexer(**kwargs).feed(source, final=True).strip()
+
+
+def sql_comments_file(file_path, out=None, chunk_size=__SQL_CHUNK_SIZE__, **kwargs):
+    """
+    Same as sql_comments(read_file(file_path)), with the file read and lexed in chunks: memory stays bounded by
+    chunk_size when the result is written to out, e.g. for multi-GB dumps.
+    :param file_path: Path of a sql source file
+    :param out: Writable text file to stream the result to, None to return it as a string
+    :param chunk_size: Characters read at once
+    :param kwargs: Dialect arguments of SqlCommentLexer
+    :return: Comment cleaned sql code as string, None if written to out
+    """
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        pieces = stripped_pieces(sql_chunks(f, chunk_size, **kwargs))
+        if out is None:
+            return "".join(pieces)
+        out.writelines(pieces)
+
+
+def sql_chunks(f, chunk_size=__SQL_CHUNK_SIZE__, **kwargs):
+    """
+    :param f: Readable text file of sql source code
+    :return: Generator of the comment cleaned pieces of the source, chunk by chunk
+    """
+    lexer = SqlCommentLexer(**kwargs)
+    for chunk in iter(partial(f.read, chunk_size), ""):
+        yield lexer.feed(chunk)
+    yield lexer.feed("", final=True)
+
+
+def stripped_pieces(pieces):
+    """
+    Pieces of a text as str.strip() would leave it: leading whitespace dropped and trailing whitespace held until
+    more text follows.
+    """
+    started, blanks = False, ""
+    for piece in pieces:
+        if not started:
+            piece = piece.lstrip()
+            started = bool(piece)
+        body = piece.rstrip()
+        if not body:
+            blanks += piece
+            continue
+        yield blanks + body
+        blanks = piece[len(body):]
 
 
-def c_style_comments(source):
+def c_style_comments(source, lang="cpp"):
     """
     Remove comments from C++ source code
     :param source: cpp source code string
+    :param lang: c, cpp, cs or js, for their literals
     :return: comment cleaned cpp code as string
     """
-    return re.sub('//.*?((?<!\\\)\n|$)|/\*.*?\*/', '', source, flags=re.S)
+    return c_family_comments(source, lang)
+
+
+def c_family_comments(source, lang):
+    """
+    Remove the // and /* */ comments of C, C++, C#, JavaScript or Java source code in a single linear pass.
+    Comment markers inside string, char, template, raw and verbatim literals are kept, line comments keep their
+    newline.
+    :param source: source code string
+    :param lang: One of __C_FAMILY__
+    :return: comment cleaned source code as string
+    """
+    return __C_FAMILY_LEXERS__[lang].sub(r"\g<keep>", source)
 
 
 def comment_remover(source, lang):
@@ -64,12 +348,10 @@ def comment_remover(source, lang):
     """
     if lang == "py":
         return python_comments(source)
-    elif lang == "cpp" or lang == "cs" or lang == "js" or lang == "c":
-        return c_style_comments(source)
+    elif lang in __C_FAMILY__:
+        return c_family_comments(source, lang)
     elif lang == "sql":
         return sql_comments(source)
-    elif lang == "java":
-        return java_comments(source)
     else:
         return source
 
@@ -79,17 +361,59 @@ def remove_comments_and_docstrings(source):
     Returns 'source' minus comments and docstrings.
     """
     source = str.strip(source)
-    io_obj = StringIO(source)
-    out = ""
+    return "".join(strip_tokens(StringIO(source).readline))
+
+
+def remove_comments_and_docstrings_file(file_path, out=None):
+    """
+    Same as remove_comments_and_docstrings(read_file(file_path)), with the tokens streamed from the file.
+    :param file_path: Path of a python source file
+    :param out: Writable text file to stream the result to, None to return it as a string
+    :return: Comment cleaned python code as string, None if written to out
+    """
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        pieces = strip_tokens(partial(next, stripped_lines(f), ""))
+        if out is None:
+            return "".join(pieces)
+        out.writelines(pieces)
+
+
+def stripped_lines(lines):
+    """
+    Lines as str.strip() would leave them on the whole text: leading and trailing blank lines dropped, first line
+    left-stripped and last line right-stripped. Streamed, only the blank lines after the current one are held.
+    :param lines: Iterable of lines, e.g. a file
+    """
+    lines = iter(lines)
+    for line in lines:
+        if line.strip():
+            break
+    else:
+        return
+    line = line.lstrip()
+    blanks = []
+    for next_line in lines:
+        if not next_line.strip():
+            blanks.append(next_line)
+            continue
+        yield line
+        yield from blanks
+        blanks = []
+        line = next_line
+    yield line.rstrip()
+
+
+def strip_tokens(readline):
+    """
+    Tokenize python source code and yield the pieces of the output of remove_comments_and_docstrings(),
+    the output is built by joining them once instead of growing a string per token.
+    :param readline: readline of the source, as tokenize.generate_tokens() takes it
+    """
     prev_toktype = tokenize.INDENT
     last_lineno = -1
     last_col = 0
-    for tok in tokenize.generate_tokens(io_obj.readline):
-        token_type = tok[0]
-        token_string = tok[1]
-        start_line, start_col = tok[2]
-        end_line, end_col = tok[3]
-        ltext = tok[4]
+    for token_type, token_string, (start_line, start_col), (end_line, end_col), _ in \
+            tokenize.generate_tokens(readline):
         # The following two conditionals preserve indentation.
         # This is necessary because we're not using tokenize.untokenize()
         # (because it spits out code with copious amounts of oddly-placed
@@ -97,36 +421,27 @@ def remove_comments_and_docstrings(source):
         if start_line > last_lineno:
             last_col = 0
         if start_col > last_col:
-            out += (" " * (start_col - last_col))
+            yield " " * (start_col - last_col)
         # Remove comments:
         if token_type == tokenize.COMMENT:
             pass
         # This series of conditionals removes docstrings:
         elif token_type == tokenize.STRING:
-            if prev_toktype != tokenize.INDENT:
-        # This is likely a docstring; double-check we're not inside an operator:
-                if prev_toktype != tokenize.NEWLINE:
-                    # Note regarding NEWLINE vs NL: The tokenize module
-                    # differentiates between newlines that start a new statement
-                    # and newlines inside of operators such as parens, brackes,
-                    # and curly braces.  Newlines inside of operators are
-                    # NEWLINE and newlines that start new code are NL.
-                    # Catch whole-module docstrings:
-                    if start_col > 0:
-                        # Unlabelled indentation means we're inside an operator
-                        out += token_string
-                    # Note regarding the INDENT token: The tokenize module does
-                    # not label indentation inside of an operator (parens,
-                    # brackets, and curly braces) as actual indentation.
-                    # For example:
-                    # def foo():
-                    #     "The spaces before this docstring are tokenize.INDENT"
-                    #     test = [
-                    #         "The spaces before this string do not get a token"
-                    #     ]
+            # A string right after an INDENT or a NEWLINE (a new statement) is likely a docstring.
+            # Note regarding NEWLINE vs NL: The tokenize module differentiates between newlines that start
+            # a new statement (NEWLINE) and newlines inside of operators such as parens, brackets and
+            # curly braces (NL). The tokenize module does not label indentation inside of an operator as
+            # actual indentation either, so a string there is kept:
+            # def foo():
+            #     "The spaces before this docstring are tokenize.INDENT"
+            #     test = [
+            #         "The spaces before this string do not get a token"
+            #     ]
+            # Whole-module docstrings start at column 0 and are removed too.
+            if prev_toktype != tokenize.INDENT and prev_toktype != tokenize.NEWLINE and start_col > 0:
+                yield token_string
         else:
-            out += token_string
+            yield token_string
         prev_toktype = token_type
         last_col = end_col
         last_lineno = end_line
-    return out
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Micro-benchmark of comment_remover on large inputs.
+
+    Usage:
+        $python3 -m src.utils.comment_remover_benchmark --sizes 1 4 16
+        $python3 -m src.utils.comment_remover_benchmark --source big_generated_module.py
+
+    python: remove_comments_and_docstrings() against the previous implementation (reference_python_comments,
+            one `out +=` per token) and against remove_comments_and_docstrings_file(), which streams the tokens
+            from the file. Every run checks that the outputs are identical.
+    c-family: MB/s of the shared C-family lexer against the previous per-language regexes, on generated
+            sources with comment markers inside literals (which the previous regexes corrupt), and on unterminated
+            block comments (quadratic with the previous regexes).
+        $python3 -m src.utils.comment_remover_benchmark --bench c-family --langs c java
+    sql: MB/s of sql_comments() (SqlCommentLexer) on a generated migration dump, from a string and streamed in chunks
+            from a file by sql_comments_file() (both must give the same output), against sqlparse when installed.
+        $python3 -m src.utils.comment_remover_benchmark --bench sql --sql-size 64 --sqlparse-size 1
+"""
+
+import os
+import re
+import sys
+import tokenize
+import argparse
+import tempfile
+from io import StringIO
+from time import perf_counter
+from src.utils.comment_remover import remove_comments_and_docstrings, remove_comments_and_docstrings_file, \
+    c_family_comments, sql_comments, sql_comments_file, sqlparse, __C_FAMILY__
+
+
+__author__ = "Mohammed Ataaur Rahaman"
+
+
+__PY_TEMPLATE__ = '''
+class Model{i}(object):
+    """
+    Docstring of Model{i}, removed.
+    """
+
+    def __init__(self, value={i}):
+        # Comment, removed
+        self.value = value  # trailing comment
+        self.names = [
+            "kept string {i}",
+            'another one',
+        ]
+
+    def compute(self, x):
+        """Docstring of compute."""
+        total = 0
+        for n in range(x):
+            total += n * self.value  # accumulate
+        return f"{{total}}-{i}"
+
+
+def helper_{i}(a, b=None):
+    \'\'\'Module level function docstring.\'\'\'
+    if b is None:
+        b = a
+    return (a +
+            b)  # continuation
+'''
+
+
+__C_TEMPLATE__ = '''
+/*
+ * Block comment of function_{i}, removed.
+ */
+int function_{i}(int a, int b) {{
+    // Line comment, removed
+    const char *url = "http://example.com/{i}/*not-a-comment*/";  // trailing comment
+    char quote = '"';
+    int ratio = a / b; /* inline */ int other = {i};
+    return ratio + other;
+}}
+'''
+
+__SQL_TEMPLATE__ = '''-- Migration {i}
+CREATE TABLE t{i} (id serial PRIMARY KEY, name text DEFAULT 'a -- b', "weird--col" int); /* created */
+INSERT INTO t{i} VALUES (1, E'it\\'s /* not */ a comment', 2), (2, 'O''Brien', 3);
+/* Block comment /* nested */ of f{i} */
+CREATE FUNCTION f{i}() RETURNS int AS $body$
+  -- kept inside the body
+  SELECT 1;
+$body$ LANGUAGE sql;
+'''
+
+# The previous regexes of java_comments and c_style_comments, kept as the reference of the benchmark
+__REFERENCE_JAVA__ = "(?:/\\*(?:[^*]|(?:\\*+[^*/]))*\\*+/)|(?://.*)"
+__REFERENCE_C_STYLE__ = '//.*?((?<!\\\\)\n|$)|/\\*.*?\\*/'
+
+
+def reference_c_family_comments(source, lang):
+    """
+    Previous implementation of the C-family comment removal, kept as the reference of the benchmark.
+    """
+    if lang == 'java':
+        return re.sub(re.compile(__REFERENCE_JAVA__), "", source)
+    return re.sub(__REFERENCE_C_STYLE__, '', source, flags=re.S)
+
+
+def reference_python_comments(source):
+    """
+    Previous implementation of remove_comments_and_docstrings(), kept as the reference of the benchmark.
+    """
+    source = str.strip(source)
+    io_obj = StringIO(source)
+    out = ""
+    prev_toktype = tokenize.INDENT
+    last_lineno = -1
+    last_col = 0
+    for tok in tokenize.generate_tokens(io_obj.readline):
+        token_type = tok[0]
+        token_string = tok[1]
+        start_line, start_col = tok[2]
+        end_line, end_col = tok[3]
+        if start_line > last_lineno:
+            last_col = 0
+        if start_col > last_col:
+            out += (" " * (start_col - last_col))
+        if token_type == tokenize.COMMENT:
+            pass
+        elif token_type == tokenize.STRING:
+            if prev_toktype != tokenize.INDENT:
+                if prev_toktype != tokenize.NEWLINE:
+                    if start_col > 0:
+                        out += token_string
+        else:
+            out += token_string
+        prev_toktype = token_type
+        last_col = end_col
+        last_lineno = end_line
+    return out
+
+
+def generate_python(size):
+    """
+    :param size: Approximate size of the source in bytes
+    :return: Python source code with comments and docstrings
+    """
+    parts, length, i = ['"""\nModule docstring.\n"""\n'], 0, 0
+    while length < size:
+        part = __PY_TEMPLATE__.format(i=i)
+        parts.append(part)
+        length += len(part)
+        i += 1
+    return ''.join(parts)
+
+
+def generate_c_family(size):
+    """
+    :param size: Approximate size of the source in bytes
+    :return: C-like source code with comments, and comment markers inside string literals
+    """
+    parts, length, i = [], 0, 0
+    while length < size:
+        part = __C_TEMPLATE__.format(i=i)
+        parts.append(part)
+        length += len(part)
+        i += 1
+    return ''.join(parts)
+
+
+def generate_sql(size):
+    """
+    :param size: Approximate size of the source in bytes
+    :return: SQL migration dump with comments, and comment markers inside literals and dollar-quoted bodies
+    """
+    parts, length, i = [], 0, 0
+    while length < size:
+        part = __SQL_TEMPLATE__.format(i=i)
+        parts.append(part)
+        length += len(part)
+        i += 1
+    return ''.join(parts)
+
+
+def best_time(function, *args, repeat=3):
+    """
+    :return: (best wall time in seconds, result of the last call)
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function(*args)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_python(sources, repeat=3):
+    """
+    :param sources: List of (label, source code)
+    :return: List of result dictionaries
+    """
+    results = []
+    for label, source in sources:
+        with tempfile.NamedTemporaryFile('w', suffix='.py', encoding='utf-8', delete=False) as f:
+            f.write(source)
+        try:
+            reference_time, expected = best_time(reference_python_comments, source, repeat=repeat)
+            string_time, from_string = best_time(remove_comments_and_docstrings, source, repeat=repeat)
+            file_time, from_file = best_time(remove_comments_and_docstrings_file, f.name, repeat=repeat)
+        finally:
+            os.unlink(f.name)
+        results.append({
+            'input': label,
+            'mb': len(source.encode('utf-8')) / 1e6,
+            'reference': reference_time,
+            'string': string_time,
+            'file': file_time,
+            'equivalent': expected == from_string == from_file,
+        })
+    return results
+
+
+def bench_c_family(langs, size, unterminated_size, repeat=3):
+    """
+    :param langs: Languages of __C_FAMILY__ to measure
+    :param size: Size of the generated source in bytes
+    :param unterminated_size: Size of the source made of unterminated block comments in bytes
+    :return: List of result dictionaries
+    """
+    source = generate_c_family(size)
+    unterminated = 'x /* a * b ' * (unterminated_size // 11)
+    results = []
+    for lang in langs:
+        for label, text in (('generated', source), ('unterminated /*', unterminated)):
+            reference_time, expected = best_time(reference_c_family_comments, text, lang, repeat=repeat)
+            lexer_time, stripped = best_time(c_family_comments, text, lang, repeat=repeat)
+            results.append({
+                'lang': lang,
+                'input': label,
+                'mb': len(text.encode('utf-8')) / 1e6,
+                'reference': reference_time,
+                'lexer': lexer_time,
+                'literals_kept': '*not-a-comment*' in stripped if label == 'generated' else None,
+                'reference_literals_kept': '*not-a-comment*' in expected if label == 'generated' else None,
+            })
+    return results
+
+
+def print_c_family_results(results, file=sys.stdout):
+    print(f"{'lang':<6} {'input':<16} {'MB':>7} {'reference MB/s':>15} {'lexer MB/s':>11} {'speedup':>8} "
+          f"{'literals kept (reference)':>26}", file=file)
+    for result in results:
+        kept = '' if result['literals_kept'] is None else \
+            f"{result['literals_kept']} ({result['reference_literals_kept']})"
+        print(
+            f"{result['lang']:<6} {result['input']:<16} {result['mb']:>7.2f} "
+            f"{result['mb'] / result['reference']:>15.2f} {result['mb'] / result['lexer']:>11.2f} "
+            f"{result['reference'] / result['lexer']:>8.2f} {kept:>26}", file=file
+        )
+
+
+def bench_sql(size, sqlparse_size, chunk_sizes=(4096, 1048576), repeat=3):
+    """
+    :param size: Size of the generated dump in bytes
+    :param sqlparse_size: Size of the dump given to sqlparse in bytes, 0 to skip it
+    :param chunk_sizes: Chunk sizes of sql_comments_file
+    :return: List of result dictionaries
+    """
+    source = generate_sql(size)
+    mb = len(source.encode('utf-8')) / 1e6
+    lexer_time, expected = best_time(sql_comments, source, repeat=repeat)
+    results = [{'input': 'lexer, string', 'mb': mb, 'seconds': lexer_time, 'equivalent': True}]
+    with tempfile.NamedTemporaryFile('w', suffix='.sql', encoding='utf-8', delete=False) as f:
+        f.write(source)
+    try:
+        for chunk_size in chunk_sizes:
+            file_time, from_file = best_time(sql_comments_file, f.name, None, chunk_size, repeat=repeat)
+            results.append({'input': f'lexer, file chunks of {chunk_size}', 'mb': mb, 'seconds': file_time,
+                             'equivalent': from_file == expected})
+    finally:
+        os.unlink(f.name)
+    if sqlparse is not None and sqlparse_size:
+        source = generate_sql(sqlparse_size)
+        sqlparse_time, _ = best_time(sql_comments, source, 'sqlparse', repeat=1)
+        results.append({'input': 'sqlparse, string', 'mb': len(source.encode('utf-8')) / 1e6,
+                        'seconds': sqlparse_time, 'equivalent': None})
+    return results
+
+
+def print_sql_results(results, file=sys.stdout):
+    print(f"{'input':<32} {'MB':>8} {'s':>8} {'MB/s':>8} {'same output':>12}", file=file)
+    for result in results:
+        same = '' if result['equivalent'] is None else str(result['equivalent'])
+        print(
+            f"{result['input']:<32} {result['mb']:>8.2f} {result['seconds']:>8.3f} "
+            f"{result['mb'] / result['seconds']:>8.2f} {same:>12}", file=file
+        )
+
+
+def print_results(results, file=sys.stdout):
+    print(f"{'input':<24} {'MB':>8} {'reference s':>12} {'string s':>10} {'file s':>10} {'speedup':>8} "
+          f"{'MB/s':>8} {'same output':>12}", file=file)
+    for result in results:
+        print(
+            f"{result['input']:<24} {result['mb']:>8.2f} {result['reference']:>12.3f} {result['string']:>10.3f} "
+            f"{result['file']:>10.3f} {result['reference'] / result['string']:>8.2f} "
+            f"{result['mb'] / result['string']:>8.2f} {str(result['equivalent']):>12}", file=file
+        )
+
+
+def get_args():
+    """
+    Get args when running with command line interface
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.version = '1.0.0'
+
+    arg_parser.add_argument('-b', '--bench', action='store', type=str, nargs='*', default=['python', 'c-family', 'sql'],
+                            choices=['python', 'c-family', 'sql'], help='Benchmarks to run.')
+    arg_parser.add_argument('-l', '--langs', action='store', type=str, nargs='*', default=list(__C_FAMILY__),
+                            choices=__C_FAMILY__, help='Languages of the c-family benchmark.')
+    arg_parser.add_argument('--c-size', action='store', type=float, default=16,
+                            help='Size of the generated c-family input in MB.')
+    arg_parser.add_argument('--unterminated-size', action='store', type=float, default=0.05,
+                            help='Size of the unterminated block comments input in MB, keep it small: the '
+                                 'reference is quadratic on it.')
+    arg_parser.add_argument('--sql-size', action='store', type=float, default=16,
+                            help='Size of the generated sql dump in MB.')
+    arg_parser.add_argument('--sqlparse-size', action='store', type=float, default=0.5,
+                            help='Size of the sql dump given to sqlparse in MB, 0 to skip it.')
+    arg_parser.add_argument('-s', '--sizes', action='store', type=float, nargs='*', default=[1, 4, 16],
+                            help='Sizes of the generated python inputs in MB.')
+    arg_parser.add_argument('--source', action='store', type=str, nargs='*', default=[],
+                            help='Benchmark these python files as well.')
+    arg_parser.add_argument('-r', '--repeat', action='store', type=int, default=3,
+                            help='Runs per measure, the best one is kept.')
+
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    if 'c-family' in args.bench:
+        print_c_family_results(bench_c_family(
+            args.langs, int(args.c_size * 1e6), int(args.unterminated_size * 1e6), repeat=args.repeat
+        ))
+
+    if 'sql' in args.bench:
+        sql_results = bench_sql(int(args.sql_size * 1e6), int(args.sqlparse_size * 1e6), repeat=args.repeat)
+        print_sql_results(sql_results)
+        if not all(result['equivalent'] is not False for result in sql_results):
+            raise SystemExit("Streamed sql output differs from the string one")
+
+    if 'python' in args.bench:
+        inputs = [(f'generated {size:g} MB', generate_python(int(size * 1e6))) for size in args.sizes]
+        for source_path in args.source:
+            with open(source_path, 'r', encoding='utf-8', errors='replace') as source_file:
+                inputs.append((os.path.basename(source_path), source_file.read()))
+
+        python_results = bench_python(inputs, repeat=args.repeat)
+        print_results(python_results)
+        if not all(result['equivalent'] for result in python_results):
+            raise SystemExit("Outputs differ from the reference implementation")
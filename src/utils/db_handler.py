@@ -3,17 +3,129 @@
 
 """
     Universal DB Handler to connect to postgres using psycopg2.
+
+    By default the handler holds a single connection and cursor, which must not be shared between threads.
+    With `pooled=True` it keeps a pool of connections instead (min_size..max_size), safe to use from many threads:
+    every query checks out a connection, checks its health if it was idle for a while, and gives it back.
+        db = DbHandler('db', 'user', 'pass', 'localhost', 5432, pooled=True, max_size=20)
+        db.create_connection()
+        rows = db.fetchall_query("SELECT * FROM jobs WHERE status = %s", ('queued',))
+        with db.session() as (conn, cur):
+            cur.execute(...)
+            cur.execute(...)
+
+    Rows are loaded in bulk, in a single transaction, with multi-row INSERTs or a COPY streamed from an iterator:
+        db.bulk_insert('jobs', rows, columns=['name', 'status'], page_size=1000)
+        db.bulk_insert('jobs', rows, columns=['name', 'status'], conflict_columns=['name'], update_columns=['status'])
+        db.copy_from_iter('jobs', (make_row(line) for line in lines), columns=['name', 'status'])
+
+    Large results are streamed from a server-side cursor, itersize rows per round trip, instead of fetchall():
+        for row in db.iter_query("SELECT * FROM events WHERE day = %s", (day,), as_dicts=True):
+            ...
+        for rows in db.iter_query("SELECT * FROM events", itersize=10000, batches=True):
+            ...
+
+    Statements are grouped in explicit transactions, with savepoints to roll back part of one:
+        with db.transaction():
+            db.execute_query("INSERT INTO runs (id) VALUES (%s)", (run_id,))
+            try:
+                with db.savepoint():
+                    db.execute_query("INSERT INTO run_tags (run_id, tag) VALUES (%s, %s)", (run_id, tag))
+            except psycopg2.IntegrityError:
+                pass  # The run is kept without its tag
+    With `autocommit=True`, statements outside a transaction commit on their own: no BEGIN/COMMIT round trips
+    for single statements and plain SELECTs. `read_only=True` opens read-only sessions.
 """
 
+import os
+import json
+import uuid
 import logging
+import threading
+from time import monotonic
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.pool
+from psycopg2 import sql
+from psycopg2.extras import execute_values, RealDictCursor
 
 
 __author__ = "Mohammed Ataaur Rahaman"
 
 
+__COPY_BUFFER_SIZE__ = 1048576
+# Escapes of the COPY text format
+__COPY_ESCAPES__ = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def table_identifier(table):
+    """
+    :param table: Table name, optionally qualified by its schema ('schema.table')
+    :return: Quoted SQL identifier
+    """
+    return sql.Identifier(*table.split('.'))
+
+
+def copy_value(value):
+    """
+    :return: Value in the COPY text format
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # bytea in the hex format, \x<hex>, with the backslash escaped for the COPY text format
+        return '\\\\x' + bytes(value).hex()
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return str(value).translate(__COPY_ESCAPES__)
+
+
+class CopyBuffer:
+    """
+    File-like object reading rows from an iterator in the COPY text format, for copy_expert().
+    Only about one read() worth of rows is held in memory at a time.
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.pending = b''
+        self.count = 0
+
+    def read(self, size=-1):
+        chunks, length = [self.pending], len(self.pending)
+        while size < 0 or length < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            line = ('\t'.join(copy_value(value) for value in row) + '\n').encode('utf-8')
+            chunks.append(line)
+            length += len(line)
+            self.count += 1
+        data = b''.join(chunks)
+        if size < 0:
+            self.pending = b''
+            return data
+        self.pending = data[size:]
+        return data[:size]
+
+
 class DbHandler:
-    def __init__(self, db_name: str, db_user: str, db_pass: str, host: str, port: int):
+    def __init__(self, db_name: str, db_user: str, db_pass: str, host: str, port: int, pooled: bool = False,
+                 min_size: int = 1, max_size: int = 10, max_idle: float = 300, health_check_after: float = 30,
+                 checkout_timeout: float = 30, autocommit: bool = False, read_only: bool = False):
+        """
+        :param pooled: Use a pool of connections shared by threads instead of a single connection and cursor
+        :param min_size: Connections kept open by the pool
+        :param max_size: Max connections open at once, callers wait for a free one beyond it
+        :param max_idle: Seconds after which an idle connection is closed and replaced on checkout
+        :param health_check_after: Seconds of idleness after which a connection is checked on checkout
+        :param checkout_timeout: Max seconds to wait for a free connection
+        :param autocommit: Commit every statement on its own, without BEGIN/COMMIT round trips. Use transaction()
+                           to group statements.
+        :param read_only: Open read-only sessions, e.g. for reporting or a replica
+        """
         self.db_name = db_name
         self.db_pass = db_pass
         self.port = port
@@ -23,6 +135,34 @@ class DbHandler:
         self.conn = None
         self.cur = None
 
+        self.pooled = pooled
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+        self.checkout_timeout = checkout_timeout
+        self.pool = None
+        self._pool_pid = None
+        self._slots = None
+        self._last_used = {}
+        self._pool_lock = threading.Lock()
+
+        self.autocommit = autocommit
+        self.read_only = read_only
+        self._local = threading.local()  # Transaction of the current thread
+
+    def __getstate__(self):
+        # Connections and the pool can't cross process boundaries, an unpickled handler connects again on use.
+        state = self.__dict__.copy()
+        del state['_local'], state['_pool_lock']
+        state.update(conn=None, cur=None, pool=None, _pool_pid=None, _slots=None, _last_used={})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._pool_lock = threading.Lock()
+
     def __str__(self):
         return f"connection to {self.db_name} on {self.url} as {self.user}"
 
@@ -30,7 +170,9 @@ class DbHandler:
         self.close_connection()
 
     def create_connection(self):
-        if self.conn is None:
+        if self.pooled:
+            self.create_pool()
+        elif self.conn is None:
             try:
                 self.conn = psycopg2.connect(
                     host=self.host,
@@ -39,6 +181,7 @@ class DbHandler:
                     user=self.user,
                     password=self.db_pass,
                 )
+                self.configure(self.conn)
                 self.create_cursor()
             except Exception as db_err:
                 raise Exception(
@@ -47,12 +190,42 @@ class DbHandler:
         else:
             logging.info("Database connection already exists")
 
+    def create_pool(self):
+        with self._pool_lock:
+            # Checked under the lock: concurrent first checkouts would each build a pool, all but one leaked
+            if self.pool is not None and self._pool_pid == os.getpid():
+                logging.info("Database connection pool already exists")
+                return
+            # A forked worker gets a pool of its own, the connections inherited from the parent are left to it.
+            try:
+                pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.min_size,
+                    self.max_size,
+                    host=self.host,
+                    port=self.port,
+                    database=self.db_name,
+                    user=self.user,
+                    password=self.db_pass,
+                )
+            except Exception as db_err:
+                raise Exception(f"Error in making connection pool to db: {db_err}")
+            self._slots = threading.BoundedSemaphore(self.max_size)
+            self._last_used = {}
+            self._pool_pid = os.getpid()
+            self.pool = pool
+        logging.debug(f"Database connection pool created ({self.min_size}-{self.max_size} connections).")
+
     def close_connection(self):
         self.close_cursor()
         if self.conn is not None:
             self.conn.close()
             self.conn = None
             logging.debug("Database connection closed.")
+        if self.pool is not None:
+            if self._pool_pid == os.getpid():
+                self.pool.closeall()
+                logging.debug("Database connection pool closed.")
+            self.pool = None
 
     def create_cursor(self):
         self.cur = self.conn.cursor()
@@ -68,12 +241,177 @@ class DbHandler:
     def rollback(self):
         self.conn.rollback()
 
+    @staticmethod
+    def is_healthy(conn):
+        """
+        :return: True if the connection is open and the server answers
+        """
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def checkout(self):
+        """
+        Take a connection from the pool, waiting up to checkout_timeout for a free one.
+        Connections idle for more than max_idle, or failing their health check, are replaced by new ones.
+        :return: psycopg2 connection, to give back with checkin()
+        """
+        if self.pool is None or self._pool_pid != os.getpid():
+            self.create_pool()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise Exception(
+                f"No free database connection after {self.checkout_timeout}s, all {self.max_size} are in use"
+            )
+        try:
+            conn = self.pool.getconn()
+            idle = monotonic() - self._last_used.get(id(conn), monotonic())
+            if conn.closed or idle > self.max_idle or (idle > self.health_check_after and not self.is_healthy(conn)):
+                logging.debug(f"Recycling a database connection idle for {idle:.0f}s.")
+                self._last_used.pop(id(conn), None)
+                self.pool.putconn(conn, close=True)
+                conn = self.pool.getconn()
+            self.configure(conn)
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def checkin(self, conn, discard=False):
+        """
+        Give a connection back to the pool, an open transaction is rolled back.
+        :param discard: Close the connection instead of keeping it for later
+        """
+        try:
+            discard = discard or bool(conn.closed)
+            if discard:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = monotonic()
+            self.pool.putconn(conn, close=discard)
+        finally:
+            self._slots.release()
+
+    def configure(self, conn):
+        """
+        Apply the autocommit and read-only modes of the handler to a connection.
+        """
+        if conn.autocommit != self.autocommit or bool(conn.readonly) != self.read_only:
+            conn.set_session(readonly=self.read_only or None, autocommit=self.autocommit)
+
+    @contextmanager
+    def session(self, new_cursor=False, transactional=False):
+        """
+        Connection and cursor committed on success and rolled back on error:
+            with db.session() as (conn, cur):
+                cur.execute(...)
+        In pooled mode they are checked out of the pool for the duration of the block. Inside transaction(), the
+        connection of the transaction is used and nothing is committed. In autocommit mode every statement commits
+        on its own, unless `transactional` is set.
+        :param new_cursor: Without the pool, use a new cursor instead of the cursor of the handler
+        :param transactional: Run the block in a transaction even in autocommit mode
+        """
+        current = getattr(self._local, 'transaction', None)
+        if current is not None:
+            conn, cur = current
+            if not new_cursor:
+                yield conn, cur
+                return
+            with conn.cursor() as cur:
+                yield conn, cur
+            return
+
+        conn = self.checkout() if self.pooled else self.conn
+        restore_autocommit = transactional and conn.autocommit
+        if restore_autocommit:
+            conn.autocommit = False
+        cur = self.cur if not (self.pooled or new_cursor) else conn.cursor()
+        try:
+            yield conn, cur
+            if not conn.autocommit:
+                conn.commit()
+        except BaseException:
+            # Also on GeneratorExit, when a streaming fetch is abandoned halfway
+            if not conn.closed and not conn.autocommit:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass  # Broken connection, dropped by checkin()
+            raise
+        finally:
+            if cur is not self.cur and not conn.closed:
+                cur.close()
+            if restore_autocommit and not conn.closed:
+                conn.autocommit = True
+            if self.pooled:
+                self.checkin(conn)
+
+    @contextmanager
+    def transaction(self, read_only=False):
+        """
+        Run the queries of the block in a single transaction, committed at the end and rolled back on error.
+        The query methods called inside it join the transaction instead of committing:
+            with db.transaction() as cur:
+                db.execute_query("UPDATE jobs SET status = %s WHERE id = %s", ('done', 1))
+                cur.execute("DELETE FROM leases WHERE job_id = %s", (1,))
+        A transaction() inside another one is a savepoint, see savepoint().
+        :param read_only: Start the transaction READ ONLY
+        :return: Cursor of the transaction
+        """
+        if getattr(self._local, 'transaction', None) is not None:
+            with self.savepoint() as cur:
+                yield cur
+            return
+
+        with self.session(transactional=True) as (conn, cur):
+            if read_only:
+                cur.execute("SET TRANSACTION READ ONLY")
+            self._local.transaction = (conn, cur)
+            try:
+                yield cur
+            finally:
+                self._local.transaction = None
+
+    @contextmanager
+    def savepoint(self, name=None):
+        """
+        Savepoint in the current transaction: on error the queries of the block are rolled back alone, the
+        exception is raised and the transaction can go on if it is caught.
+        :param name: Name of the savepoint, generated if None
+        :return: Cursor of the transaction
+        """
+        current = getattr(self._local, 'transaction', None)
+        if current is None:
+            raise Exception("savepoint() can only be used inside transaction()")
+        conn, cur = current
+        name = sql.Identifier(name or f'sp_{uuid.uuid4().hex}')
+        cur.execute(sql.SQL("SAVEPOINT {}").format(name))
+        try:
+            yield cur
+            cur.execute(sql.SQL("RELEASE SAVEPOINT {}").format(name))
+        except BaseException:
+            if not conn.closed:
+                try:
+                    cur.execute(sql.SQL("ROLLBACK TO SAVEPOINT {}").format(name))
+                except psycopg2.Error:
+                    pass  # Broken connection, the transaction is rolled back as a whole
+            raise
+
     def query_fetch_results(self, full=True):
         """
         Fetch query results
         :param full: Fetch all rows, if True, else fetch 1 row
         :return: List of rows
         """
+        if self.pooled:
+            raise Exception(
+                "no shared cursor in pooled mode, use the rows returned by the fetch queries or session()"
+            )
         if self.cur is None:
             raise Exception(
                 "cursor is not yet initialized, cannot perform fetch operation"
@@ -83,13 +421,22 @@ class DbHandler:
         else:
             return self.cur.fetchone()
 
+    @staticmethod
+    def log_error(query, error_msg=None):
+        """
+        Log the exception being handled, with error_msg if given.
+        """
+        if error_msg:
+            logging.exception(error_msg)
+        else:
+            logging.exception("Error occurred while executing query: %s", query)
+
     def execute_query(self, query, params=None, error_msg=None):
         try:
             logging.debug("Executing query %s", query)
-            self.cur.execute(query, params)
-            self.commit()
+            with self.session() as (_, cur):
+                cur.execute(query, params)
         except Exception as e:
-            self.rollback()
             if error_msg:
                 print(error_msg)
                 logging.error(error_msg)
@@ -101,11 +448,10 @@ class DbHandler:
     def fetchall_query(self, query, params=None, error_msg=None):
         try:
             logging.debug("Executing query %s", query)
-            self.cur.execute(query, params)
-            self.commit()
-            return self.cur.fetchall()
+            with self.session() as (_, cur):
+                cur.execute(query, params)
+                return cur.fetchall()
         except Exception as e:
-            self.rollback()
             if error_msg:
                 print(error_msg)
                 logging.error(error_msg)
@@ -117,11 +463,10 @@ class DbHandler:
     def execute_and_fetchone_query(self, query, error_msg=None):
         try:
             logging.debug("Executing query %s", query)
-            self.cur.execute(query)
-            self.commit()
-            return self.cur.fetchone()
+            with self.session() as (_, cur):
+                cur.execute(query)
+                return cur.fetchone()
         except Exception as e:
-            self.rollback()
             if error_msg:
                 print(error_msg)
                 logging.error(error_msg)
@@ -130,17 +475,137 @@ class DbHandler:
             logging.exception("Error occurred while executing query: %s", query)
             raise e
 
+    def iter_query(self, query, params=None, itersize=2000, batches=False, as_dicts=False, error_msg=None):
+        """
+        Stream the rows of a query from a named (server-side) cursor, memory stays bounded by itersize rows.
+        The connection is held until the generator is exhausted or closed. Without the pool, don't run other
+        queries on the handler meanwhile: their commit would close the cursor.
+        :param itersize: Rows fetched per round trip
+        :param batches: Yield lists of up to itersize rows instead of single rows
+        :param as_dicts: Yield rows as dictionaries of column -> value
+        """
+        try:
+            logging.debug("Streaming query %s", query)
+            # Named cursors only live in a transaction
+            with self.session(transactional=True) as (conn, _):
+                name = f'iter_{uuid.uuid4().hex}'
+                with conn.cursor(name=name, cursor_factory=RealDictCursor if as_dicts else None) as cur:
+                    cur.itersize = itersize
+                    cur.execute(query, params)
+                    if not batches:
+                        yield from cur
+                        return
+                    while True:
+                        rows = cur.fetchmany(itersize)
+                        if not rows:
+                            break
+                        yield rows
+        except Exception as e:
+            self.log_error(query, error_msg)
+            raise e
+
     def execute_query_with_lambda(self, cb):
-        self.create_cursor()
+        # A cursor of its own: the shared cursor of the handler stays usable afterwards.
         try:
-            result = cb(self.cur)
-            self.commit()
-            return result
+            with self.session(new_cursor=True, transactional=True) as (_, cur):
+                return cb(cur)
         except Exception as e:
-            self.rollback()
             logging.exception(
                 "Error occurred while executing queries with lambda function"
             )
             raise e
-        finally:
-            self.close_cursor()
+
+    @staticmethod
+    def _rows_and_columns(rows, columns):
+        """
+        :return: Iterator of row tuples and the list of columns, taken from the keys of the first row for dicts
+        """
+        rows = iter(rows)
+        if columns is not None:
+            return rows, list(columns)
+        first = next(rows, None)
+        if first is None:
+            return iter(()), []
+        if not isinstance(first, dict):
+            raise Exception("columns are required unless the rows are dictionaries")
+        columns = list(first)
+
+        def tuples():
+            yield tuple(first[column] for column in columns)
+            for row in rows:
+                yield tuple(row[column] for column in columns)
+
+        return tuples(), columns
+
+    def bulk_insert(self, table, rows, columns=None, page_size=1000, conflict_columns=None, update_columns=None):
+        """
+        Insert rows with multi-row INSERT statements of page_size rows each, committed once at the end.
+        :param table: Table name, optionally qualified by its schema
+        :param rows: Iterable of tuples in the order of columns, or of dictionaries
+        :param columns: Column names, the keys of the first row if None
+        :param page_size: Rows per INSERT statement
+        :param conflict_columns: Columns of the unique constraint to upsert on, None for a plain insert
+        :param update_columns: Columns updated on conflict, nothing is done on conflict if None
+        :return: Number of rows sent
+        """
+        rows, columns = self._rows_and_columns(rows, columns)
+        if not columns:
+            return 0
+        query = sql.SQL("INSERT INTO {table} ({columns}) VALUES %s").format(
+            table=table_identifier(table),
+            columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+        )
+        if conflict_columns:
+            action = sql.SQL("DO NOTHING")
+            if update_columns:
+                action = sql.SQL("DO UPDATE SET {}").format(sql.SQL(', ').join(
+                    sql.SQL("{column} = EXCLUDED.{column}").format(column=sql.Identifier(column))
+                    for column in update_columns
+                ))
+            query = sql.SQL("{query} ON CONFLICT ({conflict}) {action}").format(
+                query=query, conflict=sql.SQL(', ').join(map(sql.Identifier, conflict_columns)), action=action
+            )
+
+        count = 0
+
+        def counted():
+            nonlocal count
+            for row in rows:
+                count += 1
+                yield row
+
+        try:
+            with self.session(new_cursor=True, transactional=True) as (_, cur):
+                logging.debug("Executing bulk insert %s", query.as_string(cur))
+                execute_values(cur, query, counted(), page_size=page_size)
+        except Exception as e:
+            logging.exception("Error occurred while bulk inserting into %s", table)
+            raise e
+        logging.debug(f"Inserted {count} rows into {table}.")
+        return count
+
+    def copy_from_iter(self, table, rows, columns=None, buffer_size=__COPY_BUFFER_SIZE__):
+        """
+        Stream rows into a table with COPY FROM STDIN, in a single transaction.
+        :param table: Table name, optionally qualified by its schema
+        :param rows: Iterable of tuples in the order of columns, or of dictionaries
+        :param columns: Column names, the keys of the first row if None
+        :param buffer_size: Bytes sent to the server per read of the buffer
+        :return: Number of rows copied
+        """
+        rows, columns = self._rows_and_columns(rows, columns)
+        if not columns:
+            return 0
+        buffer = CopyBuffer(rows)
+        try:
+            with self.session(new_cursor=True) as (_, cur):
+                query = sql.SQL("COPY {table} ({columns}) FROM STDIN").format(
+                    table=table_identifier(table),
+                    columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+                )
+                cur.copy_expert(query, buffer, size=buffer_size)
+        except Exception as e:
+            logging.exception("Error occurred while copying into %s", table)
+            raise e
+        logging.debug(f"Copied {buffer.count} rows into {table}.")
+        return buffer.count
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    Queue executors on a temporary queues directory, in the test process or as daemon subprocesses.
+
+        $python3 -m tests.executors.queue_harness <queues_dir> <queue_name> <QueueExecutor kwargs as JSON>
+    runs a daemon and appends its worker id to <queues_dir>/<queue_name>/worker_ids.
+"""
+
+import os
+import sys
+import json
+import signal
+import shutil
+import tempfile
+import unittest
+import subprocess
+from pathlib import Path
+from time import monotonic, sleep
+import src.executors.queue_executor as queue_executor
+from src.executors.journal import pid_alive
+
+
+__author__ = "Mohammed Ataaur Rahaman"
+
+
+__ROOT__ = Path(__file__).resolve().parent.parent.parent
+
+
+class QueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.queues = Path(tempfile.mkdtemp())
+        self.daemons = []
+        self.queue_dir = queue_executor.__QUEUE_DIR__
+        queue_executor.__QUEUE_DIR__ = self.queues
+
+    def tearDown(self):
+        for daemon in self.daemons:
+            self.kill_daemon(daemon, group=True)
+        # Commands run in sessions of their own, stop the ones the daemons left behind.
+        for path in self.queues.glob('*/journal/*/*.log'):
+            with open(path, 'r') as f:
+                for line in f:
+                    pgid = json.loads(line)[3].get('pgid')
+                    if pgid and pid_alive(pgid):
+                        queue_executor.kill_group(pgid, signal.SIGKILL)
+        queue_executor.__QUEUE_DIR__ = self.queue_dir
+        shutil.rmtree(self.queues, ignore_errors=True)
+
+    def executor(self, queue_name, pool=2, **kwargs):
+        """
+        :return: QueueExecutor of a queue in the temporary directory
+        """
+        return queue_executor.QueueExecutor(queue_name, pool, **kwargs)
+
+    def start_daemon(self, queue_name, **kwargs):
+        """
+        Run a daemon on a queue in a session of its own, its pool workers included.
+        :return: Popen of the daemon
+        """
+        daemon = subprocess.Popen(
+            [sys.executable, '-m', 'tests.executors.queue_harness', str(self.queues), queue_name, json.dumps(kwargs)],
+            cwd=__ROOT__, start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        self.daemons.append(daemon)
+        return daemon
+
+    @staticmethod
+    def kill_daemon(daemon, group=False):
+        """
+        SIGKILL a daemon, with its pool workers if group is set, else they are left orphaned.
+        """
+        if daemon.poll() is None:
+            if group:
+                queue_executor.kill_group(daemon.pid, signal.SIGKILL)
+            else:
+                daemon.kill()
+        daemon.wait()
+
+    def worker_ids(self, queue_name):
+        path = self.queues / queue_name / 'worker_ids'
+        return path.read_text().split() if path.exists() else []
+
+    @staticmethod
+    def wait_for(condition, timeout=20, message=None):
+        """
+        Poll condition until it returns a true value.
+        :return: The value
+        """
+        deadline = monotonic() + timeout
+        while True:
+            value = condition()
+            if value:
+                return value
+            if monotonic() > deadline:
+                raise AssertionError(message or f"Timed out after {timeout}s")
+            sleep(0.05)
+
+
+if __name__ == '__main__':
+    queue_executor.__QUEUE_DIR__ = Path(sys.argv[1])
+    daemon = queue_executor.QueueExecutor(sys.argv[2], **json.loads(sys.argv[3]))
+    with open(queue_executor.__QUEUE_DIR__ / sys.argv[2] / 'worker_ids', 'a') as f:
+        f.write(f'{daemon.worker_id}\n')
+    daemon.run()
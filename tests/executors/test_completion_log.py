@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from src.executors.completion_log import CompletionLog
+
+
+class TestCompletionLog(unittest.TestCase):
+
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp()) / 'completions'
+        self.log = CompletionLog(self.root, segment_bytes=200, compression='gzip')
+
+    def tearDown(self):
+        shutil.rmtree(self.root.parent)
+
+    def test_get_latest_record_across_segments(self):
+        for idx in range(20):
+            self.log.append(idx, {'status': idx % 3 != 0}, completed_at=1000 + idx)
+        self.assertGreater(len(self.log.segments()), 2)
+        self.assertEqual(self.log.get(4), {'idx': 4, 'completed_at': 1004, 'status': True})
+        self.assertEqual(self.log.get(3)['status'], False)
+        self.assertIsNone(self.log.get(99))
+
+        # Retried: the in-memory index picks up the lines appended since the last lookup
+        self.log.append(19, {'status': False, 'attempt': 2}, completed_at=2000)
+        self.assertEqual(self.log.get(19), {'idx': 19, 'completed_at': 2000, 'status': False, 'attempt': 2})
+        self.assertEqual(CompletionLog(self.root).get(19)['attempt'], 2)
+
+    def test_append_with_empty_lock_file(self):
+        self.log.append(1, {'status': True}, completed_at=1000)
+        self.log.lock_file.write_text('')
+        self.log.append(2, {'status': True}, completed_at=1001)
+        self.assertEqual(self.log.lock_file.read_text(), '0 1000.0')
+        self.assertEqual([record['idx'] for record in self.log.query()], [1, 2])
+
+    def test_query_and_count(self):
+        for idx in range(10):
+            self.log.append(idx, {'status': idx % 2 == 0}, completed_at=1000 + idx)
+        self.assertEqual([record['idx'] for record in self.log.query(status=False, since=1004)], [5, 7, 9])
+        self.assertEqual(self.log.count(), 10)
+        self.assertEqual(self.log.count(status=True), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
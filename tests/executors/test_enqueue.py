@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import threading
+from tests.executors.queue_harness import QueueTestCase
+
+
+class TestEnqueue(QueueTestCase):
+
+    def test_concurrent_producers_get_distinct_indices(self):
+        for store in ('files', 'sqlite'):
+            with self.subTest(store=store):
+                queue = self.executor(f'producers_{store}', store=store)
+                indices = []
+
+                def produce(producer):
+                    for block in range(5):
+                        queue.enqueue_many((f'echo {producer} {block} {i}' for i in range(7)), block_size=3)
+                        indices.extend(queue.enqueue([f'echo {producer} {block}']))
+
+                producers = [threading.Thread(target=produce, args=(producer,)) for producer in range(4)]
+                for producer in producers:
+                    producer.start()
+                for producer in producers:
+                    producer.join()
+
+                pending = queue.read_queue()
+                self.assertEqual(len(pending), 4 * 5 * 8)
+                self.assertEqual(len(set(pending)), len(pending))
+                self.assertTrue(set(indices) <= set(pending))
+                commands = {queue.store.read(idx) for idx in pending}
+                self.assertEqual(len(commands), len(pending))
+
+    def test_sqlite_indices_are_never_reused(self):
+        queue = self.executor('sqlite_indices', store='sqlite')
+        self.assertEqual(queue.enqueue_many((f'echo {i}' for i in range(5)), block_size=2), 5)
+        first = queue.read_queue()
+        self.assertEqual([queue.store.read(idx) for idx in first], [f'echo {i}' for i in range(5)])
+        self.assertEqual(first, list(range(first[0], first[0] + 5)))
+
+        queue.store.dequeue(first[-2:])
+        self.assertEqual(queue.enqueue(['echo again']), [first[-1] + 1])
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import os
+from time import sleep
+from tests.executors.queue_harness import QueueTestCase
+
+
+class TestLeases(QueueTestCase):
+
+    def enqueue_unseen(self, queue, cmd):
+        """
+        Enqueue a command the way a producer on another host shows up to inotify: not at all. A hard link only
+        raises IN_CREATE, which the watcher doesn't listen to.
+        """
+        idx = queue.store.sequence.allocate(1)
+        queue.store.incoming.mkdir(parents=True, exist_ok=True)
+        (queue.store.incoming / str(idx)).write_text(cmd)
+        os.link(queue.store.incoming / str(idx), queue.store.queue / str(idx))
+        (queue.store.incoming / str(idx)).unlink()
+
+    def test_idle_daemon_rescans_on_every_heartbeat(self):
+        runs = self.queues / 'runs'
+        queue = self.executor('shared')
+        queue.save_settings(lease_ttl=1.5)
+        self.start_daemon('shared', leases=True, wakeup='inotify')
+        self.wait_for(lambda: self.worker_ids('shared'))
+        sleep(1)  # Blocked in its wait
+        self.enqueue_unseen(queue, f'echo ran >> {runs}')
+        self.wait_for(lambda: runs.exists(), timeout=5, message="The command enqueued unseen never ran")
+
+    def test_commands_of_a_dead_worker_are_reclaimed_and_run_once(self):
+        for store in ('files', 'sqlite'):
+            with self.subTest(store=store):
+                name = f'reclaim_{store}'
+                runs = self.queues / f'runs_{store}'
+                dead = self.executor(name, store=store, leases=True, worker_id='dead-host-1')
+                dead.save_settings(lease_ttl=1)
+                # Each command outlives the lease: the heartbeats of the live workers must keep it theirs.
+                indices = dead.enqueue([f'echo {i} >> {runs}; sleep 2' for i in range(4)])
+                dead.store.heartbeat()
+                self.assertEqual(len(dead.store.claim()), 4)
+
+                self.start_daemon(name, store=store, leases=True)
+                self.start_daemon(name, store=store, leases=True)
+                self.wait_for(lambda: dead.count_results() == 4, message="The reclaimed commands never ran")
+                sleep(2)  # A lease wrongly expired would run a command again by now
+
+                self.assertEqual(sorted(runs.read_text().split()), ['0', '1', '2', '3'])
+                self.assertEqual(sorted(record['idx'] for record in dead.results()), indices)
+                self.assertTrue(all(record['status'] for record in dead.results()))
+                self.assertEqual(dead.store.depth(), 0)
+                self.assertEqual(len(set(self.worker_ids(name))), 2)
+                if store == 'files':
+                    self.assertNotIn('dead-host-1', os.listdir(self.queues / name / 'claimed'))
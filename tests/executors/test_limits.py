@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import signal
+import asyncio
+from tests.executors.queue_harness import QueueTestCase
+
+
+class TestLimits(QueueTestCase):
+
+    def run_command(self, queue, engine):
+        """
+        Claim and run the next command of a queue in the test process with an engine.
+        :return: Completion record of the command
+        """
+        [(idx, cmd, meta)] = queue.store.claim(limit=1)
+        if engine == 'asyncio':
+            asyncio.run(queue.execute_command_async(idx, cmd, meta))
+        else:
+            queue.execute_command(idx, cmd, meta)
+        return queue.get_result(idx)
+
+    def test_rlimits_are_set_before_the_command_runs(self):
+        for engine in ('process', 'asyncio'):
+            with self.subTest(engine=engine):
+                queue = self.executor(f'rlimits_{engine}')
+                queue.enqueue(['ulimit -S -t; ulimit -H -t; ulimit -v'], rlimit_cpu=7, rlimit_as=512 * 1024 ** 2)
+                record = self.run_command(queue, engine)
+                self.assertTrue(record['status'])
+                self.assertEqual(record['output'].split(), ['7', '8', str(512 * 1024)])
+
+    def test_rlimit_that_cannot_be_set_fails_the_command(self):
+        queue = self.executor('rlimits_invalid')
+        queue.enqueue(['echo ran'], rlimit_as=-1024, max_attempts=1)
+        record = self.run_command(queue, 'process')
+        self.assertFalse(record['status'])
+        self.assertEqual(record['returncode'], 126)
+        self.assertIsNone(record['output'])
+
+    def test_timeout_stops_the_command_with_sigterm(self):
+        for engine in ('process', 'asyncio'):
+            with self.subTest(engine=engine):
+                queue = self.executor(f'timeout_{engine}')
+                queue.save_settings(max_attempts=1)
+                queue.enqueue(['sleep 30'], timeout=0.5)
+                record = self.run_command(queue, engine)
+                self.assertFalse(record['status'])
+                self.assertTrue(record['timed_out'])
+                self.assertEqual(record['returncode'], -signal.SIGTERM)
+                self.assertLess(record['wall_time'], 5)
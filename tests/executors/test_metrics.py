@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import json
+from tests.executors.queue_harness import QueueTestCase
+
+
+class TestMetrics(QueueTestCase):
+
+    def stats(self, queue_name):
+        try:
+            return json.loads((self.queues / queue_name / 'metrics.json').read_text())
+        except (OSError, ValueError):
+            return None
+
+    def test_queue_depth_leaves_the_commands_in_flight_out(self):
+        for store in ('files', 'sqlite'):
+            for dispatch in ('batch', 'continuous'):
+                with self.subTest(store=store, dispatch=dispatch):
+                    name = f'depth_{store}_{dispatch}'
+                    queue = self.executor(name, pool=2, store=store)
+                    queue.save_settings(metrics_interval=0.1)
+                    queue.enqueue(['sleep 30'] * 5)
+                    self.start_daemon(name, store=store, dispatch=dispatch)
+
+                    # A batch claims the whole queue at once, continuous dispatch only what the pool can start.
+                    in_flight, depth = (5, 0) if dispatch == 'batch' else (2, 3)
+                    stats = self.wait_for(
+                        lambda: (self.stats(name) or {}).get('in_flight') == in_flight and self.stats(name),
+                        message="The commands were never dispatched"
+                    )
+                    self.assertEqual(stats['queue_depth'], depth)
+                    self.assertEqual(stats['pool_size'], 2)
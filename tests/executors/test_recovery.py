@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import os
+from tests.executors.queue_harness import QueueTestCase
+from src.executors.journal import pid_alive
+
+
+class TestCrashRecovery(QueueTestCase):
+
+    def test_restart_after_sigkill_reuses_worker_id_and_reruns_interrupted_command(self):
+        runs = self.queues / 'runs'
+        queue = self.executor('crash')
+        [idx] = queue.enqueue([f'echo $$ >> {runs}; sleep 30'])
+        daemon = self.start_daemon('crash', leases=True)
+        self.wait_for(lambda: runs.exists(), message="The command never started")
+        first_run = int(runs.read_text())
+
+        # The daemon dies, its pool worker and the command it runs are orphaned.
+        self.kill_daemon(daemon)
+        self.assertTrue(pid_alive(first_run))
+        self.start_daemon('crash', leases=True)
+
+        self.wait_for(lambda: len(self.worker_ids('crash')) == 2)
+        first_id, restarted_id = self.worker_ids('crash')
+        self.assertEqual(restarted_id, first_id)
+        self.assertEqual(os.listdir(self.queues / 'crash' / 'claimed'), [first_id])
+
+        # Recovery stops the orphan and records the interrupted run, the command runs again.
+        self.wait_for(lambda: len(runs.read_text().split()) == 2, message="The command didn't run again")
+        self.wait_for(lambda: not pid_alive(first_run), message="The orphaned command is still running")
+        records = [record for record in queue.results() if record['idx'] == idx]
+        self.assertEqual(len(records), 1)
+        self.assertTrue(records[0]['interrupted'])
+        self.assertEqual(records[0]['attempt'], 1)
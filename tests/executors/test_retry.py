@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+from tests.executors.queue_harness import QueueTestCase
+
+
+class TestRetry(QueueTestCase):
+
+    def test_retries_then_dead_letter(self):
+        for store in ('files', 'sqlite'):
+            with self.subTest(store=store):
+                runs = self.queues / f'runs_{store}'
+                queue = self.executor(f'retry_{store}', store=store)
+                retried, not_retryable = queue.enqueue(
+                    [f'echo $$ >> {runs}; exit 3', 'exit 4'], max_attempts=3, retry_on=[3], retry_backoff=0.1
+                )
+                self.start_daemon(f'retry_{store}', store=store)
+                self.wait_for(lambda: len(queue.dead_letters()) == 2, message="The commands never failed for good")
+
+                self.assertEqual(len(runs.read_text().split()), 3)
+                attempts = {}
+                for record in queue.results():
+                    self.assertFalse(record['status'])
+                    attempts.setdefault(record['idx'], []).append((record['attempt'], record['returncode']))
+                self.assertEqual(attempts, {retried: [(1, 3), (2, 3), (3, 3)], not_retryable: [(1, 4)]})
+
+                dead_letters = {letter['idx']: letter for letter in queue.dead_letters()}
+                self.assertEqual(dead_letters[retried]['attempts'], 3)
+                self.assertEqual(dead_letters[not_retryable]['attempts'], 1)
+                self.assertEqual(dead_letters[retried]['meta']['retry_on'], [3])
+                self.assertEqual(queue.store.depth(), 0)
+
+                # Requeued with new indices, the attempts start over.
+                self.assertEqual(queue.requeue_dead_letters([not_retryable]), 1)
+                self.wait_for(lambda: len(queue.dead_letters()) == 2, message="The requeued command never ran")
+                [requeued] = [letter for letter in queue.dead_letters() if letter['idx'] != retried]
+                self.assertNotEqual(requeued['idx'], not_retryable)
+                self.assertEqual((requeued['command'], requeued['attempts']), ('exit 4', 1))
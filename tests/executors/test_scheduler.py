@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+from tests.executors.queue_harness import QueueTestCase
+from src.executors.scheduler import LaneScheduler, __DEFAULT_LANE__
+
+
+class TestScheduler(QueueTestCase):
+
+    def dispatch(self, queue, scheduler, slots, limit=1, running=None):
+        """
+        Claim the commands of a queue `limit` at a time, each claimed command completes before the next claim.
+        :return: List of (idx, lane) in dispatch order
+        """
+        order = []
+        while len(order) < slots:
+            claimed = queue.store.claim(limit=limit, scheduler=scheduler, running=running)
+            if not claimed:
+                break
+            order.extend((idx, meta.get('lane', __DEFAULT_LANE__)) for idx, _, meta in claimed)
+            queue.store.dequeue([idx for idx, _, _ in claimed])
+        return order
+
+    def test_strict_priority_across_lanes(self):
+        for store in ('files', 'sqlite'):
+            with self.subTest(store=store):
+                queue = self.executor(f'priority_{store}', store=store)
+                batch = queue.enqueue(['echo batch'] * 3, lane='batch')
+                [default] = queue.enqueue(['echo default'], priority=1)
+                web = queue.enqueue(['echo web'] * 2, lane='web', priority=5)
+                [urgent] = queue.enqueue(['echo urgent'], lane='batch', priority=9)
+
+                order = [idx for idx, _ in self.dispatch(queue, LaneScheduler(), slots=10)]
+                self.assertEqual(order, [urgent, *web, default, *batch])
+
+    def test_lane_caps(self):
+        for store in ('files', 'sqlite'):
+            with self.subTest(store=store):
+                queue = self.executor(f'caps_{store}', store=store)
+                queue.enqueue(['echo web'] * 3, lane='web', priority=5)
+                [batch] = queue.enqueue(['echo batch'], lane='batch')
+                scheduler = LaneScheduler(caps={'web': 2})
+
+                claimed = queue.store.claim(scheduler=scheduler, running={'web': 1})
+                self.assertEqual([meta.get('lane') for _, _, meta in claimed], ['web', 'batch'])
+                self.assertEqual(claimed[-1][0], batch)
+
+    def test_weighted_round_robin(self):
+        for store in ('files', 'sqlite'):
+            with self.subTest(store=store):
+                queue = self.executor(f'weighted_{store}', store=store)
+                # The light lane is enqueued first, FIFO alone would run all of it before the heavy lane.
+                light = queue.enqueue(['echo light'] * 8, lane='light')
+                heavy = queue.enqueue(['echo heavy'] * 12, lane='heavy', priority=-1)
+                scheduler = LaneScheduler(policy='weighted', weights={'heavy': 3})
+
+                # One claim of several commands gets the same shares as claims of one command.
+                first = queue.store.claim(limit=4, scheduler=scheduler)
+                queue.store.dequeue([idx for idx, _, _ in first])
+                order = [(idx, meta.get('lane')) for idx, _, meta in first] + self.dispatch(queue, scheduler, slots=12)
+                lanes = [lane for _, lane in order]
+                for start in range(0, 16, 4):
+                    self.assertEqual(sorted(lanes[start:start + 4]), ['heavy'] * 3 + ['light'])
+                # Inside a lane, commands still run by priority then FIFO.
+                self.assertEqual([idx for idx, lane in order if lane == 'light'], light[:4])
+                self.assertEqual([idx for idx, lane in order if lane == 'heavy'], heavy)
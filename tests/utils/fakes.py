@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+    In-memory stand-ins of psycopg2 and psycopg 3, installed only when the real packages are missing, so the
+    handlers can be imported and their logic tested without a database.
+"""
+
+import sys
+import types
+import threading
+from unittest import mock
+from contextlib import asynccontextmanager
+
+
+__author__ = "Mohammed Ataaur Rahaman"
+
+
+class FakeCursor:
+
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.name = name
+        self.rows = []
+        self.closed = False
+
+    def execute(self, query, params=None):
+        self.conn.statements.append((query, params))
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FakeConnection:
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = 0
+        self.autocommit = False
+        self.readonly = None
+
+    def cursor(self, name=None, cursor_factory=None):
+        return FakeCursor(self, name)
+
+    def set_session(self, readonly=None, autocommit=None):
+        self.readonly, self.autocommit = readonly, autocommit
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeThreadedConnectionPool:
+    created = 0
+
+    def __init__(self, min_size, max_size, **kwargs):
+        FakeThreadedConnectionPool.created += 1
+        self.kwargs = kwargs
+        self.free = [FakeConnection(**kwargs) for _ in range(min_size)]
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            return self.free.pop() if self.free else FakeConnection(**self.kwargs)
+
+    def putconn(self, conn, close=False):
+        with self.lock:
+            if close:
+                conn.close()
+            else:
+                self.free.append(conn)
+
+    def closeall(self):
+        for conn in self.free:
+            conn.close()
+
+
+def install_psycopg2():
+    """
+    Make `import psycopg2` work, with the real package when it is installed.
+    """
+    try:
+        import psycopg2  # noqa: F401
+        return False
+    except ImportError:
+        pass
+    psycopg2 = types.ModuleType('psycopg2')
+    psycopg2.Error = type('Error', (Exception,), {})
+    psycopg2.connect = FakeConnection
+    psycopg2.pool = types.ModuleType('psycopg2.pool')
+    psycopg2.pool.ThreadedConnectionPool = FakeThreadedConnectionPool
+    psycopg2.sql = mock.MagicMock(name='psycopg2.sql')
+    psycopg2.extras = types.ModuleType('psycopg2.extras')
+    psycopg2.extras.execute_values = mock.MagicMock(name='execute_values')
+    psycopg2.extras.RealDictCursor = object
+    for name in ('psycopg2', 'psycopg2.pool', 'psycopg2.sql', 'psycopg2.extras'):
+        sys.modules[name] = psycopg2 if name == 'psycopg2' else getattr(psycopg2, name.split('.')[1])
+    return True
+
+
+class FakeAsyncCursor:
+
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.name = name
+        self.description = None
+        self.rows = []
+        self.itersize = None
+        self.closed = False
+
+    async def execute(self, query, params=None):
+        self.conn.statements.append((query, params))
+        self.rows = list(self.conn.results.get(query, []))
+        self.description = [('column',)] if query in self.conn.results else None
+        if self.conn.fail_on == query:
+            raise FakeAsyncConnection.Error(f"failed: {query}")
+
+    async def executemany(self, query, params_seq):
+        self.conn.statements.append((query, list(params_seq)))
+
+    async def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    async def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    async def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    async def close(self):
+        self.closed = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class FakeAsyncConnection:
+    """
+    Records its statements, transaction() nests as psycopg does: BEGIN/COMMIT outside, savepoints inside.
+    """
+    Error = type('Error', (Exception,), {})
+
+    def __init__(self, results=None, fail_on=None):
+        self.results = results or {}  # query -> rows it returns
+        self.fail_on = fail_on  # query that raises
+        self.statements = []
+        self.depth = 0
+        self.pipelines = 0
+
+    def cursor(self, name=None, row_factory=None):
+        return FakeAsyncCursor(self, name)
+
+    @asynccontextmanager
+    async def transaction(self):
+        self.depth += 1
+        name = f'sp{self.depth}'
+        self.statements.append('BEGIN' if self.depth == 1 else f'SAVEPOINT {name}')
+        try:
+            yield self
+        except BaseException:
+            self.statements.append('ROLLBACK' if self.depth == 1 else f'ROLLBACK TO SAVEPOINT {name}')
+            raise
+        else:
+            self.statements.append('COMMIT' if self.depth == 1 else f'RELEASE SAVEPOINT {name}')
+        finally:
+            self.depth -= 1
+
+    @asynccontextmanager
+    async def pipeline(self):
+        self.pipelines += 1
+        yield self
+        self.statements.append('SYNC')
+
+
+class FakeAsyncConnectionPool:
+    check_connection = None
+
+    def __init__(self, conninfo, **kwargs):
+        self.conninfo = conninfo
+        self.kwargs = kwargs
+        self.conn = FakeAsyncConnection()
+        self.checkouts = 0
+        self.closed = True
+
+    async def open(self, wait=False):
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+    @asynccontextmanager
+    async def connection(self):
+        self.checkouts += 1
+        yield self.conn
+
+
+def install_psycopg():
+    """
+    Make `import psycopg` and `import psycopg_pool` work, with the real packages when they are installed.
+    """
+    try:
+        import psycopg  # noqa: F401
+        import psycopg_pool  # noqa: F401
+        return False
+    except ImportError:
+        pass
+    psycopg = types.ModuleType('psycopg')
+    psycopg.Error = FakeAsyncConnection.Error
+    psycopg.sql = mock.MagicMock(name='psycopg.sql')
+    psycopg.rows = types.ModuleType('psycopg.rows')
+    psycopg.rows.dict_row = object()
+    psycopg.conninfo = types.ModuleType('psycopg.conninfo')
+    psycopg.conninfo.make_conninfo = lambda **kwargs: ' '.join(f'{key}={value}' for key, value in kwargs.items())
+    psycopg_pool = types.ModuleType('psycopg_pool')
+    psycopg_pool.AsyncConnectionPool = FakeAsyncConnectionPool
+    for name in ('rows', 'conninfo', 'sql'):
+        sys.modules[f'psycopg.{name}'] = getattr(psycopg, name)
+    sys.modules['psycopg'] = psycopg
+    sys.modules['psycopg_pool'] = psycopg_pool
+    return True
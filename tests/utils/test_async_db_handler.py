@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import io
+import unittest
+from unittest import mock
+from contextlib import redirect_stdout
+from tests.utils.fakes import install_psycopg, FakeAsyncConnection, FakeAsyncConnectionPool
+
+install_psycopg()
+
+from src.utils import async_db_handler  # noqa: E402
+from src.utils.async_db_handler import AsyncDbHandler  # noqa: E402
+
+
+class TestAsyncDbHandler(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        patcher = mock.patch.object(async_db_handler, 'AsyncConnectionPool', FakeAsyncConnectionPool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = AsyncDbHandler('db', 'user', 'pass', 'localhost', 5432)
+        await self.db.create_connection()
+        self.conn = self.db.pool.conn
+
+    async def asyncTearDown(self):
+        await self.db.close_connection()
+
+    async def test_nested_transactions_are_savepoints(self):
+        self.conn.fail_on = 'INSERT tag'
+        async with self.db.transaction():
+            await self.db.execute_query('INSERT run')
+            with self.assertRaises(FakeAsyncConnection.Error):
+                async with self.db.transaction():
+                    await self.db.execute_query('INSERT tag')
+            async with self.db.transaction():
+                await self.db.execute_query('INSERT log')
+        self.assertEqual(self.conn.statements, [
+            'BEGIN',
+            ('INSERT run', None),
+            'SAVEPOINT sp2', ('INSERT tag', None), 'ROLLBACK TO SAVEPOINT sp2',
+            'SAVEPOINT sp2', ('INSERT log', None), 'RELEASE SAVEPOINT sp2',
+            'COMMIT',
+        ])
+        # The queries of the block join the transaction instead of checking out connections of their own
+        self.assertEqual(self.db.pool.checkouts, 1)
+
+    async def test_transaction_rolled_back_on_error(self):
+        with self.assertRaises(ValueError):
+            async with self.db.transaction():
+                await self.db.execute_query('UPDATE jobs')
+                raise ValueError()
+        self.assertEqual(self.conn.statements, ['BEGIN', ('UPDATE jobs', None), 'ROLLBACK'])
+        self.assertIsNone(self.db._transaction.get())
+
+    async def test_fetch_pipeline(self):
+        self.conn.results = {'SELECT 1': [(1,)], 'SELECT 2': [(2,), (3,)]}
+        results = await self.db.fetch_pipeline([('SELECT 1', None), ('UPDATE jobs', ('x',)), ('SELECT 2', None)])
+        self.assertEqual(results, [[(1,)], None, [(2,), (3,)]])
+        self.assertEqual(self.conn.pipelines, 1)
+        self.assertEqual(self.conn.statements[-1], 'SYNC')
+
+    async def test_errors_are_logged_not_printed(self):
+        self.conn.fail_on = 'SELECT broken'
+        stdout = io.StringIO()
+        with redirect_stdout(stdout), self.assertLogs(level='ERROR') as logs:
+            with self.assertRaises(FakeAsyncConnection.Error):
+                await self.db.fetchall_query('SELECT broken', error_msg='Listing the jobs failed')
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIn('Listing the jobs failed', logs.output[0])
+
+    async def test_bulk_insert_in_pages(self):
+        rows = [{'name': f'job-{i}', 'status': 'queued'} for i in range(5)]
+        self.assertEqual(await self.db.bulk_insert('jobs', rows, page_size=2), 5)
+        pages = [statement[1] for statement in self.conn.statements if isinstance(statement, tuple)]
+        self.assertEqual(pages, [
+            [('job-0', 'queued'), ('job-1', 'queued')],
+            [('job-2', 'queued'), ('job-3', 'queued')],
+            [('job-4', 'queued')],
+        ])
+        self.assertEqual((self.conn.statements[0], self.conn.statements[-1]), ('BEGIN', 'COMMIT'))
+
+    async def test_bulk_insert_from_async_iterable(self):
+        async def rows():
+            for i in range(3):
+                yield (i, 'queued')
+
+        self.assertEqual(await self.db.bulk_insert('jobs', rows(), columns=['id', 'status']), 3)
+        self.assertEqual(await self.db.bulk_insert('jobs', []), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
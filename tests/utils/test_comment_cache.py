@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from src.utils.comment_cache import CommentCache, __MEMORY__, __DISK__, __MISS__
+
+__SOURCE__ = "x = 1  # one\n"
+
+
+class TestCommentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_tiers(self):
+        path = self.tmp / 'cache' / 'comments.sqlite'
+        cache = CommentCache(path=path)
+        stripped, tier = cache.lookup(__SOURCE__, 'py')
+        self.assertEqual(tier, __MISS__)
+        self.assertEqual(cache.lookup(__SOURCE__, 'py'), (stripped, __MEMORY__))
+        cache.close()
+        self.assertEqual(CommentCache(path=path).lookup(__SOURCE__, 'py'), (stripped, __DISK__))
+
+    def test_unusable_cache_dir_falls_back_to_memory(self):
+        (self.tmp / 'file').write_text('')
+        cache = CommentCache(path=self.tmp / 'file' / 'comments.sqlite')
+        with self.assertLogs('src.utils.comment_cache', level='WARNING') as logs:
+            stripped, tier = cache.lookup(__SOURCE__, 'py')
+            cache.clear()
+        self.assertEqual(tier, __MISS__)
+        self.assertIn('Failed to read the comment cache', logs.output[0])
+        self.assertIn('Failed to write the comment cache', logs.output[1])
+        self.assertIn('Failed to clear the comment cache', logs.output[2])
+        self.assertEqual(cache.comment_remover(__SOURCE__, 'py'), stripped)
+
+    def test_clear_with_broken_database(self):
+        path = self.tmp / 'comments.sqlite'
+        cache = CommentCache(path=path)
+        cache.lookup(__SOURCE__, 'py')
+        with sqlite3.connect(str(path)) as conn:
+            conn.execute("DROP TABLE comments")
+        with self.assertLogs('src.utils.comment_cache', level='WARNING'):
+            cache.clear()
+        self.assertEqual(cache.stats()['items'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
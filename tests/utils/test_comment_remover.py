@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import unittest
+from src.utils.comment_remover import c_family_comments, SqlCommentLexer
+
+
+class TestCFamilyComments(unittest.TestCase):
+
+    def test_literals_keep_comment_markers(self):
+        source = 'char *s = "/* no */"; // one\nchar c = \'/\'; /* two */ int d;\n'
+        self.assertEqual(c_family_comments(source, 'c'), 'char *s = "/* no */"; \nchar c = \'/\';  int d;\n')
+
+    def test_digit_separators_are_no_char_literals(self):
+        source = "long n = 1'000 /* thousand */ + 0xFF'FF; // sum\nchar c = '/'; // slash\n"
+        self.assertEqual(c_family_comments(source, 'cpp'), "long n = 1'000  + 0xFF'FF; \nchar c = '/'; \n")
+
+    def test_prefixed_char_literals(self):
+        source = "auto a = u8'/', b = L'/', c = u'*', d = U'/'; /* chars */\n"
+        self.assertEqual(c_family_comments(source, 'cpp'), "auto a = u8'/', b = L'/', c = u'*', d = U'/'; \n")
+
+
+class TestSqlCommentLexer(unittest.TestCase):
+
+    @staticmethod
+    def strip(source, chunk_size):
+        lexer = SqlCommentLexer()
+        pieces = [lexer.feed(source[i:i + chunk_size]) for i in range(0, len(source), chunk_size)]
+        return ''.join(pieces) + lexer.feed('', final=True)
+
+    def test_comments_and_literals(self):
+        source = "SELECT '--no' /* block */, $$ /* body */ $$ -- line\nFROM t;\n"
+        for chunk_size in (1, 2, 7, len(source)):
+            self.assertEqual(self.strip(source, chunk_size), "SELECT '--no' , $$ /* body */ $$ \nFROM t;\n")
+
+    def test_line_comment_keeps_crlf(self):
+        source = "SELECT 1; -- one\r\nSELECT 2; -- two\r\n--\r\nSELECT 3;\r\n"
+        for chunk_size in (1, 2, 3, len(source)):
+            self.assertEqual(self.strip(source, chunk_size), "SELECT 1; \r\nSELECT 2; \r\n\r\nSELECT 3;\r\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import io
+import pickle
+import unittest
+import threading
+from unittest import mock
+from contextlib import redirect_stdout
+from tests.utils.fakes import install_psycopg2, FakeConnection, FakeCursor
+
+install_psycopg2()
+
+import psycopg2.pool  # noqa: E402
+from src.utils.db_handler import copy_value, CopyBuffer, DbHandler  # noqa: E402
+
+
+class TestCopyValue(unittest.TestCase):
+
+    def test_scalars(self):
+        self.assertEqual(copy_value(None), '\\N')
+        self.assertEqual(copy_value(True), 't')
+        self.assertEqual(copy_value(False), 'f')
+        self.assertEqual(copy_value(42), '42')
+        self.assertEqual(copy_value({'a': [1]}), '{"a": [1]}')
+
+    def test_text_escapes(self):
+        self.assertEqual(copy_value('a\tb\nc\\d\re'), 'a\\tb\\nc\\\\d\\re')
+
+    def test_binary_as_escaped_bytea_hex(self):
+        expected = '\\\\x00ff5c0a'
+        self.assertEqual(copy_value(b'\x00\xff\\\n'), expected)
+        self.assertEqual(copy_value(bytearray(b'\x00\xff\\\n')), expected)
+        self.assertEqual(copy_value(memoryview(b'\x00\xff\\\n')), expected)
+        self.assertEqual(copy_value(b''), '\\\\x')
+
+
+class TestCopyBuffer(unittest.TestCase):
+
+    def test_rows_in_copy_text_format(self):
+        buffer = CopyBuffer([(1, 'a b', None), (2, b'\x01', True)])
+        self.assertEqual(buffer.read(), b'1\ta b\t\\N\n2\t\\\\x01\tt\n')
+        self.assertEqual(buffer.count, 2)
+
+    def test_sized_reads(self):
+        rows = [(i, 'x' * 10) for i in range(100)]
+        expected = CopyBuffer(rows).read()
+        buffer = CopyBuffer(rows)
+        chunks = []
+        while True:
+            chunk = buffer.read(7)
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), 7)
+            chunks.append(chunk)
+        self.assertEqual(b''.join(chunks), expected)
+
+
+class TestPool(unittest.TestCase):
+
+    def test_concurrent_first_checkouts_create_one_pool(self):
+        created = []
+        start = threading.Barrier(8)
+        real_pool = psycopg2.pool.ThreadedConnectionPool
+
+        def slow_pool(*args, **kwargs):
+            created.append(1)
+            threading.Event().wait(0.05)  # Widen the window between the check and the assignment
+            return real_pool(*args, **kwargs)
+
+        db = DbHandler('db', 'user', 'pass', 'localhost', 5432, pooled=True, max_size=8)
+
+        def first_checkout():
+            start.wait()
+            db.checkin(db.checkout())
+
+        with mock.patch.object(psycopg2.pool, 'ThreadedConnectionPool', side_effect=slow_pool):
+            threads = [threading.Thread(target=first_checkout) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(created), 1)
+
+    def test_pickle_round_trip(self):
+        db = DbHandler('db', 'user', 'pass', 'localhost', 5432, pooled=True)
+        db.checkin(db.checkout())
+        copy = pickle.loads(pickle.dumps(db))
+        self.assertIsNone(copy.pool)
+        self.assertEqual((copy.db_name, copy.url, copy.max_size), ('db', 'localhost:5432', 10))
+        copy.checkin(copy.checkout())
+        self.assertIsNotNone(copy.pool)
+        self.assertIsNot(copy.pool, db.pool)
+
+
+class TestIterQuery(unittest.TestCase):
+
+    def test_errors_are_logged_not_printed(self):
+        db = DbHandler('db', 'user', 'pass', 'localhost', 5432)
+        db.conn = FakeConnection()
+        stdout = io.StringIO()
+        with mock.patch.object(FakeCursor, 'execute', side_effect=RuntimeError('boom')), \
+                redirect_stdout(stdout), self.assertLogs(level='ERROR') as logs:
+            with self.assertRaises(RuntimeError):
+                list(db.iter_query('SELECT * FROM events', error_msg='Streaming the events failed'))
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIn('Streaming the events failed', logs.output[0])
+        self.assertEqual(db.conn.rollbacks, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()